@@ -0,0 +1,342 @@
+'''
+Vectorized re-triage of stored summaries.
+
+Summaries are loaded into columnar NumPy arrays - one row per procedure plus flat per-polyp arrays with a
+procedure index - the polyp aggregates are computed with grouped reductions, every rule is evaluated as a
+boolean mask in the priority order of rules.RULE_TABLE and the procedures of a case are combined as
+rules.combine_history does, with a grouped minimum over the most recent ones. Every case functions.triage +
+age_out can evaluate gets the same outcome, including rule_24 for failed extractions and summaries without a
+colonoscopy.
+
+Summaries missing a value the rules need (age, polyp count, a prep score the rule_2 check reaches, or the size
+of a counted polyp) are reported as invalid instead of being triaged - functions.triage raises on these.
+
+    python -m app.bulk summaries.jsonl -o outcomes.jsonl
+'''
+import sys
+import json
+import datetime
+import argparse
+from collections import Counter
+
+import numpy as np
+from pydantic import ValidationError
+
+from app import rules
+from app.models.colonoscopy import ColonoscopySummary
+
+#polyp type codes
+ADENOMA, SSL, HYPERPLASTIC, TVA, OTHER = range(5)
+POLYP_TYPE_CODES = {
+    'adenoma': ADENOMA,
+    'sessile_serrated_polyp': SSL,
+    'hyperplastic_polyp': HYPERPLASTIC,
+    'tubulovillous_or_villous_adenoma': TVA,
+}
+SIZED_TYPES = (ADENOMA, SSL, HYPERPLASTIC)
+#total, right, transverse, left - below any of these is inadequate prep (rule_2)
+PREP_LIMITS = (6, 2, 2, 2)
+
+EXTRA_RULES = [rules.FALLBACK_RULE, rules.AGE_OUT_RULE, rules.EXTRACTION_FAILED_RULE]
+RULE_IDS = [rule for rule, _, _ in rules.RULE_TABLE] + [rule for rule, _ in EXTRA_RULES]
+FALLBACK_CODE = len(rules.RULE_TABLE)
+AGE_OUT_CODE = FALLBACK_CODE + 1
+EXTRACTION_FAILED_CODE = FALLBACK_CODE + 2
+INVALID_CODE = -1
+FOLLOW_UPS = np.array([follow_up for _, follow_up, _ in rules.RULE_TABLE] + [follow_up for _, follow_up in EXTRA_RULES])
+HIGH_RISK_CODES = np.array([RULE_IDS.index(rule) for rule in sorted(rules.HIGH_RISK_RULES)])
+
+
+def prep_readable(prep) -> bool:
+    '''
+    Whether the scalar rule_2 check gets an answer from these prep scores - it compares them in order and
+    stops at the first inadequate one, so a missing score after it does not matter
+    '''
+    for score, limit in zip(prep, PREP_LIMITS):
+        if score is None:
+            return False
+        if score < limit:
+            return True
+    return True
+
+
+class SummaryColumns:
+    '''
+    Columnar view of many summaries. Per-procedure arrays have one row per colonoscopy (a summary without any
+    still gets one, invalid, row, and date holds each row's date ordinal) and procedure_case maps each row to its summary. case_failed marks the
+    summaries rules.extraction_failed would send to review. Per-polyp arrays are flat and
+    polyp_case maps each polyp to its procedure row (offsets[i]:offsets[i + 1] are the polyps of row i)
+    '''
+
+    def __init__(self, summaries):
+        age, total_polyps, bbps, cecum_no, has_polyps, valid = [], [], [], [], [], []
+        indication, date = [], []
+        counts = []
+        procedure_case, case_age, case_valid, case_failed = [], [], [], []
+        polyp_type, polyp_size, polyp_hgd, polyp_dysplastic, polyp_incomplete = [], [], [], [], []
+
+        for case, data in enumerate(summaries):
+            if isinstance(data, ColonoscopySummary):
+                data = data.model_dump()
+            #rules.extraction_failed, for dicts that may lack the colonoscopy key
+            failed = not data.get('extraction_successful', True) or not data.get('colonoscopy')
+            case_ok = not failed and data.get('patient_age') is not None
+            all_ok = case_ok
+            for colonoscopy in data.get('colonoscopy') or [{}]:
+                scores = colonoscopy.get('bostonBowelPrepScore') or {}
+                prep = [scores.get(k) for k in ('total', 'right', 'transverse', 'left')]
+                #rule_1 is checked first, so a procedure that did not reach the caecum needs no prep scores or count
+                ok = case_ok and (colonoscopy.get('cecum_reached') is False
+                                  or (prep_readable(prep) and colonoscopy.get('number_of_polyps') is not None))
+                polyps = colonoscopy.get('polyps') or []
+
+                for polyp in polyps:
+                    code = POLYP_TYPE_CODES.get(polyp['type'], OTHER)
+                    size = polyp['size']
+                    if size is None:
+                        if code in SIZED_TYPES:
+                            ok = False
+                        size = 0
+                    polyp_type.append(code)
+                    polyp_size.append(size)
+                    polyp_hgd.append(polyp['dysplasia'] == 'high_grade')
+                    polyp_dysplastic.append(polyp['dysplasia'] in ('low_grade', 'high_grade'))
+                    polyp_incomplete.append(polyp['resection'] != 'complete' or polyp['retrieval'] != 'complete')
+
+                counts.append(len(polyps))
+                age.append(data.get('patient_age') or 0)
+                indication.append(data.get('indication', ''))
+                total_polyps.append(colonoscopy.get('number_of_polyps') or 0)
+                bbps.append([0 if v is None else v for v in prep])
+                cecum_no.append(colonoscopy.get('cecum_reached') is False)
+                has_polyps.append(bool(polyps))
+                #days since 0001-01-01, -1 for undated procedures
+                procedure_date = rules.normalize_date(colonoscopy.get('date'))
+                date.append(datetime.date.fromisoformat(procedure_date).toordinal() if procedure_date else -1)
+                valid.append(ok)
+                procedure_case.append(case)
+                all_ok = all_ok and ok
+            case_age.append(data.get('patient_age') or 0)
+            case_valid.append(all_ok)
+            case_failed.append(failed)
+
+        self.n = len(counts)
+        self.n_cases = len(case_valid)
+        self.age = np.array(age, dtype = np.int64)
+        self.indication = np.array(indication, dtype = object)
+        self.total_polyps = np.array(total_polyps, dtype = np.int64)
+        self.bbps = np.array(bbps, dtype = np.int64).reshape(self.n, 4)
+        self.cecum_no = np.array(cecum_no, dtype = bool)
+        self.has_polyps = np.array(has_polyps, dtype = bool)
+        self.date = np.array(date, dtype = np.int64)
+        self.valid = np.array(valid, dtype = bool)
+        self.procedure_case = np.array(procedure_case, dtype = np.int64)
+        self.case_age = np.array(case_age, dtype = np.int64)
+        self.case_valid = np.array(case_valid, dtype = bool)
+        self.case_failed = np.array(case_failed, dtype = bool)
+
+        self.offsets = np.zeros(self.n + 1, dtype = np.int64)
+        np.cumsum(counts, out = self.offsets[1:])
+        self.polyp_case = np.repeat(np.arange(self.n), counts)
+        self.polyp_type = np.array(polyp_type, dtype = np.int8)
+        self.polyp_size = np.array(polyp_size, dtype = np.int64)
+        self.polyp_hgd = np.array(polyp_hgd, dtype = bool)
+        self.polyp_dysplastic = np.array(polyp_dysplastic, dtype = bool)
+        self.polyp_incomplete = np.array(polyp_incomplete, dtype = bool)
+
+    def __len__(self):
+        return self.n_cases
+
+
+class Aggregates:
+    '''
+    The per-procedure values of rules.TriageFeatures, as arrays
+    '''
+
+    def __init__(self, c: SummaryColumns):
+        n = c.n
+        self.cecum_no = c.cecum_no
+        self.bbps_total, self.bbps_right, self.bbps_transverse, self.bbps_left = c.bbps.T
+        self.patient_age = c.age
+        self.total_polyps = c.total_polyps
+        self.has_polyps = c.has_polyps
+        self.is_sps = c.indication == 'sps'
+        self.is_ibd = c.indication == 'ibd'
+        self.is_family_history_discharge = np.isin(c.indication, list(rules.FAMILY_HISTORY_DISCHARGE))
+
+        def count(mask):
+            return np.bincount(c.polyp_case[mask], minlength = n)
+
+        def largest(mask):
+            out = np.zeros(n, dtype = np.int64)
+            np.maximum.at(out, c.polyp_case[mask], c.polyp_size[mask])
+            return out
+
+        adenoma = c.polyp_type == ADENOMA
+        ssl = c.polyp_type == SSL
+        hyperplastic = c.polyp_type == HYPERPLASTIC
+
+        self.n_adenoma = count(adenoma)
+        self.max_adenoma = largest(adenoma)
+        self.hgd_adenoma = count(adenoma & c.polyp_hgd) > 0
+        self.n_ssl = count(ssl)
+        self.max_ssl = largest(ssl)
+        self.dysplastic_ssl = count(ssl & c.polyp_dysplastic) > 0
+        self.max_hyperplastic = largest(hyperplastic)
+        self.tva = count(c.polyp_type == TVA) > 0
+        self.incomplete = count(c.polyp_incomplete) > 0
+
+
+#vectorized form of each condition in rules.RULE_TABLE - the priority order comes from the table itself
+VECTOR_RULES = {
+    'rule_1': lambda f: f.cecum_no,
+    'rule_2': lambda f: (f.bbps_total < 6) | (f.bbps_right < 2) | (f.bbps_transverse < 2) | (f.bbps_left < 2),
+    'rule_3': lambda f: f.is_sps,
+    'rule_4': lambda f: f.n_adenoma >= 10,
+    'rule_21': lambda f: f.incomplete,
+    'rule_22': lambda f: f.is_ibd,
+    'rule_5': lambda f: f.max_ssl >= 10,
+    'rule_6': lambda f: f.dysplastic_ssl,
+    'rule_7': lambda f: f.max_adenoma >= 10,
+    'rule_8': lambda f: f.tva,
+    'rule_9': lambda f: f.hgd_adenoma,
+    'rule_10': lambda f: (f.n_adenoma == 0) & (f.n_ssl >= 5) & (f.max_ssl < 10),
+    'rule_11': lambda f: (f.n_ssl == 0) & (f.n_adenoma >= 5) & (f.n_adenoma <= 9) & (f.max_adenoma < 10) & ~f.hgd_adenoma,
+    'rule_12': lambda f: (f.n_ssl > 0) & (f.n_adenoma > 0) & (f.total_polyps >= 5) & (f.total_polyps <= 9),
+    'rule_13': lambda f: f.max_hyperplastic >= 10,
+    'rule_14': lambda f: (f.n_ssl == 0) & (f.n_adenoma >= 3) & (f.n_adenoma <= 4) & (f.max_adenoma < 10) & ~f.hgd_adenoma,
+    'rule_15': lambda f: (f.n_ssl >= 1) & (f.n_ssl <= 4) & (f.max_ssl < 10) & (f.n_adenoma == 0),
+    'rule_16': lambda f: (f.n_ssl > 0) & (f.total_polyps <= 4) & (f.max_ssl < 10) & (f.max_adenoma < 10),
+    'rule_17': lambda f: (f.n_ssl == 0) & (f.n_adenoma > 0) & (f.n_adenoma < 3) & (f.max_adenoma < 10) & ~f.hgd_adenoma,
+    'rule_18': lambda f: (f.n_ssl == 0) & (f.n_adenoma == 0),
+    'rule_23': lambda f: ~f.has_polyps & f.is_family_history_discharge,
+}
+
+
+def evaluate(f: Aggregates, valid: np.ndarray) -> np.ndarray:
+    '''
+    Returns the rule code (index into RULE_IDS) for every procedure, before age out
+    '''
+    codes = np.full(len(valid), FALLBACK_CODE, dtype = np.int64)
+    unassigned = valid.copy()
+    for code, (rule, _, _) in enumerate(rules.RULE_TABLE):
+        hit = VECTOR_RULES[rule](f) & unassigned
+        codes[hit] = code
+        unassigned &= ~hit
+        if not unassigned.any():
+            break
+    codes[~valid] = INVALID_CODE
+    return codes
+
+
+def combine(c: SummaryColumns, codes: np.ndarray) -> np.ndarray:
+    '''
+    The rule code of every case from the codes of its procedures - rules.combine_history: the most recent dated
+    procedures and the undated ones are combined with a grouped minimum
+    '''
+    if c.n == c.n_cases:
+        case_codes = codes.copy()
+    else:
+        latest = np.full(c.n_cases, -1, dtype = np.int64)
+        np.maximum.at(latest, c.procedure_case, c.date)
+        superseded = (c.date != -1) & (c.date != latest[c.procedure_case])
+        #shortest follow up first (0 is human review), the earlier procedure on a tie
+        rank = np.where(superseded, np.iinfo(np.int64).max, FOLLOW_UPS[codes] * c.n + np.arange(c.n))
+        best = np.full(c.n_cases, np.iinfo(np.int64).max)
+        np.minimum.at(best, c.procedure_case, rank)
+        case_codes = codes[best % c.n]
+        case_codes[~c.case_valid] = INVALID_CODE
+    #as in functions.triage, a failed extraction goes to review before any rule is checked
+    case_codes[c.case_failed] = EXTRACTION_FAILED_CODE
+    return case_codes
+
+
+def apply_age_out(patient_age: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    valid = codes != INVALID_CODE
+    follow_up = np.where(valid, FOLLOW_UPS[codes], 0)
+    exempt = np.isin(codes, HIGH_RISK_CODES) & (patient_age <= rules.AGE_OUT_LIMIT)
+    aged_out = valid & ~exempt & (follow_up != 0) & (follow_up + patient_age > rules.AGE_OUT_LIMIT)
+    return np.where(aged_out, AGE_OUT_CODE, codes)
+
+
+class BulkResult:
+    def __init__(self, codes: np.ndarray):
+        self.codes = codes
+        self.valid = codes != INVALID_CODE
+        self.follow_up = np.where(self.valid, FOLLOW_UPS[codes], -1)
+        self.rule = np.array(RULE_IDS + [None], dtype = object)[codes]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def outcome(self, i: int) -> dict | None:
+        if not self.valid[i]:
+            return None
+        rule = self.rule[i]
+        return {'follow_up': int(self.follow_up[i]), 'rule': rule, 'reason': rules.rules_dict[rule]}
+
+    def outcomes(self) -> list:
+        return [self.outcome(i) for i in range(len(self))]
+
+    def counts(self) -> Counter:
+        return Counter('invalid' if rule is None else rule for rule in self.rule)
+
+
+def triage_with_age_out(summaries) -> BulkResult:
+    columns = summaries if isinstance(summaries, SummaryColumns) else SummaryColumns(summaries)
+    f = Aggregates(columns)
+    return BulkResult(apply_age_out(columns.case_age, combine(columns, evaluate(f, columns.valid))))
+
+
+def read_summaries(lines):
+    '''
+    Yields (line number, summary dict or None) from JSONL. Each line is either a ColonoscopySummary or an
+    audit log record from routes.recommend, in which case its json_summary is used
+    '''
+    for number, line in enumerate(lines, start = 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            if 'extra' in record and 'json_summary' in record['extra']:
+                record = record['extra']['json_summary']
+            yield number, ColonoscopySummary.model_validate(record).model_dump()
+        except (json.JSONDecodeError, ValidationError, TypeError):
+            yield number, None
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Re-triage stored colonoscopy summaries with the current rules')
+    parser.add_argument('input', help = 'JSONL file of summaries or audit log records')
+    parser.add_argument('-o', '--output', help = 'write one outcome per input line to this JSONL file')
+    args = parser.parse_args(argv)
+
+    with open(args.input, 'r', encoding = 'utf-8') as f:
+        parsed = list(read_summaries(f))
+    unreadable = sum(data is None for _, data in parsed)
+    result = triage_with_age_out([data for _, data in parsed if data is not None])
+
+    if args.output:
+        #rows are written in input order, readable summaries take their outcomes from result in turn
+        outcomes = iter(result.outcomes())
+        with open(args.output, 'w', encoding = 'utf-8') as out:
+            for number, data in parsed:
+                if data is None:
+                    row = {'line': number, 'error': 'not a valid ColonoscopySummary'}
+                else:
+                    outcome = next(outcomes)
+                    if outcome is None:
+                        row = {'line': number, 'error': 'summary is missing fields the rules need'}
+                    else:
+                        row = {'line': number, **outcome}
+                out.write(json.dumps(row) + '\n')
+
+    counts = result.counts()
+    print(f'{len(result)} summaries re-triaged, {unreadable} unreadable lines', file = sys.stderr)
+    for rule, n in sorted(counts.items(), key = lambda item: -item[1]):
+        print(f'{rule:>10}: {n}', file = sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+
+from app.models.colonoscopy import ColonoscopySummary
+
+logger = logging.getLogger(__name__)
+
+#the response schema is part of every key so a change to the pydantic model also invalidates old entries
+SCHEMA_FINGERPRINT = hashlib.sha256(
+    json.dumps(ColonoscopySummary.model_json_schema(), sort_keys = True).encode('utf-8')
+).hexdigest()
+
+
+def normalize_report_text(text: str) -> str:
+    '''
+    Collapses whitespace so that trivially reformatted submissions of the same report share a cache entry
+    '''
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+def prompt_fingerprint(prompt_version, system_prompt: str) -> str:
+    h = hashlib.sha256()
+    h.update(str(prompt_version).encode('utf-8'))
+    h.update(b'\x00')
+    h.update(system_prompt.encode('utf-8'))
+    h.update(b'\x00')
+    h.update(SCHEMA_FINGERPRINT.encode('ascii'))
+    return h.hexdigest()
+
+
+class ExtractionCache:
+    '''
+    Persistent, content-addressed cache of validated ColonoscopySummary dumps, backed by SQLite.
+    Entries expire after ttl_seconds and the least recently used entries are evicted beyond max_entries.
+    All methods are blocking - call them through asyncio.to_thread from async code
+    '''
+
+    def __init__(self, path: str, ttl_seconds: float = 7 * 24 * 3600, max_entries: int = 10_000, enabled: bool = True):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+        self._conn = None
+        self._lock = threading.Lock()
+        self._current_prompt = None
+
+    @classmethod
+    def from_env(cls):
+        #the cached extractions carry patient details, so the cache is off unless it is turned on with a path for it
+        path = os.getenv('EXTRACTION_CACHE_PATH', '')
+        enabled = os.getenv('EXTRACTION_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        if enabled and not path:
+            logger.warning('EXTRACTION_CACHE_ENABLED is set without EXTRACTION_CACHE_PATH, the extraction cache stays off')
+            enabled = False
+        return cls(
+            path = path,
+            ttl_seconds = float(os.getenv('EXTRACTION_CACHE_TTL_SECONDS', 7 * 24 * 3600)),
+            max_entries = int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', 10_000)),
+            enabled = enabled,
+        )
+
+    def _connect(self):
+        #opened lazily so importing the app never touches the disk
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread = False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                '''CREATE TABLE IF NOT EXISTS extraction_cache (
+                    key TEXT PRIMARY KEY,
+                    prompt TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )'''
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_extraction_cache_accessed ON extraction_cache (accessed)')
+            self._conn.commit()
+        return self._conn
+
+    def make_key(self, text: str, prompt_id: str, model: str) -> str:
+        h = hashlib.sha256()
+        for part in (normalize_report_text(text), prompt_id, model):
+            h.update(part.encode('utf-8'))
+            h.update(b'\x00')
+        return h.hexdigest()
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT value, created FROM extraction_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created = row
+            if now - created > self.ttl_seconds:
+                conn.execute('DELETE FROM extraction_cache WHERE key = ?', (key,))
+                conn.commit()
+                self.expired += 1
+                self.misses += 1
+                return None
+            conn.execute('UPDATE extraction_cache SET accessed = ? WHERE key = ?', (now, key))
+            conn.commit()
+            self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, value: dict, prompt_id: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            if prompt_id != self._current_prompt:
+                #the prompt or schema changed since the last write - entries made with any other prompt are dead weight
+                removed = conn.execute('DELETE FROM extraction_cache WHERE prompt != ?', (prompt_id,)).rowcount
+                if removed:
+                    logger.info(f'Extraction cache invalidated {removed} entries after a prompt change')
+                self._current_prompt = prompt_id
+            conn.execute(
+                'INSERT OR REPLACE INTO extraction_cache (key, prompt, value, created, accessed) VALUES (?, ?, ?, ?, ?)',
+                (key, prompt_id, json.dumps(value), now, now)
+            )
+            self._evict(conn, now)
+            conn.commit()
+
+    def _evict(self, conn, now: float):
+        expired = conn.execute('DELETE FROM extraction_cache WHERE created < ?', (now - self.ttl_seconds,)).rowcount
+        self.expired += max(expired, 0)
+        (count,) = conn.execute('SELECT COUNT(*) FROM extraction_cache').fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            conn.execute(
+                'DELETE FROM extraction_cache WHERE key IN (SELECT key FROM extraction_cache ORDER BY accessed ASC LIMIT ?)',
+                (excess,)
+            )
+            self.evictions += excess
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('DELETE FROM extraction_cache')
+            conn.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'expired': self.expired,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+extraction_cache = ExtractionCache.from_env()
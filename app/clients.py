@@ -1,9 +1,19 @@
 from openai import OpenAI, AzureOpenAI, AsyncAzureOpenAI
+import openai
 import os
+import json
+import time
+import random
+import asyncio
+import logging
 from dotenv import load_dotenv
 
+from app import metrics
+from app.preprocess import count_tokens
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
 
 
 chat_client = AsyncAzureOpenAI(
@@ -18,8 +28,290 @@ embedding_client = AsyncAzureOpenAI(
     azure_endpoint = os.getenv('AZURE_ENDPOINT'),
 )
 
+#retries are done by ResilientClient, which also paces requests to the quota, so the SDK's own retries are off
 hnz_client = AsyncAzureOpenAI(
     api_version = os.getenv('HNZ_API_VERSION'),
     api_key = os.getenv('HNZ_API_KEY'),
-    azure_endpoint = os.getenv('HNZ_ENDPOINT')
-)
\ No newline at end of file
+    azure_endpoint = os.getenv('HNZ_ENDPOINT'),
+    max_retries = 0,
+)
+
+
+def worker_count() -> int:
+    #gunicorn.conf.py exports its worker count here, uvicorn --workers reads the same variable
+    return max(1, int(os.getenv('WEB_CONCURRENCY', '1')))
+
+
+class RetryableError(Exception):
+    '''
+    The LLM call failed for a reason that should clear up on its own (rate limit, timeout, outage).
+    The report should be retried later, not triaged as a failed extraction
+    '''
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    '''
+    Refills at capacity per minute. reserve() always succeeds - the level may go negative - and returns how
+    long the caller has to wait for its share, so concurrent callers queue up in arrival order
+    '''
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, scale: float):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60 * scale)
+        self.updated = now
+
+    def reserve(self, amount: float, scale: float = 1.0) -> float:
+        self._refill(scale)
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level / (self.capacity / 60 * scale)
+
+    def refund(self, amount: float):
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    '''
+    Request and token buckets sized to the deployment's RPM/TPM quota (0 = no limit on that one).
+    The refill rate backs off by half on every 429 and recovers a little with each success, so the
+    limiter settles just under the quota the deployment actually gives us
+    '''
+    def __init__(self, rpm: float = 0, tpm: float = 0, max_wait: float = 30.0, min_scale: float = 0.1, recovery: float = 0.05):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.max_wait = max_wait
+        self.min_scale = min_scale
+        self.recovery = recovery
+        self.scale = 1.0
+
+    async def acquire(self, tokens: float):
+        reserved = []
+        wait = 0.0
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is not None:
+                wait = max(wait, bucket.reserve(amount, self.scale))
+                reserved.append((bucket, amount))
+        if wait > self.max_wait:
+            for bucket, amount in reserved:
+                bucket.refund(amount)
+            raise RetryableError(f'Rate limiter queue is {wait:.1f}s deep', retry_after = wait)
+        if wait:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                #the call never went out, so its share of the quota goes back to the callers queued behind it
+                for bucket, amount in reserved:
+                    bucket.refund(amount)
+                raise
+
+    def correct(self, estimated: float, actual: float):
+        #charge the tokens the response actually reported instead of the estimate
+        if self.tokens is not None:
+            self.tokens.level -= actual - estimated
+
+    def throttled(self):
+        self.scale = max(self.min_scale, self.scale * 0.5)
+
+    def succeeded(self):
+        self.scale = min(1.0, self.scale + self.recovery)
+
+
+class CircuitBreaker:
+    '''
+    Opens after failure_threshold consecutive failures and rejects calls for reset_timeout seconds,
+    then lets a single probe through - success closes it again, failure reopens it
+    '''
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def before_call(self) -> bool:
+        '''
+        Raises while the breaker is open, returns True when this call is the probe
+        '''
+        if self.opened_at is None:
+            return False
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if remaining > 0 or self.probing:
+            raise RetryableError('Circuit breaker is open', retry_after = max(remaining, 1.0))
+        self.probing = True
+        return True
+
+    def release_probe(self):
+        #the probe ended without an answer either way (limiter timeout, 429, cancelled) - the next call probes instead
+        self.probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                logger.warning(f'Circuit breaker opened after {self.failures} consecutive failures')
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+
+#429s are quota, not outages - they slow the limiter down but don't count towards the breaker
+TRANSIENT_ERRORS = (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError)
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    for header, unit in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        value = response.headers.get(header)
+        if value:
+            try:
+                return float(value) * unit
+            except ValueError:
+                pass
+    return None
+
+
+def estimate_tokens(messages) -> int:
+    if isinstance(messages, str):
+        return count_tokens(messages)
+    return sum(count_tokens(str(message.get('content', ''))) for message in messages or [])
+
+
+class ResilientResponses:
+    def __init__(self, owner):
+        self._owner = owner
+
+    async def parse(self, **kwargs):
+        return await self._owner.call('parse', **kwargs)
+
+    async def create(self, **kwargs):
+        return await self._owner.call('create', **kwargs)
+
+
+class ResilientClient:
+    '''
+    Wraps an AsyncAzureOpenAI client's responses API with quota pacing, retries with jittered backoff that
+    honor Retry-After, and a circuit breaker. When the retries run out a RetryableError is raised
+    '''
+    def __init__(self, client, name: str, limiter: RateLimiter | None = None, breaker: CircuitBreaker | None = None,
+                 max_retries: int = 4, backoff: float = 0.5, max_backoff: float = 20.0, expected_output_tokens: int = 600):
+        self.client = client
+        self.name = name
+        self.limiter = limiter or RateLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.expected_output_tokens = expected_output_tokens
+        self.responses = ResilientResponses(self)
+
+    @classmethod
+    def from_env(cls, client, name: str, rpm: float | None = None, tpm: float | None = None):
+        #the limits are the deployment's quota - every server worker paces itself, so each gets an equal share
+        workers = worker_count()
+        return cls(
+            client,
+            name,
+            limiter = RateLimiter(
+                rpm = (float(os.getenv('LLM_RPM_LIMIT', '0')) if rpm is None else rpm) / workers,
+                tpm = (float(os.getenv('LLM_TPM_LIMIT', '0')) if tpm is None else tpm) / workers,
+                max_wait = float(os.getenv('LLM_MAX_QUEUE_WAIT', '30')),
+            ),
+            breaker = CircuitBreaker(
+                failure_threshold = int(os.getenv('LLM_BREAKER_THRESHOLD', '5')),
+                reset_timeout = float(os.getenv('LLM_BREAKER_RESET', '30')),
+            ),
+            max_retries = int(os.getenv('LLM_RETRIES', '4')),
+            backoff = float(os.getenv('LLM_BACKOFF', '0.5')),
+            max_backoff = float(os.getenv('LLM_MAX_BACKOFF', '20')),
+            expected_output_tokens = int(os.getenv('LLM_EXPECTED_OUTPUT_TOKENS', '600')),
+        )
+
+    def _delay(self, error: Exception, attempt: int) -> float:
+        retry_after = retry_after_seconds(error)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def call(self, method: str, **kwargs):
+        estimated = estimate_tokens(kwargs.get('input')) + self.expected_output_tokens
+        for attempt in range(self.max_retries + 1):
+            probe = self.breaker.before_call()
+            try:
+                await self.limiter.acquire(estimated)
+                try:
+                    response = await getattr(self.client.responses, method)(**kwargs)
+                except (openai.RateLimitError, *TRANSIENT_ERRORS) as e:
+                    if isinstance(e, openai.RateLimitError):
+                        self.limiter.throttled()
+                        metrics.llm_throttled.inc(deployment = self.name)
+                    else:
+                        self.breaker.record_failure()
+                    delay = self._delay(e, attempt)
+                    if attempt == self.max_retries or self.breaker.is_open:
+                        raise RetryableError(f'{self.name}: {type(e).__name__} after {attempt + 1} attempt(s)', retry_after = delay) from e
+                    metrics.llm_retries.inc(deployment = self.name)
+                    logger.warning(f'{self.name}: {type(e).__name__}, retrying in {delay:.2f}s')
+                    await asyncio.sleep(delay)
+                    continue
+                except Exception:
+                    #the deployment answered (bad request, unparseable output) so it is up, but this is not retryable
+                    self.breaker.record_success()
+                    raise
+            finally:
+                #a probe that neither succeeded nor failed must not keep the breaker half-open forever
+                if probe:
+                    self.breaker.release_probe()
+
+            self.breaker.record_success()
+            self.limiter.succeeded()
+            usage = getattr(response, 'usage', None)
+            if usage is not None:
+                self.limiter.correct(estimated, (usage.input_tokens or 0) + (usage.output_tokens or 0))
+            return response
+
+    async def close(self):
+        await self.client.close()
+
+
+async def close_clients():
+    #closes the connection pools of the module level clients, the router closes the extraction deployments
+    for client in (chat_client, embedding_client, hnz_client):
+        await client.close()
+
+
+def extraction_deployments() -> list:
+    '''
+    (name, client, model) for every deployment that can serve extraction. By default this is just hnz_client and
+    DEPLOYMENT_NAME. LLM_DEPLOYMENTS adds more, as a JSON list of objects with name, endpoint, deployment,
+    api_version and api_key_env (the name of the env var holding the key), and optionally rpm and tpm quotas.
+    They should all host the same model. Every client is wrapped in a ResilientClient
+    '''
+    deployments = [('hnz', ResilientClient.from_env(hnz_client, 'hnz'), os.getenv('DEPLOYMENT_NAME'))]
+    for config in json.loads(os.getenv('LLM_DEPLOYMENTS', '[]')):
+        client = AsyncAzureOpenAI(
+            api_version = config.get('api_version', os.getenv('HNZ_API_VERSION')),
+            api_key = os.getenv(config['api_key_env']),
+            azure_endpoint = config['endpoint'],
+            max_retries = 0,
+        )
+        resilient = ResilientClient.from_env(client, config['name'], rpm = config.get('rpm'), tpm = config.get('tpm'))
+        deployments.append((config['name'], resilient, config['deployment']))
+    return deployments
@@ -0,0 +1,169 @@
+'''
+Bulk pseudonymization of identifiers and de-identification of audit logs.
+
+Pseudonymizer gives the same output as functions.pseudonymize - base32 of HMAC-SHA256(key, identifier),
+truncated - but keys the HMAC once and copies the keyed context per identifier, only encodes the digest
+bytes the truncated output needs, and can keep an LRU cache of repeated identifiers.
+
+    python -m app.deidentify audit.log                 -> rewrites audit.log in place
+    python -m app.deidentify audit.log -o clean.jsonl --drop-text
+'''
+import os
+import re
+import sys
+import hmac
+import json
+import base64
+import hashlib
+import shutil
+import argparse
+import tempfile
+from functools import lru_cache
+
+NHI_PATTERN = re.compile(r'\b[A-Z]{3}[0-9]{4}\b')
+#fields of an audit record's json_summary that identify the patient
+IDENTIFIER_FIELDS = ('patient_NHI', 'patient_name')
+
+
+def load_key() -> bytes:
+    key = os.getenv('HMAC_KEY')
+    if not key:
+        raise ValueError('HMAC_KEY is not set')
+    return base64.b64decode(key)
+
+
+class Pseudonymizer:
+    def __init__(self, key: bytes, length: int = 20, cache_size: int = 0):
+        self.length = length
+        self._keyed = hmac.new(key, digestmod = hashlib.sha256)
+        #base32 turns every 5 bytes into 8 characters, so only the first ceil(length / 8) groups are needed
+        self._n_bytes = min(32, -(-length // 8) * 5)
+        if cache_size:
+            self.pseudonymize = lru_cache(maxsize = cache_size)(self.pseudonymize)
+
+    def pseudonymize(self, identifier: str) -> str:
+        h = self._keyed.copy()
+        h.update(identifier.encode('utf-8'))
+        return base64.b32encode(h.digest()[:self._n_bytes]).decode('ascii')[:self.length]
+
+    def pseudonymize_many(self, identifiers):
+        '''
+        Lazily pseudonymizes an iterable of identifiers - None and empty values pass through unchanged
+        '''
+        pseudonymize = self.pseudonymize
+        for identifier in identifiers:
+            yield pseudonymize(identifier) if identifier else identifier
+
+    def pseudonymize_column(self, identifiers) -> list:
+        '''
+        Pseudonymizes a column of identifiers, hashing each distinct value once
+        '''
+        seen = {}
+        pseudonymize = self.pseudonymize
+        out = []
+        for identifier in identifiers:
+            if not identifier:
+                out.append(identifier)
+                continue
+            value = seen.get(identifier)
+            if value is None:
+                value = seen[identifier] = pseudonymize(identifier)
+            out.append(value)
+        return out
+
+    def cache_info(self):
+        return getattr(self.pseudonymize, 'cache_info', lambda: None)()
+
+
+def deidentify_record(record: dict, pseudonymizer: Pseudonymizer, drop_text: bool = False) -> dict:
+    '''
+    Replaces the patient identifiers of one audit log record in place. In the free text report, NHIs and the
+    extracted patient name are replaced by their pseudonyms - or the text is dropped with drop_text
+    '''
+    extra = record.get('extra')
+    if not isinstance(extra, dict):
+        return record
+    summary = extra.get('json_summary')
+    names = []
+    if isinstance(summary, dict):
+        for field in IDENTIFIER_FIELDS:
+            value = summary.get(field)
+            if isinstance(value, str) and value:
+                summary[field] = pseudonymizer.pseudonymize(value)
+                if field == 'patient_name':
+                    names.append((value, summary[field]))
+    text = extra.get('user_input')
+    if isinstance(text, str):
+        if drop_text:
+            extra.pop('user_input')
+        else:
+            text = NHI_PATTERN.sub(lambda m: pseudonymizer.pseudonymize(m.group(0)), text)
+            for name, pseudonym in names:
+                #whole words only - a short name like 'Al' must not be replaced inside 'also'
+                text = re.sub(rf'(?<!\w){re.escape(name)}(?!\w)', lambda m: pseudonym, text, flags = re.IGNORECASE)
+            extra['user_input'] = text
+    return record
+
+
+def deidentify_lines(lines, pseudonymizer: Pseudonymizer, drop_text: bool = False):
+    '''
+    Yields de-identified JSONL lines. Lines that are not JSON objects are passed through unchanged
+    '''
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            yield line
+            continue
+        if not isinstance(record, dict):
+            yield line
+            continue
+        yield json.dumps(deidentify_record(record, pseudonymizer, drop_text), separators = (',', ':')) + '\n'
+
+
+def deidentify_file(source: str, output: str | None = None, pseudonymizer: Pseudonymizer | None = None,
+                    drop_text: bool = False) -> int:
+    '''
+    De-identifies a JSONL audit log line by line, so memory use does not grow with the file. Without output the
+    file is rewritten in place - through a temporary file in the same directory that replaces it at the end
+    '''
+    pseudonymizer = pseudonymizer or Pseudonymizer(load_key(), cache_size = 100_000)
+    target = output or source
+    directory = os.path.dirname(os.path.abspath(target))
+    n = 0
+    with open(source, 'r', encoding = 'utf-8') as f, \
+         tempfile.NamedTemporaryFile('w', encoding = 'utf-8', dir = directory, delete = False, suffix = '.tmp') as out:
+        try:
+            for line in deidentify_lines(f, pseudonymizer, drop_text):
+                out.write(line)
+                n += 1
+        except BaseException:
+            out.close()
+            os.unlink(out.name)
+            raise
+    if output is None:
+        shutil.copymode(source, out.name)
+    os.replace(out.name, target)
+    return n
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Pseudonymize the patient identifiers in a JSONL audit log')
+    parser.add_argument('input', help = 'JSONL audit log, rewritten in place unless --output is given')
+    parser.add_argument('-o', '--output', help = 'write the de-identified log here instead')
+    parser.add_argument('--drop-text', action = 'store_true', help = 'remove the free text report instead of pseudonymizing NHIs and names in it')
+    parser.add_argument('--length', type = int, default = 20, help = 'characters of each pseudonym')
+    parser.add_argument('--cache-size', type = int, default = 100_000, help = 'identifiers kept in the LRU cache (0 = no cache)')
+    args = parser.parse_args(argv)
+
+    pseudonymizer = Pseudonymizer(load_key(), length = args.length, cache_size = args.cache_size)
+    n = deidentify_file(args.input, args.output, pseudonymizer, args.drop_text)
+    print(f'De-identified {n} lines into {args.output or args.input}')
+    info = pseudonymizer.cache_info()
+    if info is not None:
+        print(f'Identifier cache: {info.hits} hits, {info.misses} misses')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+'''
+Rule-based extraction for the simplest reports - a single colonoscopy with no polyps, cecum reached and a full
+Boston Bowel Prep Score. Returns a ColonoscopySummary only when every field the triage rules need is found
+exactly once and nothing in the text suggests a finding, an incomplete procedure or a high risk indication.
+Anything else returns None and goes to the LLM
+'''
+import os
+import re
+import logging
+from datetime import datetime
+
+from app.models.colonoscopy import BostonBowelPrepScore, Colonoscopy, ColonoscopySummary
+
+logger = logging.getLogger(__name__)
+
+#off until client_scripts/validate_fast_extract.py has been run against real reports and HUMAN_LABELS
+FAST_EXTRACT_ENABLED = os.getenv('FAST_EXTRACT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+
+_flags = re.IGNORECASE
+
+AGE_PATTERNS = [
+    re.compile(r'\bage[d:]?\s*[:=]?\s*(\d{1,3})\b', _flags),
+    re.compile(r'\b(\d{1,3})[\s-]*(?:years?|yrs?)[\s-]*old\b', _flags),
+    re.compile(r'\b(\d{1,3})\s*(?:yo|y/o|yr old)\b', _flags),
+]
+
+#BBPS 9 (3/3/3), BBPS: 3,2,3 total 8, Boston Bowel Prep Score 3+3+3=9
+BBPS_LABEL = r'(?:bbps|boston bowel prep(?:aration)? score)'
+BBPS_SUBSCORES = re.compile(BBPS_LABEL + r'[^\n\d]{0,40}?(?:(\d)\s*(?:/\s*9)?\s*[(\[]?\s*)?([0-3])\s*[/,+-]\s*([0-3])\s*[/,+-]\s*([0-3])(?:\s*[)\]])?(?:\s*(?:=|total:?)\s*(\d))?', _flags)
+BBPS_NAMED = re.compile(r'right\s*[:=]?\s*([0-3])\D{1,20}?transverse\s*[:=]?\s*([0-3])\D{1,20}?left\s*[:=]?\s*([0-3])', _flags)
+BBPS_TOTAL = re.compile(BBPS_LABEL + r'\s*(?:total)?\s*[:=]?\s*(\d)\b(?!\s*[/,+-]\s*[0-3])', _flags)
+
+NEGATION = r'\b(?:not|unable|failed|cannot)\b|n\'t\b'
+#no negation allowed between the landmark and the verb - 'the caecum was not visualised'
+CECUM_REACHED = re.compile(r'\b(?:c(?:a)?ecum|c(?:a)?ecal pole|terminal ileum)\b(?:(?!' + NEGATION + r')[^.\n]){0,30}?\b(?:reached|intubated|visuali[sz]ed|identified)\b'
+                           r'|\b(?:reached|intubated to|intubation of) the (?:c(?:a)?ecum|terminal ileum)\b'
+                           r'|\bc(?:a)?ecal intubation\b', _flags)
+NO_POLYPS = re.compile(r'\bno (?:colonic |colorectal )?polyps?\b(?: (?:were |was )?(?:seen|found|identified|detected|noted))?'
+                       r'|\b0 polyps\b|\bpolyps?\s*[:=]\s*(?:none|0|nil)\b', _flags)
+
+#any of these means the report needs the full extraction
+DISQUALIFYING = re.compile(
+    NEGATION + r'|\b(?:not reached|unable to (?:reach|intubate)|incomplete|abandoned|poor(?:ly)? prep|inadequate'
+    r'|adenoma|adenomatous|serrated|ssl|ssp|hyperplastic|polypectomy|snare|resect\w*|lesion|mass|tumou?r|cancer|carcinoma'
+    r'|biops(?:y|ies)|histolog\w*|dysplasia|piecemeal|emr|clip'
+    r'|ibd|colitis|crohn\w*|polyposis|lynch|family history|previous colonoscopy|prior colonoscopy)\b', _flags)
+
+#indication keywords, first match wins - only the indications that don't change a no-polyp outcome
+INDICATIONS = [
+    ('positive_faecal_immunochemical_test', re.compile(r'\b(?:positive|\+ve) (?:fit|faecal immunochemical|fecal immunochemical)|\bfit positive\b', _flags)),
+    ('surveillance_for_previous_polyps', re.compile(r'\bsurveillance\b', _flags)),
+    ('screening', re.compile(r'\bscreening\b', _flags)),
+    ('anaemia', re.compile(r'\ban(?:a)?emi(?:a|c)\b|\biron deficiency\b', _flags)),
+    ('rectal_bleeding', re.compile(r'\b(?:rectal bleeding|pr bleeding|haematochezia|hematochezia)\b', _flags)),
+    ('change_in_bowel_habit', re.compile(r'\bchange in bowel habit', _flags)),
+    ('abdominal_pain', re.compile(r'\babdominal pain\b', _flags)),
+    ('weight_loss', re.compile(r'\bweight loss\b', _flags)),
+]
+
+DATE_PATTERNS = [
+    (re.compile(r'\b(\d{4})-(\d{1,2})-(\d{1,2})\b'), '%Y-%m-%d'),
+    (re.compile(r'\b(\d{1,2})/(\d{1,2})/(\d{4})\b'), '%d/%m/%Y'),
+]
+
+
+def _single(values: set):
+    return next(iter(values)) if len(values) == 1 else None
+
+
+class FastExtractor:
+    def __init__(self, nhi_pattern: re.Pattern, enabled: bool = True):
+        self.nhi_pattern = nhi_pattern
+        self.enabled = enabled
+        self.attempts = 0
+        self.hits = 0
+
+    @classmethod
+    def from_env(cls, nhi_pattern: re.Pattern):
+        return cls(nhi_pattern, enabled = FAST_EXTRACT_ENABLED)
+
+    def _age(self, text: str) -> int | None:
+        ages = {int(m.group(1)) for pattern in AGE_PATTERNS for m in pattern.finditer(text)}
+        age = _single(ages)
+        return age if age is not None and 18 <= age <= 110 else None
+
+    def _bbps(self, text: str) -> BostonBowelPrepScore | None:
+        candidates = set()
+        for m in BBPS_SUBSCORES.finditer(text):
+            leading, right, transverse, left, trailing = m.groups()
+            subscores = (int(right), int(transverse), int(left))
+            for total in (leading, trailing):
+                if total is not None and int(total) != sum(subscores):
+                    return None
+            candidates.add(subscores)
+        for m in BBPS_NAMED.finditer(text):
+            candidates.add(tuple(int(v) for v in m.groups()))
+        for m in BBPS_TOTAL.finditer(text):
+            #a total of 9 can only be 3/3/3, any other total alone leaves the segments unknown
+            if int(m.group(1)) == 9:
+                candidates.add((3, 3, 3))
+            elif not candidates:
+                return None
+        subscores = _single(candidates)
+        if subscores is None:
+            return None
+        right, transverse, left = subscores
+        return BostonBowelPrepScore(total = right + transverse + left, right = right, transverse = transverse, left = left)
+
+    def _date(self, text: str) -> str | None:
+        dates = set()
+        for pattern, fmt in DATE_PATTERNS:
+            for m in pattern.finditer(text):
+                try:
+                    dates.add(datetime.strptime(m.group(0), fmt).strftime('%Y-%m-%d'))
+                except ValueError:
+                    pass
+        return _single(dates)
+
+    def _indication(self, text: str) -> str:
+        for indication, pattern in INDICATIONS:
+            if pattern.search(text):
+                return indication
+        return 'unknown'
+
+    def extract(self, text: str) -> ColonoscopySummary | None:
+        '''
+        A complete summary for a simple no-polyp report, otherwise None
+        '''
+        if not self.enabled:
+            return None
+        self.attempts += 1
+        if DISQUALIFYING.search(text) or not NO_POLYPS.search(text) or not CECUM_REACHED.search(text):
+            return None
+        #every mention of a polyp has to be part of a 'no polyps' phrase
+        if len(re.findall(r'\bpolyps?\b', text, _flags)) != len(NO_POLYPS.findall(text)):
+            return None
+        age = self._age(text)
+        bbps = self._bbps(text)
+        if age is None or bbps is None:
+            return None
+
+        nhi = _single(set(self.nhi_pattern.findall(text)))
+        self.hits += 1
+        return ColonoscopySummary(
+            patient_NHI = nhi,
+            patient_age = age,
+            indication = self._indication(text),
+            colonoscopy = [Colonoscopy(
+                date = self._date(text),
+                number_of_polyps = 0,
+                cecum_reached = True,
+                bostonBowelPrepScore = bbps,
+                polyps = [],
+            )],
+        )
+
+    def stats(self) -> dict:
+        return {
+            'attempts': self.attempts,
+            'hits': self.hits,
+            'hit_rate': self.hits / self.attempts if self.attempts else 0.0,
+        }
@@ -17,9 +17,8 @@ import base64
 import random
 
 
-from transformers import pipeline
-import torch
 import re
+import threading
 
 
 import logging
@@ -27,13 +26,23 @@ logger = logging.getLogger(__name__)
 from logging.handlers import RotatingFileHandler
 from datetime import datetime
 
-from app.clients import chat_client, hnz_client
-from app.models.colonoscopy import ColonoscopySummary
+from app.clients import chat_client, hnz_client, RetryableError
+from app.models.colonoscopy import Colonoscopy, ColonoscopySummary
+from app.cache import extraction_cache, prompt_fingerprint
+from app.prompt_registry import prompt_registry, PROMPT_PATH
+from app import rules
+from app.rules import rules_dict
+from app.llm_router import extraction_router
+from app import metrics
+from app.preprocess import preprocessor
+from app.fast_extract import FastExtractor
+from app.near_duplicate import NearDuplicateIndex
+from app.deidentify import NHI_PATTERN, Pseudonymizer
+from app.repair import parse_output, text_format
 
 load_dotenv()
 
 BASE_PATH = Path(__file__).parent.parent
-PROMPT_PATH = BASE_PATH / 'app' / 'prompts'
 DATA_PATH = BASE_PATH / 'data' / 'sample_reports'
 KEY = base64.b64decode(os.getenv('HMAC_KEY'))
 
@@ -43,43 +52,69 @@ if not deployment or deployment.strip() == '':
 
 
 
-def load_prompt(prompt_file:str) -> str:
-    prompt_path = PROMPT_PATH / prompt_file
-    if not prompt_path.exists():
-        raise FileNotFoundError(f"Prompt file not found: {prompt_path}")
-    
-    with open(prompt_path, 'r') as f:
-        try:
-            config = yaml.safe_load(f)
-        except yaml.YAMLError as e:
-            print(f"Error loading YAML file: {e}")
-        system_prompt = f"{config['prompt']['content']}"
-        rules = config['prompt'].get('rules')
-        if rules:
-            rules_text = "\n Rules: \n" + "\n".join(f'- {rule}' for rule in rules)
-            system_prompt = f'{system_prompt}\n{rules_text}'
-        return system_prompt
+JSON_SUMMARY_PROMPT = 'json_summary_prompt.yaml'
+#the strict json_schema format responses.parse would send for ColonoscopySummary
+SUMMARY_FORMAT = text_format(ColonoscopySummary)
 
 
-
-async def format_query_json(user_query: str) -> dict: 
-    PROMPT_FILE = PROMPT_PATH/'json_summary_prompt.yaml'
-    with open(PROMPT_FILE, 'r', encoding = 'utf-8') as f:
+def load_prompt(prompt_file:str) -> str:
+    return prompt_registry.get(prompt_file).system_prompt
+
+
+
+def prepare_report(user_query: str) -> str:
+    #strips boilerplate and normalizes whitespace before the report is sent or used as a cache key
+    prepared = preprocessor.prepare(user_query)
+    if preprocessor.enabled:
+        metrics.report_tokens.inc(prepared.tokens_before, stage = 'raw')
+        metrics.report_tokens.inc(prepared.tokens_after, stage = 'sent')
+        for name, n in prepared.removed.items():
+            metrics.boilerplate_removed.inc(n, pattern = name)
+        if prepared.tokens_saved:
+            logger.info(f'Preprocessing saved {prepared.tokens_saved} of {prepared.tokens_before} report tokens')
+    return prepared.text
+
+
+async def format_query_json(user_query: str) -> ColonoscopySummary:
+    prompt = prompt_registry.get(JSON_SUMMARY_PROMPT)
+    system_prompt = prompt.system_prompt
+    user_query = prepare_report(user_query)
+
+    #simple no-polyp reports are filled in by regex, everything else goes on to the cache and the LLM
+    fast = fast_extractor.extract(user_query)
+    if fast is not None:
+        metrics.extraction_path.inc(path = 'fast')
+        return fast
+
+    cache_key = None
+    prompt_id = prompt_fingerprint(prompt.version, system_prompt)
+    #near-duplicate matches are only reused for the same prompt and deployment, like cache entries
+    extraction_id = f'{prompt_id}:{deployment}'
+    if extraction_cache.enabled:
+        cache_key = extraction_cache.make_key(user_query, prompt_id, deployment)
         try:
-            config = yaml.safe_load(f)
-        except yaml.YAMLError as e:
-            raise Exception(f'Error loading YAML prompt file: {e}')
-        system_prompt = f"{config['prompt']['content']}"
-        if 'rules' in config:
-            rules_text = '\nRules:\n' + '\n'.join(f'- {rule}' for rule in config['rules'])
-            system_prompt = f'{system_prompt}\n{rules_text}'
-        
-        
-
+            cached = await asyncio.to_thread(extraction_cache.get, cache_key)
+        except Exception as e:
+            logger.error(f'Extraction cache lookup failed: {e}')
+            cached = None
+        if cached is not None:
+            metrics.extraction_path.inc(path = 'cache')
+            return ColonoscopySummary.model_validate(cached)
+
+    #a lightly edited resubmission misses the exact cache but can still reuse the earlier extraction
+    embedding = await near_duplicates.embed(user_query)
+    match = near_duplicates.find(embedding, user_query, extraction_id)
+    if match is not None:
+        metrics.extraction_path.inc(path = 'near_duplicate')
+        logger.info(f'Reusing the extraction of a near-duplicate report (similarity {match.similarity:.3f})')
+        return ColonoscopySummary.model_validate(match.result)
+
+    metrics.extraction_path.inc(path = 'llm')
     user_prompt = f'Please format this medical text into structured JSON output - {user_query}'
-    try:
-        response1 = await hnz_client.responses.parse(
-            model = deployment,
+
+    async def extract(client, model):
+        response = await client.responses.create(
+            model = model,
             
             input = [
                 {
@@ -91,20 +126,43 @@ async def format_query_json(user_query: str) -> dict:
                     'content': user_prompt,
                 }
             ],
-            text_format = ColonoscopySummary
+            text = {'format': SUMMARY_FORMAT}
             
 
         )
+        #validated here rather than by responses.parse so output that misses the schema can be repaired locally
+        result = parse_output(response.output_text)
+        metrics.record_structured_output(result, getattr(response, 'usage', None))
+        if result.repaired:
+            logger.info(f'Repaired structured output locally: {", ".join(result.repairs)}')
+        elif result.summary is None:
+            logger.warning(f'Structured output could not be repaired: {result.error}')
+        return response, result
 
-        if response1.output_parsed is None:
-            return empty_summary()
-
-        output = response1.output_parsed.model_dump()
-        return output
+    try:
+        #only output that local repair can't fix is sent again, to another deployment
+        response1, result = await extraction_router.request(extract, is_valid = lambda r: r[1].summary is not None)
+        metrics.record_token_usage(getattr(response1, 'usage', None))
+
+        output = result.summary
+    except RetryableError as e:
+        #rate limits and outages are not failed extractions - the caller should retry the report later
+        logger.error(f'Extraction unavailable, retryable: {e}')
+        metrics.extraction_failures.inc(reason = 'retryable')
+        raise
     except Exception as e:
         logger.error(e)
+        metrics.extraction_failures.inc(reason = type(e).__name__)
         return empty_summary()
 
+    near_duplicates.add(embedding, user_query, extraction_id, output.model_dump())
+    if cache_key is not None:
+        try:
+            await asyncio.to_thread(extraction_cache.set, cache_key, output.model_dump(), prompt_id)
+        except Exception as e:
+            logger.error(f'Extraction cache write failed: {e}')
+    return output
+
     # try:
     #     raw_output = response1.output_text
     #     result_json = json.loads(raw_output)
@@ -132,191 +190,91 @@ async def send_request(report_text: str, api_url: str):
 #keyed hashing function for deidentification
 
 def pseudonymize(identifier: str, key: bytes = KEY, length: int = 20) -> str:
+    #the default key reuses a keyed HMAC context, see app.deidentify for bulk use
+    if key is KEY and length == 20:
+        return _pseudonymizer.pseudonymize(identifier)
+    return Pseudonymizer(key, length).pseudonymize(identifier)
 
-    h = hmac.new(key, identifier.encode('utf-8'), hashlib.sha256).digest() 
-    return base64.b32encode(h).decode('ascii')[:length] #takes h which is bytes and encodes to base32 then decodes to ascii 
+_pseudonymizer = Pseudonymizer(KEY, cache_size = int(os.getenv('PSEUDONYM_CACHE_SIZE', '10000')))
 
 #trying an on device model to redact PII
-ner = pipeline("ner", model = "OpenMed/OpenMed-PII-BioClinicalModern-Base-149M-v1", aggregation_strategy="simple")
+#the model and its transformers/torch imports are only loaded when redaction is actually used
+PII_REDACTION_ENABLED = os.getenv('PII_REDACTION_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+NER_MODEL = os.getenv('PII_NER_MODEL', 'OpenMed/OpenMed-PII-BioClinicalModern-Base-149M-v1')
+
+_ner = None
+_ner_lock = threading.Lock()
+
+def get_ner():
+    global _ner
+    if _ner is None:
+        with _ner_lock:
+            if _ner is None:
+                from transformers import pipeline
+                _ner = pipeline("ner", model = NER_MODEL, aggregation_strategy="simple")
+    return _ner
+
+nhi_pattern = NHI_PATTERN
+fast_extractor = FastExtractor.from_env(nhi_pattern)
+near_duplicates = NearDuplicateIndex.from_env(nhi_pattern)
+
+def apply_redactions(text: str, entities: list) -> str:
+    '''
+    Rebuilds text in a single pass, replacing NER entities with their label and NHIs with [NHI].
+    Offsets always refer to the original text; where spans overlap the earliest (then longest) wins
+    '''
+    spans = [(entity['start'], entity['end'], f"{entity['entity_group']}") for entity in entities]
+    spans.extend((m.start(), m.end(), '[NHI]') for m in nhi_pattern.finditer(text))
+    spans.sort(key = lambda span: (span[0], -span[1]))
+
+    parts = []
+    cursor = 0
+    for start, end, label in spans:
+        if start < cursor:
+            continue
+        parts.append(text[cursor:start])
+        parts.append(label)
+        cursor = end
+    parts.append(text[cursor:])
+    return ''.join(parts)
 
 def redact_pii(user_query: str) -> str:
-    entities = ner(user_query)
-
-    sorted_entities = sorted(entities, key = lambda x: x['start'], reverse = True)
-
-    redacted = user_query
-    nhi_pattern = r'\b[A-Z]{3}[0-9]{4}\b'
-    redacted = re.sub(nhi_pattern, '[NHI]', redacted)
-
-    for entity in sorted_entities:
-        redacted = redacted[:entity['start']] + f"{entity['group']}" + redacted[entity['end']:]
-    return redacted
+    entities = get_ner()(user_query)
+    return apply_redactions(user_query, entities)
 
 def empty_summary():
     return ColonoscopySummary(
         extraction_successful = False
     )
 
+def as_summary(data: ColonoscopySummary | dict) -> ColonoscopySummary:
+    #the pipeline passes ColonoscopySummary through, dicts (stored summaries, older callers) are validated once here
+    if isinstance(data, ColonoscopySummary):
+        return data
+    return ColonoscopySummary.model_validate(data)
 
-rules_dict = {
-    'rule_1': 'Cecum not reached',
-    'rule_2': 'Inadequate prep',
-    'rule_3': 'Serrated polyposis syndrome',
-    'rule_4': 'Greater than 10 adenomatous polyps',
-    'rule_5': 'SSL >= 10mm',
-    'rule_6': 'SSL with dysplasia',
-    'rule_7': 'Adenoma >= 10mm',
-    'rule_8': 'Tubulovillous or villous adenoma',
-    'rule_9': 'Adenoma with HGD',
-    'rule_10': '5 or more SSL all less than 10mm, no other polyps, no high risk features',
-    'rule_11': '5-9 adenomas with no high risk features and no SSL',
-    'rule_12': '5-9 combined adenomas and SSL',
-    'rule_13': 'Hyperplastic polyp >= 10mm',
-    'rule_14': '3-4 adenomas, no SSL, no high risk features',
-    'rule_15': '1-4 SSL < 10mm no dysplasia no other polyps',
-    'rule_16': 'Adenoma and SSL present, less than 5 total polyps, no high risk features',
-    'rule_17': '1-2 adenomas less than 10mm no hgd',
-    'rule_18': 'No polyps',
-    'rule_19': 'No criteria met, needs human review',
-    'rule_20': 'Patient aged out',
-    'rule_21': 'Incomplete/piecemeal resection or incomplete retrieval',
-    'rule_22': 'IBD',
-    'rule_23': 'Discharged due to no polyps and family history category 1 or 2'
-}
 
 
 
-#need to fix this by adding handling of empty inputs and other edge cases similar to that
 
-def triage(data: dict):
-    n_adenoma = 0
-    max_adenoma = 0
-    hgd_adenoma = False
-    n_ssl = 0
-    max_ssl = 0
-    dysplastic_ssl = False
-    n_hyperplastic = 0
-    max_hyperplastic = 0
-    
-    tva = False
-    incomplete_resection = False
-    incomplete_retrieval = False
-    
-    follow_up = None
-    patient_age = data['patient_age']
-    indication = data.get('indication', '')
-    total_polyps = data['colonoscopy'][0]['number_of_polyps']
-    cecum = data['colonoscopy'][0]['cecum_reached']
-    bbps = data['colonoscopy'][0]['bostonBowelPrepScore']
-    if data['colonoscopy'][0]['polyps']:
-        polyps = data['colonoscopy'][0]['polyps']
-        for polyp in polyps:
-            if polyp['type'] == 'adenoma':
-                n_adenoma += 1
-                max_adenoma = max(max_adenoma, polyp['size'])
-                if polyp['dysplasia'] == 'high_grade':
-                    hgd_adenoma = True
-            elif polyp['type'] == 'sessile_serrated_polyp':
-                n_ssl += 1
-                max_ssl = max(max_ssl, polyp['size'])
-                if polyp['dysplasia'] in ['low_grade', 'high_grade']:
-                    dysplastic_ssl = True
-            elif polyp['type'] == 'hyperplastic_polyp':
-                n_hyperplastic += 1
-                max_hyperplastic = max(max_hyperplastic, polyp['size'])
-            elif polyp['type'] == 'tubulovillous_or_villous_adenoma':
-                tva = True        
-            if polyp['resection'] != 'complete':
-                incomplete_resection = True
-            if polyp['retrieval'] != 'complete':
-                incomplete_retrieval = True
-
-    #need human review - these all have a return statement so that no other criteria are triggered further down the line
-    #for now, have follow up value of 0 represent needing human review
-    if cecum == 'no':
-        return {'follow_up': 0, 'rule': 'rule_1', 'reason': 'Cecum not reached'}
-    elif bbps['total'] < 6 or bbps['right'] < 2 or bbps['transverse'] < 2 or bbps['left'] < 2:
-        return {'follow_up': 0, 'rule': 'rule_2', 'reason':'Inadequate prep'}
-    elif indication == 'sps': 
-        return {'follow_up': 0, 'rule': 'rule_3', 'reason': 'Serrated polyposis syndrome'}
-    #this seems like something a human should look at
-    elif n_adenoma >= 10:
-        return {'follow_up': 0, 'rule': 'rule_4', 'reason': 'Greater than 10 adenomatous polyps'}
-    #incomplete resection or retrieval
-    elif incomplete_resection == True or incomplete_retrieval == True:
-        return {'follow_up': 0, 'rule': 'rule_21', 'reason': 'Incomplete/piecemeal resection or incomplete retrieval'}
-    elif indication == 'ibd':
-        return {'follow_up': 0, 'rule': 'rule_22', 'reason': 'IBD'}
- 
-    #3 years
-    ###These are high risk polyps - triaging rules vary somewhat for these regarding the age out criteria
-    elif max_ssl >=10:
-        return {'follow_up': 3, 'rule': 'rule_5', 'reason': 'SSL >= 10mm'}
-    
-    elif dysplastic_ssl == True:
-        return {'follow_up': 3, 'rule': 'rule_6', 'reason': 'SSL with dysplasia'}
-    
-    elif max_adenoma >= 10:
-        return {'follow_up': 3, 'rule': 'rule_7', 'reason': 'Adenoma >= 10mm'}
-    elif tva == True:
-        return {'follow_up': 3, 'rule': 'rule_8', 'reason': 'Tubulovillous or villous adenoma'}
-    elif hgd_adenoma == True:
-        return {'follow_up': 3, 'rule': 'rule_9', 'reason': 'Adenoma with HGD'}
-    
-    ###These are other indications for 3 year follow up
-    elif n_adenoma == 0 and n_ssl >= 5 and max_ssl < 10:
-        return {'follow_up': 3, 'rule': 'rule_10', 'reason': '5 or more SSL all less than 10mm, no other polyps, no high risk features'}
-    elif n_ssl == 0 and 5 <= n_adenoma <= 9 and max_adenoma < 10 and hgd_adenoma == False:
-        return {'follow_up': 3, 'rule': 'rule_11', 'reason': '5-9 adenomas with no high risk features and no SSL'}
-    elif n_ssl > 0 and n_adenoma > 0 and 5 <= total_polyps <= 9:
-        return {'follow_up': 3, 'rule': 'rule_12', 'reason': '5-9 combined adenomas and SSL'}
-    elif max_hyperplastic >= 10:
-        return {'follow_up': 3, 'rule': 'rule_13', 'reason': 'Hyperplastic polyp >= 10mm'}
-    
-
-
-    #5 years
-    elif n_ssl == 0 and 3 <= n_adenoma <= 4 and max_adenoma < 10 and hgd_adenoma == False:
-        return {'follow_up': 5, 'rule': 'rule_14', 'reason': '3-4 adenomas, no SSL, no high risk features'}
-    
-    elif 1 <= n_ssl <= 4 and max_ssl < 10 and n_adenoma == 0:
-        return {'follow_up': 5, 'rule': 'rule_15', 'reason': '1-4 SSL < 10mm no dysplasia no other polyps'}
-    
-    elif n_ssl > 0 and total_polyps <= 4 and max_ssl < 10 and max_adenoma < 10:
-        return {'follow_up': 5, 'rule': 'rule_16', 'reason': 'Adenoma and SSL present, less than 5 total polyps, no high risk features'}
-    
+#need to fix this by adding handling of empty inputs and other edge cases similar to that
 
-    #10 years
+def triage(data: ColonoscopySummary | dict):
+    data = as_summary(data)
+    #nothing usable came back from the LLM, so there is nothing to triage
+    if not data.extraction_successful or not data.colonoscopy:
+        return rules.extraction_failed_outcome()
+    #every procedure in the report is triaged, the most recent one decides (rules.combine_history)
+    return rules.combine_history([(colonoscopy.date, triage_colonoscopy(data, colonoscopy)) for colonoscopy in data.colonoscopy])[0]
 
-    elif n_ssl == 0 and 0 < n_adenoma < 3 and max_adenoma < 10 and hgd_adenoma == False:
-        return {'follow_up': 10, 'rule': 'rule_17', 'reason': '1-2 adenomas less than 10mm no hgd'}
-    elif n_ssl == 0 and n_adenoma == 0:
-        return {'follow_up': 10, 'rule': 'rule_18', 'reason': 'No polyps'}
-    
-    ###Add discharge criteria here?
 
-    #if no polyps and family history category 1 or 2
-    if not data['colonoscopy'][0]['polyps'] and indication in ['family_history_category_1', 'family_history_category_2']:
-        return {'follow_up': 20, 'rule': 'rule_23', 'reason': 'Discharged due to no polyps and family history category 1 or 2'}
-    
+def triage_colonoscopy(data: ColonoscopySummary, colonoscopy: Colonoscopy):
+    #the rules themselves live in app/rules.py RULE_TABLE
+    return rules.evaluate(rules.procedure_features(data.patient_age, data.indication, colonoscopy))
 
-    
-    #if no criteria met, refer for human review
-    else:
-        return {'follow_up': 0, 'rule': 'rule_19', 'reason': 'No criteria met, needs human review'}
-
-def age_out(data: dict, outcome: dict):
+def age_out(data: ColonoscopySummary | dict, outcome: dict):
     #see if the patient will age out
-    patient_age = data['patient_age']
-    follow_up = outcome['follow_up']
-    rule = outcome['rule']
-    if rule in ['rule_5', 'rule_6', 'rule_7', 'rule_8', 'rule_9'] and patient_age <= 75: #high risk polyps can rescope up to age 78
-        return outcome
-    elif follow_up is not None and follow_up != 0 and follow_up + patient_age > 75:
-        return {'follow_up': 20, 'rule': 'rule_20', 'reason': 'Patient aged out'}
-    
-    else:
-        return outcome
+    return rules.apply_age_out(as_summary(data).patient_age, outcome)
 
 
 
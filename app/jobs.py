@@ -0,0 +1,330 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+import logging
+
+from app.clients import RetryableError
+
+logger = logging.getLogger(__name__)
+
+#job states - a job is queued until a worker leases it, and done or failed once it has a result
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class QueueDisabledError(Exception):
+    pass
+
+
+class JobStore:
+    '''
+    SQLite table of triage jobs, so queued and finished jobs survive a restart. A worker leases a job for
+    lease_seconds - a job whose lease runs out (the process died mid-job) is handed to the next worker.
+    The report text is dropped once a job finishes, only the result is kept, for result_ttl seconds.
+    All methods are blocking - call them through asyncio.to_thread from async code
+    '''
+
+    def __init__(self, path: str, lease_seconds: float = 300.0, result_ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.result_ttl = result_ttl
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        #opened lazily so importing the app never touches the disk
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread = False, isolation_level = None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA busy_timeout=5000')
+            self._conn.execute(
+                '''CREATE TABLE IF NOT EXISTS triage_jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    user_query TEXT,
+                    result TEXT,
+                    error TEXT,
+                    retryable INTEGER NOT NULL DEFAULT 0,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL,
+                    available_at REAL NOT NULL
+                )'''
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_triage_jobs_status ON triage_jobs (status, available_at)')
+        return self._conn
+
+    def enqueue(self, user_query: str, max_pending: int) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                (pending,) = conn.execute('SELECT COUNT(*) FROM triage_jobs WHERE status IN (?, ?)', (QUEUED, RUNNING)).fetchone()
+                if pending >= max_pending:
+                    raise QueueFullError(f'{pending} jobs are already waiting')
+                conn.execute(
+                    'INSERT INTO triage_jobs (id, status, user_query, created, updated, available_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (job_id, QUEUED, user_query, now, now, now)
+                )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+        return job_id
+
+    def claim(self) -> tuple | None:
+        '''
+        (id, user_query, attempts) of the oldest job that is due, leased to the caller, or None
+        '''
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            #a running job is only available again once its lease has run out
+            row = conn.execute(
+                '''UPDATE triage_jobs SET status = ?, attempts = attempts + 1, updated = ?, available_at = ?
+                   WHERE id = (SELECT id FROM triage_jobs WHERE status IN (?, ?) AND available_at <= ?
+                               ORDER BY created LIMIT 1)
+                   RETURNING id, user_query, attempts''',
+                (RUNNING, now, now + self.lease_seconds, QUEUED, RUNNING, now)
+            ).fetchone()
+        return row
+
+    def complete(self, job_id: str, result: dict):
+        self._finish(job_id, DONE, result = json.dumps(result))
+
+    def fail(self, job_id: str, error: str, retryable: bool = False):
+        self._finish(job_id, FAILED, error = error, retryable = retryable)
+
+    def _finish(self, job_id: str, status: str, result: str | None = None, error: str | None = None, retryable: bool = False):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                '''UPDATE triage_jobs SET status = ?, user_query = NULL, result = ?, error = ?, retryable = ?,
+                   updated = ?, available_at = ? WHERE id = ?''',
+                (status, result, error, int(retryable), now, now, job_id)
+            )
+            self._purge(conn, now)
+
+    def retry_later(self, job_id: str, delay: float, error: str):
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                'UPDATE triage_jobs SET status = ?, error = ?, updated = ?, available_at = ? WHERE id = ?',
+                (QUEUED, error, now, now + delay, job_id)
+            )
+
+    def release(self, job_id: str):
+        #a worker stopped mid-job - hand it straight back instead of waiting for the lease to run out
+        now = time.time()
+        with self._lock:
+            self._connect().execute(
+                'UPDATE triage_jobs SET status = ?, attempts = attempts - 1, updated = ?, available_at = ? WHERE id = ? AND status = ?',
+                (QUEUED, now, now, job_id, RUNNING)
+            )
+
+    def get(self, job_id: str) -> dict | None:
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT status, result, error, retryable, attempts, created, updated FROM triage_jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        status, result, error, retryable, attempts, created, updated = row
+        return {
+            'job_id': job_id,
+            'status': status,
+            'result': json.loads(result) if result is not None else None,
+            'error': error,
+            'retryable': bool(retryable),
+            'attempts': attempts,
+            'created': created,
+            'updated': updated,
+        }
+
+    def _purge(self, conn, now: float):
+        conn.execute('DELETE FROM triage_jobs WHERE status IN (?, ?) AND updated < ?', (DONE, FAILED, now - self.result_ttl))
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._connect().execute('SELECT status, COUNT(*) FROM triage_jobs GROUP BY status').fetchall()
+        return {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class JobQueue:
+    '''
+    Runs queued triage jobs on a pool of asyncio workers. handler is an async callable that takes the report
+    text and returns a JSON-serializable result. A RetryableError puts the job back in the queue after the
+    Retry-After delay (or an exponential backoff) until max_attempts is reached. submit raises QueueFullError
+    once max_pending jobs are waiting, so callers can push back on the client. A disabled queue starts no
+    workers, never touches the disk and raises QueueDisabledError on submit
+    '''
+
+    def __init__(self, store: JobStore, workers: int = 4, max_pending: int = 1000, max_attempts: int = 5,
+                 poll_interval: float = 1.0, backoff: float = 5.0, max_backoff: float = 300.0, enabled: bool = True):
+        self.store = store
+        self.enabled = enabled
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.errors = 0
+        self._handler = None
+        self._tasks = []
+        self._wakeup = None
+
+    @classmethod
+    def from_env(cls):
+        #queued jobs hold the report text, so the queue only runs when it is given a path for it
+        path = os.getenv('JOB_QUEUE_PATH', '')
+        return cls(
+            JobStore(
+                path = path,
+                lease_seconds = float(os.getenv('JOB_LEASE_SECONDS', '300')),
+                result_ttl = float(os.getenv('JOB_RESULT_TTL_SECONDS', 7 * 24 * 3600)),
+            ),
+            workers = int(os.getenv('JOB_WORKERS', '4')),
+            max_pending = int(os.getenv('JOB_QUEUE_MAX_PENDING', '1000')),
+            max_attempts = int(os.getenv('JOB_MAX_ATTEMPTS', '5')),
+            poll_interval = float(os.getenv('JOB_POLL_INTERVAL', '1.0')),
+            enabled = bool(path),
+        )
+
+    @property
+    def running(self) -> bool:
+        return any(not task.done() for task in self._tasks)
+
+    async def start(self, handler):
+        if not self.enabled:
+            logger.info('Job queue is off - set JOB_QUEUE_PATH to enable POST /triage/jobs')
+            return
+        self._handler = handler
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.workers)]
+        counts = await asyncio.to_thread(self.store.counts)
+        if counts[QUEUED] or counts[RUNNING]:
+            logger.info(f'Job queue resuming {counts[QUEUED]} queued and {counts[RUNNING]} interrupted jobs')
+
+    async def submit(self, user_query: str) -> str:
+        if not self.enabled:
+            raise QueueDisabledError('JOB_QUEUE_PATH is not set')
+        try:
+            job_id = await asyncio.to_thread(self.store.enqueue, user_query, self.max_pending)
+        except QueueFullError:
+            self.rejected += 1
+            raise
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def get(self, job_id: str) -> dict | None:
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.store.get, job_id)
+
+    def counts(self) -> dict:
+        if not self.enabled:
+            return {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        return self.store.counts()
+
+    def _delay(self, error: RetryableError, attempts: int) -> float:
+        if error.retry_after:
+            return error.retry_after
+        return min(self.max_backoff, self.backoff * 2 ** (attempts - 1))
+
+    async def _idle(self):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _work(self):
+        while True:
+            try:
+                await self._run_one()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                #a store error (database locked, disk full) must not end the worker, or the queue stops draining
+                self.errors += 1
+                logger.error(f'Job queue worker error: {e!r}')
+                await self._idle()
+
+    async def _run_one(self):
+        job = await asyncio.to_thread(self.store.claim)
+        if job is None:
+            await self._idle()
+            return
+        job_id, user_query, attempts = job
+        try:
+            result = await self._handler(user_query)
+        except asyncio.CancelledError:
+            #shielded, so the job is handed back even though this worker is being cancelled
+            await asyncio.shield(asyncio.to_thread(self.store.release, job_id))
+            raise
+        except RetryableError as e:
+            if attempts >= self.max_attempts:
+                self.failed += 1
+                await asyncio.to_thread(self.store.fail, job_id, f'Extraction temporarily unavailable: {e}', True)
+                return
+            self.retried += 1
+            delay = self._delay(e, attempts)
+            logger.warning(f'Job {job_id} attempt {attempts} failed ({e}), retrying in {delay:.1f}s')
+            await asyncio.to_thread(self.store.retry_later, job_id, delay, str(e))
+            return
+        except Exception as e:
+            logger.error(f'Job {job_id} failed: {e!r}')
+            self.failed += 1
+            await asyncio.to_thread(self.store.fail, job_id, f'Triage failed: {e}')
+            return
+        self.processed += 1
+        await asyncio.to_thread(self.store.complete, job_id, result)
+
+    def stats(self) -> dict:
+        return {
+            'processed': self.processed,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rejected': self.rejected,
+            'errors': self.errors,
+        }
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self.store.close()
+
+
+job_queue = JobQueue.from_env()
@@ -0,0 +1,190 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+
+from app.clients import extraction_deployments
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidResponse(Exception):
+    pass
+
+
+class Deployment:
+    '''
+    One model deployment behind an OpenAI-compatible client, with the load and health figures the router uses
+    '''
+
+    def __init__(self, name: str, client, model: str, window: int = 200):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.outstanding = 0
+        self.latencies = deque(maxlen = window)
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.unhealthy_until
+
+    def quantile(self, q: float) -> float | None:
+        if len(self.latencies) < 10:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        return {
+            'outstanding': self.outstanding,
+            'requests': self.requests,
+            'errors': self.errors,
+            'healthy': self.healthy,
+            'p50_seconds': self.quantile(0.5),
+            'p95_seconds': self.quantile(0.95),
+        }
+
+
+class LLMRouter:
+    '''
+    Spreads requests over several deployments, sending each one to the healthy deployment with the fewest
+    requests in flight. A deployment that fails failure_threshold times in a row is skipped for cooldown seconds.
+
+    With hedging on, if the first deployment has not answered within its recent p95 latency (never less than
+    hedge_min_delay) the same request is sent to a second deployment and the first valid response wins
+    '''
+
+    def __init__(self, deployments: list, hedge: bool = False, hedge_quantile: float = 0.95, hedge_min_delay: float = 1.0,
+                 max_attempts: int = 2, failure_threshold: int = 3, cooldown: float = 30.0):
+        if not deployments:
+            raise ValueError('LLMRouter needs at least one deployment')
+        self.deployments = deployments
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.max_attempts = max_attempts
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            [Deployment(name, client, model) for name, client, model in extraction_deployments()],
+            hedge = os.getenv('LLM_HEDGE_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+            hedge_quantile = float(os.getenv('LLM_HEDGE_QUANTILE', '0.95')),
+            hedge_min_delay = float(os.getenv('LLM_HEDGE_MIN_DELAY', '1.0')),
+            max_attempts = int(os.getenv('LLM_MAX_ATTEMPTS', '2')),
+        )
+
+    def pick(self, exclude = ()) -> Deployment | None:
+        candidates = [d for d in self.deployments if d not in exclude]
+        if not candidates:
+            return None
+        healthy = [d for d in candidates if d.healthy] or candidates
+        fewest = min(d.outstanding for d in healthy)
+        return random.choice([d for d in healthy if d.outstanding == fewest])
+
+    def hedge_delay(self, deployment: Deployment) -> float:
+        observed = deployment.quantile(self.hedge_quantile)
+        return max(self.hedge_min_delay, observed or 0.0)
+
+    def _launch(self, deployment: Deployment, call, is_valid) -> asyncio.Task:
+        #counted before the task starts so requests picked in the same loop iteration see each other
+        deployment.outstanding += 1
+        deployment.requests += 1
+        task = asyncio.create_task(self._attempt(deployment, call, is_valid))
+        task.add_done_callback(lambda _: setattr(deployment, 'outstanding', deployment.outstanding - 1))
+        return task
+
+    async def _attempt(self, deployment: Deployment, call, is_valid):
+        start = time.perf_counter()
+        try:
+            result = await call(deployment.client, deployment.model)
+            if not is_valid(result):
+                raise InvalidResponse(f'{deployment.name} returned an invalid response')
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            deployment.errors += 1
+            deployment.consecutive_failures += 1
+            if deployment.consecutive_failures >= self.failure_threshold:
+                deployment.unhealthy_until = time.monotonic() + self.cooldown
+                logger.warning(f'Deployment {deployment.name} marked unhealthy for {self.cooldown}s')
+            raise
+        deployment.latencies.append(time.perf_counter() - start)
+        deployment.consecutive_failures = 0
+        return result
+
+    async def _race(self, primary: Deployment, tried: set, call, is_valid):
+        first = self._launch(primary, call, is_valid)
+        secondary = self.pick(exclude = tried) if self.hedge else None
+        if secondary is None:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout = self.hedge_delay(primary))
+        if done:
+            return first.result()
+
+        tried.add(secondary)
+        self.hedges += 1
+        second = self._launch(secondary, call, is_valid)
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when = asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(self, call, is_valid = lambda result: True):
+        '''
+        call is an async function taking (client, model). Failed or invalid responses are retried on a
+        different deployment, up to max_attempts deployments in total
+        '''
+        tried = set()
+        error = None
+        for _ in range(self.max_attempts):
+            deployment = self.pick(exclude = tried)
+            if deployment is None:
+                break
+            tried.add(deployment)
+            try:
+                return await self._race(deployment, tried, call, is_valid)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+                logger.warning(f'LLM request via {deployment.name} failed: {e!r}')
+        raise error
+
+    def stats(self) -> dict:
+        return {
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'deployments': {d.name: d.stats() for d in self.deployments},
+        }
+
+    async def close(self):
+        for deployment in self.deployments:
+            close = getattr(deployment.client, 'close', None)
+            if close is not None:
+                await close()
+
+
+extraction_router = LLMRouter.from_env()
@@ -1,9 +1,52 @@
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler
 from datetime import datetime
 import json
+import os
+import atexit
+import queue
+import threading
+import time
+
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+LOG_BATCH_SIZE = int(os.getenv('LOG_BATCH_SIZE', '256'))
+LOG_FLUSH_INTERVAL = float(os.getenv('LOG_FLUSH_INTERVAL', '0.5'))
+#records that wait longer than this between the request and the disk are counted as delayed
+LOG_DELAY_WARNING = float(os.getenv('LOG_DELAY_WARNING', '1.0'))
+
+
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_FILE = os.getenv('LOG_FILE', 'app.log')
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    #pydantic models and anything else json can't handle natively
+    if hasattr(value, 'model_dump'):
+        return value.model_dump(mode = 'json')
+    return str(value)
+
+
+def _json_dumps(log_record: dict) -> str:
+    return json.dumps(log_record, separators = (',', ':'), default = _default)
+
+
+def _orjson_dumps(log_record: dict) -> str:
+    return orjson.dumps(log_record, default = _default).decode('utf-8')
+
 
 class JSONFormatter(logging.Formatter):
+    def __init__(self, *args, backend: str = 'json', **kwargs):
+        super().__init__(*args, **kwargs)
+        if backend == 'orjson' and orjson is None:
+            logging.getLogger(__name__).warning('LOG_FORMAT=orjson but orjson is not installed, falling back to json')
+            backend = 'json'
+        self.dumps = _orjson_dumps if backend == 'orjson' else _json_dumps
+
     def format(self, record):
         log_record = {
             'timestamp': self.formatTime(record),
@@ -12,26 +55,213 @@ class JSONFormatter(logging.Formatter):
         }
         if hasattr(record, 'extra_data'):
             log_record['extra'] = record.extra_data
-        return json.dumps(log_record)
+        return self.dumps(log_record)
+
+
+class BatchWriteMixin:
+    '''
+    Lets a stream handler write a whole batch of records and flush once, instead of flushing per record
+    '''
+    def emit_batch(self, records):
+        with self.lock:
+            for record in records:
+                if record.levelno < self.level:
+                    continue
+                try:
+                    if isinstance(self, RotatingFileHandler) and self.shouldRollover(record):
+                        self.doRollover()
+                    self.stream.write(self.format(record) + self.terminator)
+                except Exception:
+                    self.handleError(record)
+            self.flush()
+
+
+class BatchedStreamHandler(BatchWriteMixin, logging.StreamHandler):
+    pass
+
+
+class BatchedRotatingFileHandler(BatchWriteMixin, RotatingFileHandler):
+    pass
+
+
+class DroppingQueueHandler(QueueHandler):
+    '''
+    Never blocks the caller - when the queue is full the record is dropped and counted
+    '''
+    def __init__(self, log_queue, stats):
+        super().__init__(log_queue)
+        self.stats = stats
+
+    def prepare(self, record):
+        #the JSON formatting happens on the writer thread, here we only freeze the message
+        msg = record.getMessage()
+        if record.exc_info:
+            msg = f'{msg}\n{logging.Formatter().formatException(record.exc_info)}'
+        record.msg = msg
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.stats.enqueued += 1
+        except queue.Full:
+            self.stats.dropped += 1
+
+
+class LogStats:
+    def __init__(self):
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.delayed = 0
+        self.max_delay = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'written': self.written,
+            'batches': self.batches,
+            'delayed': self.delayed,
+            'max_delay_seconds': self.max_delay,
+        }
+
+
+class BatchingQueueListener:
+    '''
+    Background thread that drains the log queue and hands records to the handlers in batches.
+    A batch is written when it reaches batch_size records or flush_interval seconds after its first record
+    '''
+    _sentinel = None
+
+    def __init__(self, log_queue, handlers, stats, batch_size = LOG_BATCH_SIZE, flush_interval = LOG_FLUSH_INTERVAL):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.stats = stats
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self._monitor, name = 'audit-log-writer', daemon = True)
+        self._thread.start()
+
+    def _monitor(self):
+        while True:
+            record = self.queue.get()
+            if record is self._sentinel:
+                return
+            batch = [record]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    record = self.queue.get(timeout = timeout)
+                except queue.Empty:
+                    break
+                if record is self._sentinel:
+                    stop = True
+                    break
+                batch.append(record)
+            self._write(batch)
+            if stop:
+                return
+
+    def _write(self, batch):
+        for handler in self.handlers:
+            if hasattr(handler, 'emit_batch'):
+                handler.emit_batch(batch)
+            else:
+                for record in batch:
+                    handler.handle(record)
+        now = time.time()
+        delay = now - batch[0].created
+        self.stats.written += len(batch)
+        self.stats.batches += 1
+        self.stats.max_delay = max(self.stats.max_delay, delay)
+        self.stats.delayed += sum(1 for record in batch if now - record.created > LOG_DELAY_WARNING)
+
+    def stop(self):
+        if self._thread is not None:
+            self.queue.put(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+def log_file() -> str:
+    '''
+    LOG_FILE, or under gunicorn app-<slot>.log for each worker - rotation is not safe across processes, so
+    the workers don't share a file. gunicorn.conf.py reuses a dead worker's slot for its replacement
+    '''
+    slot = os.getenv('WORKER_SLOT')
+    if slot is None:
+        return LOG_FILE
+    root, ext = os.path.splitext(LOG_FILE)
+    return f'{root}-{slot}{ext}'
+
+
+log_stats = LogStats()
+_listener = None
+_setup_lock = threading.Lock()
+
 
 def setup_logging():
+    '''
+    Configures api_logger once per process - later calls return the already configured logger
+    '''
+    global _listener
     logger = logging.getLogger('api_logger')
-    logger.setLevel(logging.INFO)
+    with _setup_lock:
+        if _listener is not None:
+            return logger
+
+        logger.setLevel(logging.INFO)
 
-    file_handler = RotatingFileHandler(
-        'app.log',
-        maxBytes = 5_000_000,
-        backupCount = 3
+        file_handler = BatchedRotatingFileHandler(
+            log_file(),
+            maxBytes = 5_000_000,
+            backupCount = 3
 
-    )
-    file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(JSONFormatter())
+        )
+        file_handler.setLevel(logging.INFO)
+        file_handler.setFormatter(JSONFormatter(backend = LOG_FORMAT))
 
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(JSONFormatter())
+        console_handler = BatchedStreamHandler()
+        console_handler.setLevel(logging.INFO)
+        console_handler.setFormatter(JSONFormatter(backend = LOG_FORMAT))
 
-    logger.addHandler(console_handler)
-    logger.addHandler(file_handler)
-    logger.propagate = False
+        #request handlers only put records on a bounded queue, a background thread formats and writes them
+        log_queue = queue.Queue(maxsize = LOG_QUEUE_SIZE)
+        _listener = BatchingQueueListener(log_queue, [console_handler, file_handler], log_stats)
+        _listener.start()
+
+        logger.addHandler(DroppingQueueHandler(log_queue, log_stats))
+        logger.propagate = False
     return logger
+
+
+def shutdown_logging():
+    '''
+    Writes out everything still queued, stops the writer thread and detaches the handlers
+    '''
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        logger = logging.getLogger('api_logger')
+        for handler in list(logger.handlers):
+            if isinstance(handler, DroppingQueueHandler):
+                logger.removeHandler(handler)
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -1,3 +1,7 @@
+import time
+#measured from here so the startup figure covers importing the app, its clients and parsing the prompts
+_import_started = time.perf_counter()
+
 import os
 from fastapi import FastAPI, Depends, HTTPException, status, Header
 from fastapi.middleware.cors import CORSMiddleware
@@ -7,17 +11,62 @@ import asyncio
 from pydantic import BaseModel
 import logging
 import sys
+from contextlib import asynccontextmanager
 
 load_dotenv()
 
 from app.functions import format_query_json, triage, age_out, triage_with_age_out
-from app.logging_config import setup_logging
+from app.logging_config import setup_logging, shutdown_logging
+
+from app import routes, functions, metrics
+from app.redaction import redaction_service
+from app.jobs import job_queue
+from app.clients import close_clients
+from app.llm_router import extraction_router
+from app.cache import extraction_cache
+from app.patient_history import patient_history
+from app.prompt_registry import prompt_registry
+
+#seconds spent importing the app and running the startup half of the lifespan, read by /metrics and the startup benchmark
+startup_seconds = {'import': time.perf_counter() - _import_started}
+metrics.registry.gauge('app_startup_seconds', 'Seconds spent on each phase of startup',
+                       lambda: startup_seconds, label_name = 'phase')
+
 
-from app import routes
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    '''
+    Runs in every worker process. The clients, prompt registry and caches are built on import, so with a
+    preloaded server (gunicorn.conf.py) that work happens once before the workers are forked; anything that
+    starts threads or tasks, or holds connections, is started here and closed again on shutdown
+    '''
+    started = time.perf_counter()
+    #logging is configured here, once per process, rather than on import
+    logger = setup_logging()
+    #fail at startup rather than on the first request when the extraction prompt is missing
+    prompt_registry.get(functions.JSON_SUMMARY_PROMPT)
+    #edited prompt files are picked up in the background, so serving a prompt never reads the disk
+    prompt_registry.start()
+    #only pay for the NER model at startup when redaction is switched on
+    if functions.PII_REDACTION_ENABLED:
+        await redaction_service.warm()
+    await job_queue.start(routes.process_job)
+    startup_seconds['lifespan'] = time.perf_counter() - started
+    logger.info(f'Started in {startup_seconds["import"] + startup_seconds["lifespan"]:.2f}s '
+                f'(import {startup_seconds["import"]:.2f}s, lifespan {startup_seconds["lifespan"]:.2f}s)')
+    yield
+    await job_queue.close()
+    await prompt_registry.close()
+    await redaction_service.close()
+    await functions.near_duplicates.close()
+    await extraction_router.close()
+    await close_clients()
+    extraction_cache.close()
+    patient_history.close()
+    shutdown_logging()
 
-logger = setup_logging()
 
-app = FastAPI(title = 'Colonoscopy triage API')
+app = FastAPI(title = 'Colonoscopy triage API', lifespan = lifespan)
 
 ORIGINS = os.getenv('CORS_ORIGINS', '').split(',')
 
@@ -0,0 +1,180 @@
+'''
+Minimal in-process metrics with Prometheus text exposition, served by GET /metrics.
+Values are per process - with several workers each one reports its own figures
+'''
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _labels_text(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, labels, value) for labels, value in items]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(tuple(sorted(labels.items())), ([0], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        samples = []
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + (('le', _number(float(bound))),), cumulative))
+            samples.append((f'{self.name}_count', labels, cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+        return samples
+
+
+class Gauge:
+    '''
+    Reads its value(s) when scraped - fn returns a number, or a dict of {label value: number} for label_name
+    '''
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, fn, label_name: str | None = None, metric_type: str = 'gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        self.label_name = label_name
+        self.type = metric_type
+
+    def samples(self):
+        value = self.fn()
+        if self.label_name is None:
+            return [(self.name, (), value)]
+        return [(self.name, ((self.label_name, key),), v) for key, v in value.items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.register(Counter(name, documentation))
+
+    def histogram(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets))
+
+    def gauge(self, name: str, documentation: str, fn, label_name: str | None = None, metric_type: str = 'gauge') -> Gauge:
+        return self.register(Gauge(name, documentation, fn, label_name, metric_type))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                lines.append(f'# {metric.name} unavailable: {e!r}')
+                continue
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in samples:
+                lines.append(f'{name}{_labels_text(labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram('triage_stage_seconds', 'Time spent in each stage of a triage request')
+rule_hits = registry.counter('triage_rule_hits_total', 'Final recommendations by rules_dict id')
+extraction_failures = registry.counter('extraction_failures_total', 'Failed LLM extractions by reason - retryable ones are raised, the rest fall back to empty_summary')
+llm_tokens = registry.counter('llm_tokens_total', 'Tokens reported by the extraction calls, by direction')
+extraction_path = registry.counter('extraction_path_total', 'Extractions by how they were served - fast (regex), cache, near_duplicate or llm')
+report_tokens = registry.counter('report_tokens_total', 'Report tokens before (raw) and after (sent) preprocessing')
+boilerplate_removed = registry.counter('boilerplate_lines_removed_total', 'Boilerplate lines removed from reports, by pattern')
+llm_throttled = registry.counter('llm_throttled_total', '429 responses from each deployment')
+structured_output = registry.counter('structured_output_total', 'LLM extractions by schema validation outcome - valid, repaired locally (an LLM call saved) or failed')
+structured_output_repairs = registry.counter('structured_output_repairs_total', 'Local coercions applied to extractions that failed the schema, by kind')
+structured_output_tokens_saved = registry.counter('structured_output_tokens_saved_total', 'Tokens of the LLM calls that local repair made unnecessary')
+llm_retries = registry.counter('llm_retries_total', 'LLM calls retried after a 429, timeout or server error, by deployment')
+
+
+@contextmanager
+def stage_timer(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage = stage)
+
+
+def record_token_usage(usage):
+    if usage is None:
+        return
+    llm_tokens.inc(getattr(usage, 'input_tokens', 0) or 0, direction = 'input')
+    llm_tokens.inc(getattr(usage, 'output_tokens', 0) or 0, direction = 'output')
+
+
+def record_structured_output(result, usage = None):
+    if result.summary is None:
+        structured_output.inc(outcome = 'failed')
+    elif result.repaired:
+        structured_output.inc(outcome = 'repaired')
+        #without the repair the same request would have been sent again
+        if usage is not None:
+            structured_output_tokens_saved.inc((getattr(usage, 'input_tokens', 0) or 0) + (getattr(usage, 'output_tokens', 0) or 0))
+    else:
+        structured_output.inc(outcome = 'valid')
+    for repair in result.repairs:
+        structured_output_repairs.inc(repair = repair)
@@ -0,0 +1,162 @@
+'''
+Reuses the extraction of an earlier report when a new one is a lightly edited copy of it - a resent report with
+a typo fixed or a sentence reworded misses the exact-match cache. Reports are embedded with embedding_client
+(concurrent reports share one embeddings call) and compared by cosine similarity against the recent reports
+held in memory. A match is only reused when the similarity clears the threshold and the two reports differ
+only outside the clinical vocabulary - same NHI, and the same numbers, negations, histology, grade, morphology,
+resection and location words in the same order - since a changed polyp size or 'tubular' edited to
+'tubulovillous' barely moves the embedding but changes the triage
+'''
+import os
+import re
+import time
+import logging
+from dataclasses import dataclass
+
+import numpy as np
+
+from app.batching import MicroBatcher
+from app.clients import embedding_client
+from app.fast_extract import DISQUALIFYING
+
+logger = logging.getLogger(__name__)
+
+#every token a triage-relevant edit could change, compared in report order
+CLINICAL = re.compile(
+    r'\d+(?:\.\d+)?'
+    r'|\b(?:no|not|nil|none|without|negative|unable|failed|cannot)\b|n\'t\b'
+    r'|\b(?:one|two|three|four|five|six|seven|eight|nine|ten|single|multiple|several|numerous)\b'
+    r'|\b(?:tubular|tubulo-?villous|villous|adenoma\w*|serrated|sessile|pedunculated|flat|hyperplastic|traditional'
+    r'|ssl|ssa|ssp|tva|hp|polyps?|dysplas\w*|atypia|low|high|grade|lgd|hgd|carcinoma|cancer|malignan\w*|invasive|mucosa\w*'
+    r'|en bloc|piecemeal|fragment\w*|complete\w*|incomplete\w*|removed|resect\w*|unresected|retrieved|lost|biops\w*|snare|emr'
+    r'|c(?:a)?ecum|c(?:a)?ecal|ileum|appendi\w*|ascending|hepatic|transverse|splenic|descending|sigmoid|rectum|rectal|anus|anal'
+    r'|left|right|proximal|distal|reached|intubated|visuali[sz]ed|identified)\b',
+    re.IGNORECASE
+)
+
+
+def key_fields(text: str, nhi_pattern: re.Pattern) -> tuple:
+    '''
+    The parts of a report that must be identical for an earlier extraction to be reused
+    '''
+    return (
+        tuple(sorted(set(nhi_pattern.findall(text)))),
+        tuple(m.group(0).lower().replace('-', '') for m in CLINICAL.finditer(text)),
+        tuple(sorted(m.group(0).lower() for m in DISQUALIFYING.finditer(text))),
+    )
+
+
+@dataclass
+class NearDuplicateMatch:
+    result: dict
+    similarity: float
+
+
+class NearDuplicateIndex:
+    '''
+    Brute force cosine similarity over a fixed-size ring buffer of unit vectors - at a few thousand reports
+    one matrix-vector product is faster than maintaining an approximate index. Entries older than ttl_seconds
+    are ignored and each entry is tied to the prompt fingerprint it was extracted with
+    '''
+
+    def __init__(self, client, model: str | None, nhi_pattern: re.Pattern, threshold: float = 0.97,
+                 max_entries: int = 5000, ttl_seconds: float = 7 * 24 * 3600, enabled: bool = False,
+                 max_batch_size: int = 16, max_wait: float = 0.01):
+        self.client = client
+        self.model = model
+        self.nhi_pattern = nhi_pattern
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled and bool(model)
+
+        self.lookups = 0
+        self.reused = 0
+        self.fields_differ = 0
+        self.embedding_failures = 0
+
+        self._vectors = None
+        self._created = np.full(max_entries, -np.inf)
+        self._entries = [None] * max_entries
+        self._next = 0
+        self._batcher = MicroBatcher(self._embed_batch, max_batch_size = max_batch_size, max_wait = max_wait)
+
+    @classmethod
+    def from_env(cls, nhi_pattern: re.Pattern):
+        return cls(
+            embedding_client,
+            os.getenv('EMBEDDING_DEPLOYMENT_NAME'),
+            nhi_pattern,
+            threshold = float(os.getenv('NEAR_DUPLICATE_THRESHOLD', '0.97')),
+            max_entries = int(os.getenv('NEAR_DUPLICATE_MAX_ENTRIES', '5000')),
+            ttl_seconds = float(os.getenv('NEAR_DUPLICATE_TTL_SECONDS', 7 * 24 * 3600)),
+            enabled = os.getenv('NEAR_DUPLICATE_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+            max_batch_size = int(os.getenv('EMBEDDING_BATCH_SIZE', '16')),
+            max_wait = float(os.getenv('EMBEDDING_BATCH_WAIT_MS', '10')) / 1000,
+        )
+
+    async def _embed_batch(self, texts: list) -> list:
+        response = await self.client.embeddings.create(model = self.model, input = texts)
+        vectors = np.array([d.embedding for d in sorted(response.data, key = lambda d: d.index)], dtype = np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis = 1, keepdims = True), 1e-12)
+        return list(vectors)
+
+    async def embed(self, text: str) -> np.ndarray | None:
+        '''
+        Unit embedding of the report, or None when the index is off or the embeddings call failed
+        '''
+        if not self.enabled:
+            return None
+        try:
+            return await self._batcher.submit(text)
+        except Exception as e:
+            #the index is only an optimization, the report still goes to the LLM
+            self.embedding_failures += 1
+            logger.warning(f'Report embedding failed, skipping the near-duplicate check: {e!r}')
+            return None
+
+    def find(self, vector: np.ndarray | None, text: str, prompt_id: str) -> NearDuplicateMatch | None:
+        if vector is None or self._vectors is None:
+            return None
+        self.lookups += 1
+        similarity = self._vectors @ vector
+        similarity[self._created < time.time() - self.ttl_seconds] = -np.inf
+        fields = None
+        #most similar first, the first entry below the threshold ends the search
+        for i in np.argsort(similarity)[::-1]:
+            if similarity[i] < self.threshold:
+                break
+            entry_prompt, entry_fields, result = self._entries[i]
+            if entry_prompt != prompt_id:
+                continue
+            fields = fields or key_fields(text, self.nhi_pattern)
+            if entry_fields == fields:
+                self.reused += 1
+                return NearDuplicateMatch(result, float(similarity[i]))
+            self.fields_differ += 1
+        return None
+
+    def add(self, vector: np.ndarray | None, text: str, prompt_id: str, result: dict):
+        if vector is None:
+            return
+        if self._vectors is None:
+            self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype = np.float32)
+        i = self._next
+        self._vectors[i] = vector
+        self._created[i] = time.time()
+        self._entries[i] = (prompt_id, key_fields(text, self.nhi_pattern), result)
+        self._next = (i + 1) % self.max_entries
+
+    def stats(self) -> dict:
+        return {
+            'lookups': self.lookups,
+            'reused': self.reused,
+            'reuse_rate': self.reused / self.lookups if self.lookups else 0.0,
+            'fields_differ': self.fields_differ,
+            'embedding_failures': self.embedding_failures,
+            'entries': int(np.isfinite(self._created).sum()),
+            'embedding_batches': self._batcher.batches,
+        }
+
+    async def close(self):
+        await self._batcher.close()
@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from app.models.colonoscopy import Colonoscopy, ColonoscopySummary
+from app.rules import combine_history, normalize_date
+
+
+def procedure_key(colonoscopy: Colonoscopy) -> str:
+    '''
+    Identifies a procedure across submissions - by its date when the report has one (a corrected report
+    replaces the earlier version), otherwise by its content
+    '''
+    #normalized, so the same date written two ways is one procedure
+    date = normalize_date(colonoscopy.date)
+    if date:
+        return f'date:{date}'
+    return 'sha256:' + hashlib.sha256(colonoscopy.model_dump_json().encode('utf-8')).hexdigest()
+
+
+def _procedure_date(key: str) -> str | None:
+    return normalize_date(key[len('date:'):]) if key.startswith('date:') else None
+
+
+def procedure_fingerprint(data: ColonoscopySummary, colonoscopy: Colonoscopy) -> str:
+    #everything the outcome of a single procedure depends on - the procedure itself and the indication
+    return hashlib.sha256(f'{data.indication}\x00{colonoscopy.model_dump_json()}'.encode('utf-8')).hexdigest()
+
+
+class PatientHistoryStore:
+    '''
+    Per-patient triage state, backed by SQLite and keyed by the pseudonymized NHI. Every procedure seen for a
+    patient is stored with its own triage outcome (before age out), together with the combined outcome of the
+    whole history (rules.combine_history - the most recent procedure decides) and the date it counts from.
+    Only procedures that are new or changed are triaged, the stored outcomes of the rest are reused.
+    All methods are blocking - call them through asyncio.to_thread from async code
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.procedures_triaged = 0
+        self.procedures_known = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(os.getenv('PATIENT_HISTORY_PATH', 'patient_history.sqlite3'))
+
+    def _connect(self):
+        #opened lazily so importing the app never touches the disk
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread = False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                '''CREATE TABLE IF NOT EXISTS patient_procedures (
+                    patient_key TEXT NOT NULL,
+                    procedure_key TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    outcome TEXT NOT NULL,
+                    updated REAL NOT NULL,
+                    PRIMARY KEY (patient_key, procedure_key)
+                )'''
+            )
+            self._conn.execute(
+                '''CREATE TABLE IF NOT EXISTS patient_outcomes (
+                    patient_key TEXT PRIMARY KEY,
+                    outcome TEXT NOT NULL,
+                    procedures INTEGER NOT NULL,
+                    latest_date TEXT,
+                    updated REAL NOT NULL
+                )'''
+            )
+            self._conn.commit()
+        return self._conn
+
+    def update(self, patient_key: str, data: ColonoscopySummary, triage_procedure) -> tuple:
+        '''
+        Adds the procedures of data to the patient's history and returns (combined outcome, number of procedures,
+        date of the procedure the follow up counts from). triage_procedure(data, colonoscopy) is only called for
+        procedures that are new or have changed
+        '''
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            stored = {key: fingerprint for key, fingerprint in conn.execute(
+                'SELECT procedure_key, fingerprint FROM patient_procedures WHERE patient_key = ?', (patient_key,)
+            )}
+            position = len(stored)
+
+            changed = False
+            for colonoscopy in data.colonoscopy:
+                key = procedure_key(colonoscopy)
+                fingerprint = procedure_fingerprint(data, colonoscopy)
+                if stored.get(key) == fingerprint:
+                    self.procedures_known += 1
+                    continue
+                outcome = triage_procedure(data, colonoscopy)
+                self.procedures_triaged += 1
+                changed = True
+                if key in stored:
+                    #a corrected version of a procedure already on record
+                    conn.execute(
+                        'UPDATE patient_procedures SET fingerprint = ?, outcome = ?, updated = ? WHERE patient_key = ? AND procedure_key = ?',
+                        (fingerprint, json.dumps(outcome), now, patient_key, key)
+                    )
+                else:
+                    conn.execute(
+                        'INSERT INTO patient_procedures (patient_key, procedure_key, fingerprint, position, outcome, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                        (patient_key, key, fingerprint, position, json.dumps(outcome), now)
+                    )
+                    position += 1
+                stored[key] = fingerprint
+
+            if not changed:
+                row = conn.execute(
+                    'SELECT outcome, latest_date FROM patient_outcomes WHERE patient_key = ?', (patient_key,)
+                ).fetchone()
+                if row is not None:
+                    return json.loads(row[0]), len(stored), row[1]
+
+            #a new procedure can supersede the ones on record, so the combined outcome is rebuilt from the stored
+            #per-procedure outcomes - nothing is triaged again
+            rows = conn.execute(
+                'SELECT procedure_key, outcome FROM patient_procedures WHERE patient_key = ? ORDER BY position', (patient_key,)
+            ).fetchall()
+            combined, latest = combine_history([(_procedure_date(key), json.loads(outcome)) for key, outcome in rows])
+            conn.execute(
+                'INSERT OR REPLACE INTO patient_outcomes (patient_key, outcome, procedures, latest_date, updated) VALUES (?, ?, ?, ?, ?)',
+                (patient_key, json.dumps(combined), len(stored), latest, now)
+            )
+            conn.commit()
+        return combined, len(stored), latest
+
+    def get(self, patient_key: str) -> tuple | None:
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT outcome, procedures, latest_date FROM patient_outcomes WHERE patient_key = ?', (patient_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1], row[2]
+
+    def stats(self) -> dict:
+        return {
+            'triaged': self.procedures_triaged,
+            'already_known': self.procedures_known,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+patient_history = PatientHistoryStore.from_env()
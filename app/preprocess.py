@@ -0,0 +1,131 @@
+'''
+Clean-up of report text before it is sent to the LLM: unicode and whitespace normalization and removal of
+boilerplate lines (disclaimers, page markers, signatures - patterns in boilerplate.yaml). The cleaned text is
+also what the extraction cache keys on, so resubmissions that differ only in layout or boilerplate share an entry
+'''
+import os
+import re
+import threading
+import unicodedata
+import logging
+from dataclasses import dataclass, field
+from functools import lru_cache
+from pathlib import Path
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+BOILERPLATE_PATH = Path(os.getenv('PREPROCESS_BOILERPLATE_FILE', Path(__file__).parent / 'boilerplate.yaml'))
+PREPROCESS_ENABLED = os.getenv('PREPROCESS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+#reports longer than this after clean-up are logged - they are never truncated, that could drop findings
+PREPROCESS_TOKEN_WARNING = int(os.getenv('PREPROCESS_TOKEN_WARNING', '8000'))
+TOKENIZER_ENCODING = os.getenv('TOKENIZER_ENCODING', 'o200k_base')
+#when boilerplate removal leaves less than this share of the report, the patterns took clinical text with them
+#and the report is sent with whitespace normalization only
+PREPROCESS_MIN_KEPT = float(os.getenv('PREPROCESS_MIN_KEPT', '0.25'))
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    '''
+    The tiktoken encoding, or False when tiktoken is not installed or its encoding files can't be loaded
+    '''
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except Exception as e:
+                    logger.warning(f'tiktoken unavailable ({e!r}), estimating tokens as characters / 4')
+                    _encoding = False
+    return _encoding
+
+
+@lru_cache(maxsize = 32)
+def _count_cached(text: str) -> int:
+    return len(get_encoding().encode(text))
+
+
+def count_tokens(text: str) -> int:
+    if not get_encoding():
+        return (len(text) + 3) // 4
+    #the system prompt is counted on every call, so counts are memoized
+    return _count_cached(text)
+
+
+_inline_space = re.compile(r'[^\S\n]+')
+_blank_lines = re.compile(r'\n{3,}')
+
+
+def normalize_whitespace(text: str) -> str:
+    '''
+    NFKC-normalizes (non-breaking spaces, full-width digits), collapses runs of spaces and tabs, strips each line
+    and keeps at most one blank line between blocks. Line breaks are kept because they separate report sections
+    '''
+    text = unicodedata.normalize('NFKC', text).replace('\r\n', '\n').replace('\r', '\n')
+    lines = [_inline_space.sub(' ', line).strip() for line in text.split('\n')]
+    return _blank_lines.sub('\n\n', '\n'.join(lines)).strip()
+
+
+@dataclass(frozen = True)
+class PreparedReport:
+    text: str
+    tokens_before: int
+    tokens_after: int
+    removed: dict = field(default_factory = dict)
+    #boilerplate removal was undone because it left too little of the report
+    fallback: bool = False
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+class Preprocessor:
+    def __init__(self, patterns: dict, enabled: bool = True, min_kept: float = PREPROCESS_MIN_KEPT):
+        #name -> compiled pattern
+        self.patterns = {name: re.compile(pattern, re.IGNORECASE | re.MULTILINE) for name, pattern in patterns.items()}
+        self.enabled = enabled
+        self.min_kept = min_kept
+
+    @classmethod
+    def from_file(cls, path: Path = BOILERPLATE_PATH, enabled: bool = PREPROCESS_ENABLED, min_kept: float = PREPROCESS_MIN_KEPT):
+        with open(path, 'r', encoding = 'utf-8') as f:
+            config = yaml.safe_load(f) or {}
+        return cls({item['name']: item['pattern'] for item in config.get('patterns', [])}, enabled = enabled, min_kept = min_kept)
+
+    def clean(self, text: str) -> tuple:
+        '''
+        (cleaned text, {pattern name: lines removed})
+        '''
+        removed = {}
+        for name, pattern in self.patterns.items():
+            text, n = pattern.subn('', text)
+            if n:
+                removed[name] = n
+        return normalize_whitespace(text), removed
+
+    def prepare(self, text: str) -> PreparedReport:
+        if not self.enabled:
+            return PreparedReport(text, 0, 0)
+        cleaned, removed = self.clean(text)
+        fallback = False
+        if removed:
+            normalized = normalize_whitespace(text)
+            if not cleaned or len(cleaned) < self.min_kept * len(normalized):
+                #an empty or gutted report would also become a cache key shared with unrelated reports
+                logger.warning(f'Boilerplate removal left {len(cleaned)} of {len(normalized)} characters, sending the report without it')
+                cleaned, removed, fallback = normalized, {}, True
+        before = count_tokens(text)
+        after = count_tokens(cleaned)
+        if after > PREPROCESS_TOKEN_WARNING:
+            logger.warning(f'Report is {after} tokens after preprocessing (warning threshold {PREPROCESS_TOKEN_WARNING})')
+        return PreparedReport(cleaned, before, after, removed, fallback)
+
+
+preprocessor = Preprocessor.from_file()
@@ -0,0 +1,134 @@
+import os
+import asyncio
+import threading
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+PROMPT_PATH = Path(__file__).parent / 'prompts'
+
+
+@dataclass(frozen = True)
+class Prompt:
+    name: str
+    version: str
+    file: str
+    system_prompt: str
+    mtime: float
+
+
+def compile_prompt(config: dict) -> str:
+    '''
+    Builds the final system prompt from a prompt YAML config - the prompt content followed by its rules
+    '''
+    prompt = config['prompt']
+    system_prompt = f"{prompt['content']}"
+    rules = prompt.get('rules') or config.get('rules')
+    if rules:
+        rules_text = "\n Rules: \n" + "\n".join(f'- {rule}' for rule in rules)
+        system_prompt = f'{system_prompt}\n{rules_text}'
+    return system_prompt
+
+
+class PromptRegistry:
+    '''
+    Parses every YAML prompt in a directory once and serves the compiled system prompts by name
+    (the `name` field in the file) or by file name. get() never touches the disk - edited files are picked up
+    by reload(), which start() runs every reload_interval seconds in a background task (off the event loop).
+    Files are only re-read when their mtime changes
+    '''
+
+    def __init__(self, prompt_path: Path = PROMPT_PATH, reload_interval: float = 5.0):
+        self.prompt_path = Path(prompt_path)
+        self.reload_interval = reload_interval
+        self._prompts = {}
+        self._by_file = {}
+        self._mtimes = {}
+        self._lock = threading.Lock()
+        self._task = None
+
+    def load_all(self):
+        with self._lock:
+            self._scan(strict = True)
+
+    def _scan(self, strict: bool = False):
+        for path in sorted(self.prompt_path.glob('*.yaml')):
+            mtime = path.stat().st_mtime
+            if self._mtimes.get(path.name) == mtime:
+                continue
+            try:
+                prompt = self._load_file(path, mtime)
+            except Exception as e:
+                if strict:
+                    raise
+                #keep serving the last good version of a prompt that was saved in a broken state
+                logger.error(f'Failed to reload prompt file {path}: {e}')
+                continue
+            if path.name in self._mtimes:
+                logger.info(f'Reloaded prompt {prompt.name} version {prompt.version} from {path.name}')
+            self._mtimes[path.name] = mtime
+            self._by_file[path.name] = prompt
+            self._prompts[prompt.name] = prompt
+
+    def _load_file(self, path: Path, mtime: float) -> Prompt:
+        with open(path, 'r', encoding = 'utf-8') as f:
+            try:
+                config = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f'Error loading YAML prompt file {path}: {e}')
+        return Prompt(
+            name = config.get('name', path.stem),
+            version = str(config.get('version', '')),
+            file = path.name,
+            system_prompt = compile_prompt(config),
+            mtime = mtime,
+        )
+
+    def reload(self):
+        '''
+        Re-reads the prompt files whose mtime changed. Blocking - call it through asyncio.to_thread from async code
+        '''
+        with self._lock:
+            self._scan()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            try:
+                await asyncio.to_thread(self.reload)
+            except Exception as e:
+                #the prompt directory can be briefly unreadable during a deploy, keep serving what is loaded
+                logger.error(f'Prompt reload failed: {e!r}')
+
+    def start(self):
+        if self.reload_interval < 0 or self._task is not None:
+            return
+        self._task = asyncio.get_running_loop().create_task(self._watch())
+
+    async def close(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def get(self, name: str) -> Prompt:
+        prompt = self._by_file.get(name) or self._prompts.get(name)
+        if prompt is None:
+            raise FileNotFoundError(f"Prompt not found: {self.prompt_path / name}")
+        return prompt
+
+    def versions(self) -> dict:
+        return {name: prompt.version for name, prompt in self._prompts.items()}
+
+
+#a negative interval turns hot-reloading off
+prompt_registry = PromptRegistry(reload_interval = float(os.getenv('PROMPT_RELOAD_INTERVAL', '5')))
+prompt_registry.load_all()
@@ -0,0 +1,61 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from app import functions
+from app.batching import MicroBatcher
+
+logger = logging.getLogger(__name__)
+
+
+class RedactionService:
+    '''
+    Runs PII redaction off the event loop. Reports awaiting redaction are micro-batched into a single
+    NER pipeline call, which runs on a dedicated worker thread
+    '''
+
+    def __init__(self, ner_factory = None, max_batch_size: int = 16, max_wait: float = 0.005):
+        self.ner_factory = ner_factory or functions.get_ner
+        self._executor = None
+        self._batcher = MicroBatcher(self._process, max_batch_size = max_batch_size, max_wait = max_wait)
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            max_batch_size = int(os.getenv('PII_BATCH_SIZE', '16')),
+            max_wait = float(os.getenv('PII_BATCH_WAIT_MS', '5')) / 1000,
+        )
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = 'pii-ner')
+        return self._executor
+
+    def _redact_batch(self, texts: list) -> list:
+        ner = self.ner_factory()
+        entities = ner(texts)
+        return [functions.apply_redactions(text, found) for text, found in zip(texts, entities)]
+
+    async def _process(self, texts: list) -> list:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), self._redact_batch, texts)
+
+    async def warm(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._get_executor(), self.ner_factory)
+
+    async def redact(self, text: str) -> str:
+        return await self._batcher.submit(text)
+
+    def stats(self) -> dict:
+        return {'batches': self._batcher.batches, 'reports': self._batcher.items}
+
+    async def close(self):
+        await self._batcher.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait = False)
+            self._executor = None
+
+
+redaction_service = RedactionService.from_env()
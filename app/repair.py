@@ -0,0 +1,320 @@
+'''
+Local repair of structured outputs that fail the ColonoscopySummary schema. The raw output text is parsed as
+JSON and deterministic coercions are applied - synonym maps for the literal fields, yes/no to bool, numbers
+with units, clamping of prep scores - before validating again. Anything that can't be repaired without
+guessing at a value the triage rules depend on (polyp type, size, dysplasia or resection, the patient's age,
+the indication) fails the repair, so the caller asks the LLM again instead of triaging on a made up value
+'''
+import re
+import json
+from dataclasses import dataclass, field
+
+from pydantic import ValidationError
+
+from app.models.colonoscopy import Polyp, ColonoscopySummary
+
+
+class RepairFailed(ValueError):
+    pass
+
+
+def _key(value: str) -> str:
+    return re.sub(r'[\s\-/]+', '_', value.strip().lower())
+
+
+POLYP_TYPES = {
+    'adenoma': 'adenoma',
+    'tubular_adenoma': 'adenoma',
+    'adenomatous': 'adenoma',
+    'adenomatous_polyp': 'adenoma',
+    'ta': 'adenoma',
+    'tubulovillous_adenoma': 'tubulovillous_or_villous_adenoma',
+    'villous_adenoma': 'tubulovillous_or_villous_adenoma',
+    'tubulovillous': 'tubulovillous_or_villous_adenoma',
+    'tva': 'tubulovillous_or_villous_adenoma',
+    'ssl': 'sessile_serrated_polyp',
+    'ssp': 'sessile_serrated_polyp',
+    'ssa': 'sessile_serrated_polyp',
+    'sessile_serrated_lesion': 'sessile_serrated_polyp',
+    'sessile_serrated_adenoma': 'sessile_serrated_polyp',
+    'serrated_polyp': 'sessile_serrated_polyp',
+    'hyperplastic': 'hyperplastic_polyp',
+    'hp': 'hyperplastic_polyp',
+    'normal_mucosa': 'normal_colonic_mucosa',
+    'normal': 'normal_colonic_mucosa',
+}
+
+LOCATIONS = {
+    'caecum': 'cecum',
+    'ascending': 'ascending_colon',
+    'hepatic': 'hepatic_flexure',
+    'transverse': 'transverse_colon',
+    'splenic': 'splenic_flexure',
+    'descending': 'descending_colon',
+    'sigmoid': 'sigmoid_colon',
+    'anal_canal': 'anus',
+}
+
+DYSPLASIA = {
+    'no_dysplasia': 'none',
+    'no': 'none',
+    'nil': 'none',
+    'absent': 'none',
+    'low': 'low_grade',
+    'lgd': 'low_grade',
+    'low_grade_dysplasia': 'low_grade',
+    'high': 'high_grade',
+    'hgd': 'high_grade',
+    'high_grade_dysplasia': 'high_grade',
+}
+
+RESECTION = {
+    'en_bloc': 'complete',
+    'completely_resected': 'complete',
+    'removed': 'complete',
+    'piecemeal_resection': 'piecemeal',
+    'not_removed': 'not_resected',
+    'unresected': 'not_resected',
+}
+
+RETRIEVAL = {
+    'retrieved': 'complete',
+    'yes': 'complete',
+    'not_retrieved': 'incomplete',
+    'lost': 'incomplete',
+    'no': 'incomplete',
+}
+
+#exact synonyms only - the indication decides rules 3, 22 and 23, so a free text indication that is not listed
+#here ('IBD surveillance' is not polyp surveillance) fails the repair rather than being mapped to a guess
+INDICATIONS = {
+    'serrated_polyposis': 'sps',
+    'serrated_polyposis_syndrome': 'sps',
+    'inflammatory_bowel_disease': 'ibd',
+    'ibd_surveillance': 'ibd',
+    'ulcerative_colitis': 'ibd',
+    'uc': 'ibd',
+    'crohns': 'ibd',
+    'crohns_disease': 'ibd',
+    "crohn's_disease": 'ibd',
+    'fit': 'positive_faecal_immunochemical_test',
+    'positive_fit': 'positive_faecal_immunochemical_test',
+    'fit_positive': 'positive_faecal_immunochemical_test',
+    'positive_fecal_immunochemical_test': 'positive_faecal_immunochemical_test',
+    'anemia': 'anaemia',
+    'iron_deficiency_anaemia': 'anaemia',
+    'iron_deficiency_anemia': 'anaemia',
+    'ida': 'anaemia',
+    'pr_bleeding': 'rectal_bleeding',
+    'rectal_bleed': 'rectal_bleeding',
+    'change_in_bowel_habits': 'change_in_bowel_habit',
+    'altered_bowel_habit': 'change_in_bowel_habit',
+    'polyp_surveillance': 'surveillance_for_previous_polyps',
+    'post_polypectomy_surveillance': 'surveillance_for_previous_polyps',
+    'surveillance_of_previous_polyps': 'surveillance_for_previous_polyps',
+    'bowel_screening': 'screening',
+    'bowel_cancer_screening': 'screening',
+    'screening_colonoscopy': 'screening',
+    'family_history': 'family_history_unknown',
+}
+
+TRUE = {'true', 'yes', 'y', 'reached', 'complete', 'completed', '1'}
+FALSE = {'false', 'no', 'n', 'not_reached', 'incomplete', '0'}
+
+def _strict(schema):
+    #strict structured outputs need every object closed and every property listed as required - optional
+    #fields stay nullable through their anyOf, so null defaults are dropped
+    schema = dict(schema)
+    if '$defs' in schema:
+        schema['$defs'] = {name: _strict(definition) for name, definition in schema['$defs'].items()}
+    if 'properties' in schema:
+        schema['properties'] = {name: _strict(prop) for name, prop in schema['properties'].items()}
+        schema['required'] = list(schema['properties'])
+    if isinstance(schema.get('items'), dict):
+        schema['items'] = _strict(schema['items'])
+    if 'anyOf' in schema:
+        schema['anyOf'] = [_strict(variant) for variant in schema['anyOf']]
+    if schema.get('type') == 'object':
+        schema.setdefault('additionalProperties', False)
+    if 'default' in schema and schema['default'] is None:
+        del schema['default']
+    return schema
+
+
+def text_format(model) -> dict:
+    '''
+    The strict json_schema text.format of the Responses API for a pydantic model
+    '''
+    return {'type': 'json_schema', 'name': model.__name__, 'schema': _strict(model.model_json_schema()), 'strict': True}
+
+
+@dataclass
+class RepairResult:
+    summary: ColonoscopySummary | None
+    #names of the coercions applied - empty when the output was valid as it came
+    repairs: list = field(default_factory = list)
+    error: str | None = None
+
+    @property
+    def repaired(self) -> bool:
+        return self.summary is not None and bool(self.repairs)
+
+
+class Repairer:
+    def __init__(self):
+        self.repairs = []
+
+    def note(self, repair: str):
+        self.repairs.append(repair)
+
+    def literal(self, value, allowed: tuple, synonyms: dict, name: str, required: bool = False, unknown = None):
+        if value is None or value in allowed:
+            return value
+        if isinstance(value, str):
+            key = _key(value)
+            if key in allowed:
+                self.note(f'{name}_format')
+                return key
+            #exact synonyms only - 'removed piecemeal' must not become 'removed', 'not assessed' must not become 'no'
+            if key in synonyms:
+                self.note(f'{name}_synonym')
+                return synonyms[key]
+        if required:
+            raise RepairFailed(f'unrecognised {name} {value!r}')
+        self.note(f'{name}_unknown')
+        return unknown
+
+    def boolean(self, value, name: str):
+        if value is None or isinstance(value, bool):
+            return value
+        key = _key(str(value))
+        if key in TRUE:
+            self.note(f'{name}_bool')
+            return True
+        if key in FALSE:
+            self.note(f'{name}_bool')
+            return False
+        raise RepairFailed(f'unrecognised {name} {value!r}')
+
+    def integer(self, value, name: str, low: int | None = None, high: int | None = None, clamp: bool = False):
+        if value is None or (isinstance(value, int) and not isinstance(value, bool)
+                             and (low is None or value >= low) and (high is None or value <= high)):
+            return value
+        if isinstance(value, float) and value.is_integer():
+            value = int(value)
+        elif isinstance(value, str):
+            #whole numbers only - rounding '9.5 mm' up would cross the 10mm threshold of rules 5, 7 and 13
+            match = re.fullmatch(r'\s*(-?\d+)(?:\.0+)?\s*(?:mm|millimet(?:er|re)s?|years?|yrs?|y)?\s*', value, re.IGNORECASE)
+            if match is None:
+                raise RepairFailed(f'unrecognised {name} {value!r}')
+            value = int(match.group(1))
+        elif not isinstance(value, int) or isinstance(value, bool):
+            raise RepairFailed(f'unrecognised {name} {value!r}')
+        self.note(f'{name}_number')
+        if (low is not None and value < low) or (high is not None and value > high):
+            if not clamp:
+                raise RepairFailed(f'{name} {value} out of range')
+            self.note(f'{name}_clamped')
+            value = max(low, min(high, value))
+        return value
+
+
+def _allowed(model, name: str) -> tuple:
+    #the values of a Literal[...] | None field
+    annotation = model.model_fields[name].annotation
+    for arg in getattr(annotation, '__args__', ()):
+        if getattr(arg, '__args__', None):
+            return arg.__args__
+    return annotation.__args__
+
+
+def _repair_bbps(r: Repairer, bbps):
+    if not isinstance(bbps, dict):
+        return bbps
+    out = {k: r.integer(bbps.get(k), f'bbps_{k}', 0, 3, clamp = True) for k in ('right', 'transverse', 'left')}
+    total = r.integer(bbps.get('total'), 'bbps_total', 0, 9, clamp = True)
+    segments = [out[k] for k in ('right', 'transverse', 'left')]
+    if None not in segments and total != sum(segments):
+        #the segment scores are what the prep rule checks, a total that disagrees with them is the error
+        r.note('bbps_total_recomputed')
+        total = sum(segments)
+    out['total'] = total
+    return out
+
+
+def _repair_polyp(r: Repairer, polyp):
+    if not isinstance(polyp, dict):
+        raise RepairFailed('polyp is not an object')
+    polyp = dict(polyp)
+    polyp['type'] = r.literal(polyp.get('type'), _allowed(Polyp, 'type'), POLYP_TYPES, 'polyp_type', required = True)
+    polyp['location'] = r.literal(polyp.get('location'), _allowed(Polyp, 'location'), LOCATIONS, 'location')
+    polyp['dysplasia'] = r.literal(polyp.get('dysplasia'), _allowed(Polyp, 'dysplasia'), DYSPLASIA, 'dysplasia', required = True)
+    polyp['resection'] = r.literal(polyp.get('resection'), _allowed(Polyp, 'resection'), RESECTION, 'resection', required = True)
+    polyp['retrieval'] = r.literal(polyp.get('retrieval'), _allowed(Polyp, 'retrieval'), RETRIEVAL, 'retrieval', unknown = 'unknown')
+    polyp['size'] = r.integer(polyp.get('size'), 'polyp_size', 0)
+    return polyp
+
+
+def _repair_colonoscopy(r: Repairer, colonoscopy):
+    if not isinstance(colonoscopy, dict):
+        raise RepairFailed('colonoscopy is not an object')
+    colonoscopy = dict(colonoscopy)
+    colonoscopy['cecum_reached'] = r.boolean(colonoscopy.get('cecum_reached'), 'cecum_reached')
+    colonoscopy['bostonBowelPrepScore'] = _repair_bbps(r, colonoscopy.get('bostonBowelPrepScore'))
+    polyps = colonoscopy.get('polyps') or []
+    if not isinstance(polyps, list):
+        raise RepairFailed('polyps is not a list')
+    colonoscopy['polyps'] = [_repair_polyp(r, polyp) for polyp in polyps]
+    number = colonoscopy.get('number_of_polyps')
+    try:
+        colonoscopy['number_of_polyps'] = r.integer(number, 'number_of_polyps', 0)
+    except RepairFailed:
+        if not polyps:
+            raise
+        r.note('number_of_polyps_counted')
+        colonoscopy['number_of_polyps'] = len(polyps)
+    return colonoscopy
+
+
+def _repair_summary(r: Repairer, data: dict) -> dict:
+    data = dict(data)
+    data['extraction_successful'] = r.boolean(data.get('extraction_successful', True), 'extraction_successful')
+    data['patient_age'] = r.integer(data.get('patient_age'), 'patient_age', 0, 130)
+    indication = data.get('indication')
+    if indication is None:
+        data['indication'] = 'unknown'
+    else:
+        data['indication'] = r.literal(indication, _allowed(ColonoscopySummary, 'indication'), INDICATIONS, 'indication', required = True)
+    colonoscopies = data.get('colonoscopy') or []
+    if isinstance(colonoscopies, dict):
+        r.note('colonoscopy_list')
+        colonoscopies = [colonoscopies]
+    if not isinstance(colonoscopies, list):
+        raise RepairFailed('colonoscopy is not a list')
+    data['colonoscopy'] = [_repair_colonoscopy(r, c) for c in colonoscopies]
+    return data
+
+
+def parse_output(text: str | None) -> RepairResult:
+    '''
+    Validates the raw output text of a structured output call, repairing it locally when it fails the schema
+    '''
+    if not text:
+        return RepairResult(None, error = 'empty output')
+    try:
+        return RepairResult(ColonoscopySummary.model_validate_json(text))
+    except ValidationError:
+        pass
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        return RepairResult(None, error = f'not JSON: {e}')
+    if not isinstance(data, dict):
+        return RepairResult(None, error = 'not a JSON object')
+
+    r = Repairer()
+    try:
+        summary = ColonoscopySummary.model_validate(_repair_summary(r, data))
+    except (RepairFailed, ValidationError, TypeError) as e:
+        return RepairResult(None, repairs = r.repairs, error = str(e).splitlines()[0])
+    return RepairResult(summary, repairs = r.repairs)
@@ -1,36 +1,405 @@
-from fastapi import APIRouter, File, UploadFile, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, File, UploadFile, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from pydantic import BaseModel, Field
+from typing import List
+import asyncio
 import logging
+import json
+import math
+import os
+import tempfile
 
 from app import functions
-from app.logging_config import setup_logging
+from app import metrics
+from app.models.colonoscopy import ColonoscopySummary
+from app.redaction import redaction_service
+from app.llm_router import extraction_router
+from app.logging_config import log_stats
+from app.clients import RetryableError
+from app.jobs import job_queue, QueueFullError, QueueDisabledError
+from app.patient_history import patient_history
 
-logger = setup_logging()
+logger = logging.getLogger('api_logger')
 
 router = APIRouter(tags=['triage'])
 
+#max number of LLM extractions in flight for a single batch request
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', '8'))
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '500'))
+#reports of a /triage/stream upload processed at once, and the limits on how the upload is held
+STREAM_CONCURRENCY = int(os.getenv('STREAM_CONCURRENCY', str(BATCH_CONCURRENCY)))
+STREAM_SPOOL_BYTES = int(os.getenv('STREAM_SPOOL_BYTES', str(1024 * 1024)))
+STREAM_MAX_LINE_BYTES = int(os.getenv('STREAM_MAX_LINE_BYTES', str(1024 * 1024)))
+
+
+async def _prepare_query(user_query: str) -> str:
+    if functions.PII_REDACTION_ENABLED:
+        return await redaction_service.redact(user_query)
+    return user_query
+
+
+def _triage(json_summary: ColonoscopySummary):
+    with metrics.stage_timer('triage'):
+        recommendation = functions.triage(json_summary)
+    with metrics.stage_timer('age_out'):
+        final = functions.age_out(json_summary, recommendation)
+    metrics.rule_hits.inc(rule = final.get('rule', 'unknown'))
+    return recommendation, final
+
+
+def _prompt_version() -> str:
+    prompt = functions.prompt_registry.get(functions.JSON_SUMMARY_PROMPT)
+    return f'{prompt.name}@{prompt.version}'
+
 
 class UserInput(BaseModel):
     user_query: str
 
 
-@router.post("/triage")
+class BatchInput(BaseModel):
+    user_queries: List[str] = Field(min_length = 1)
+
+
+class Recommendation(BaseModel):
+    follow_up: int | None
+    rule: str
+    reason: str
+
+
+class TriageResponse(BaseModel):
+    user_input: ColonoscopySummary
+    recommendation: Recommendation
+
+
+class BatchItem(BaseModel):
+    index: int
+    user_input: ColonoscopySummary | None = None
+    recommendation: Recommendation | None = None
+    error: str | None = None
+    #true when the LLM was rate limited or unavailable - resubmit the report later
+    retryable: bool = False
+
+
+class BatchResponse(BaseModel):
+    results: List[BatchItem]
+
+
+async def _extract(user_query: str) -> ColonoscopySummary:
+    with metrics.stage_timer('redaction'):
+        prepared = await _prepare_query(user_query)
+    with metrics.stage_timer('extraction'):
+        return functions.as_summary(await functions.format_query_json(prepared))
+
+
+def _audit_log(user_query: str, json_summary: ColonoscopySummary, recommendation: dict, **fields):
+    with metrics.stage_timer('audit_log'):
+        logger.info("User input received and recommendation generated",
+                    extra = {
+                        'extra_data': {
+                            'user_input': user_query,
+                            'json_summary': json_summary,
+                            'recommendation': recommendation,
+                            'prompt_version': _prompt_version(),
+                            **fields
+                        }
+                    }
+        )
+
+
+async def _triage_item(index: int, user_query: str, label: str = 'Batch', **log_fields) -> BatchItem:
+    '''
+    Extracts and triages one report of a batch or stream - a failure is reported on the item instead of raised
+    '''
+    try:
+        json_summary = await _extract(user_query)
+    except RetryableError as e:
+        return BatchItem(index = index, error = f'Extraction temporarily unavailable: {e}', retryable = True)
+    except Exception as e:
+        logger.error(f'{label} item {index} extraction failed: {e!r}')
+        return BatchItem(index = index, error = f'Extraction failed: {e}')
+    try:
+        recommendation, final = _triage(json_summary)
+    except Exception as e:
+        logger.error(f'{label} item {index} triage failed: {e!r}')
+        return BatchItem(index = index, user_input = json_summary, error = f'Triage failed: {e}')
+
+    _audit_log(user_query, json_summary, recommendation, **log_fields)
+    return BatchItem(index = index, user_input = json_summary, recommendation = final)
+
+
+def _unavailable(e: RetryableError) -> HTTPException:
+    return HTTPException(status_code = 503, detail = f'Extraction temporarily unavailable: {e}',
+                         headers = {'Retry-After': str(math.ceil(e.retry_after or 1))})
+
+
+@router.post("/triage", response_model = TriageResponse)
 async def recommend(request: UserInput):
     user_query = request.user_query
-    #redacted_user_query = functions.redact_pii(user_query)
-    json_summary = await functions.format_query_json(user_query)
-    recommendation = functions.triage(json_summary)
-    final = functions.age_out(json_summary, recommendation)
-
-    logger.info("User input received and recommendation generated", 
-                extra = {
-                    'extra_data': {
-                        'user_input': user_query,
-                        'json_summary': json_summary,
-                        'recommendation': recommendation
-                    }
-                }
+    try:
+        json_summary = await _extract(user_query)
+    except RetryableError as e:
+        raise _unavailable(e)
+    recommendation, final = _triage(json_summary)
+    _audit_log(user_query, json_summary, recommendation)
+
+    return TriageResponse(user_input = json_summary, recommendation = final)
+
+
+class PatientTriageResponse(TriageResponse):
+    #procedures on record for the patient, including the ones in this report
+    procedures: int
+    #date of the most recent procedure, which the follow up counts from - None when no procedure is dated
+    follow_up_from: str | None = None
+
+
+@router.post("/triage/patient", response_model = PatientTriageResponse)
+async def recommend_patient(request: UserInput):
+    '''
+    Triages a report together with every procedure already on record for the patient (matched on the
+    pseudonymized NHI), so only the new report has to be sent. The recommendation comes from the most recent
+    procedure on record (follow_up_from), aged out with the age in this report
+    '''
+    user_query = request.user_query
+    try:
+        json_summary = await _extract(user_query)
+    except RetryableError as e:
+        raise _unavailable(e)
+    if not json_summary.extraction_successful or not json_summary.colonoscopy:
+        recommendation, final = _triage(json_summary)
+        _audit_log(user_query, json_summary, recommendation)
+        return PatientTriageResponse(user_input = json_summary, recommendation = final, procedures = 0)
+    if not json_summary.patient_NHI:
+        raise HTTPException(status_code = 422, detail = 'No NHI found in the report, it cannot be matched to a patient history - use POST /triage')
+
+    patient_key = functions.pseudonymize(json_summary.patient_NHI)
+    with metrics.stage_timer('triage'):
+        recommendation, procedures, follow_up_from = await asyncio.to_thread(
+            patient_history.update, patient_key, json_summary, functions.triage_colonoscopy)
+    with metrics.stage_timer('age_out'):
+        final = functions.age_out(json_summary, recommendation)
+    metrics.rule_hits.inc(rule = final.get('rule', 'unknown'))
+    _audit_log(user_query, json_summary, recommendation, patient_key = patient_key, procedures = procedures)
+    return PatientTriageResponse(user_input = json_summary, recommendation = final, procedures = procedures, follow_up_from = follow_up_from)
+
+
+@router.post("/triage/batch", response_model = BatchResponse)
+async def recommend_batch(request: BatchInput):
+    '''
+    Triages a list of reports in one call. LLM extraction runs concurrently (bounded by BATCH_CONCURRENCY),
+    results come back in input order and a failure in one report is reported on that item only
+    '''
+    if len(request.user_queries) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code = 413, detail = f'Batch exceeds the maximum of {BATCH_MAX_ITEMS} reports')
+
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(index: int, user_query: str) -> BatchItem:
+        async with semaphore:
+            return await _triage_item(index, user_query, batch_index = index)
+
+    results = await asyncio.gather(*(run(index, user_query) for index, user_query in enumerate(request.user_queries)))
+    return BatchResponse(results = results)
+
+
+class StreamItem(BatchItem):
+    id: str | None = None
+
+
+def _parse_stream_line(line: bytes) -> tuple:
+    '''
+    (user_query, id) from one NDJSON line - either {"user_query": ..., "id": ...} or a bare JSON string
+    '''
+    if len(line.rstrip(b'\r\n')) > STREAM_MAX_LINE_BYTES:
+        raise ValueError(f'line is longer than {STREAM_MAX_LINE_BYTES} bytes')
+    record = json.loads(line)
+    if isinstance(record, str):
+        return record, None
+    if isinstance(record, dict) and isinstance(record.get('user_query'), str):
+        record_id = record.get('id')
+        return record['user_query'], None if record_id is None else str(record_id)
+    raise ValueError('expected {"user_query": ...} or a JSON string')
+
+
+async def _spool_upload(request: Request):
+    '''
+    The NDJSON input as a file object. Multipart uploads are already spooled by the form parser; a raw body is
+    copied into a SpooledTemporaryFile, which moves to disk past STREAM_SPOOL_BYTES so memory use stays flat
+    '''
+    if request.headers.get('content-type', '').startswith('multipart/form-data'):
+        form = await request.form()
+        for value in form.values():
+            if isinstance(value, StarletteUploadFile):
+                await value.seek(0)
+                return value.file, form.close
+        await form.close()
+        raise HTTPException(status_code = 400, detail = 'Multipart upload has no file')
+
+    spool = tempfile.SpooledTemporaryFile(max_size = STREAM_SPOOL_BYTES)
+    async for chunk in request.stream():
+        spool.write(chunk)
+    spool.seek(0)
+
+    async def close():
+        spool.close()
+    return spool, close
+
+
+async def _stream_results(upload, close):
+    lines = asyncio.Queue(maxsize = STREAM_CONCURRENCY)
+    finished = asyncio.Queue(maxsize = STREAM_CONCURRENCY)
+
+    async def read():
+        try:
+            index = 0
+            while line := await asyncio.to_thread(upload.readline, STREAM_MAX_LINE_BYTES + 1):
+                if len(line) > STREAM_MAX_LINE_BYTES and not line.endswith(b'\n'):
+                    #skip the rest of an oversized line so the next one starts cleanly
+                    while (rest := await asyncio.to_thread(upload.readline, STREAM_MAX_LINE_BYTES)) and not rest.endswith(b'\n'):
+                        pass
+                if line.strip():
+                    await lines.put((index, line))
+                index += 1
+        finally:
+            for _ in range(STREAM_CONCURRENCY):
+                await lines.put(None)
+
+    async def work():
+        while (job := await lines.get()) is not None:
+            index, line = job
+            try:
+                user_query, record_id = _parse_stream_line(line)
+            except ValueError as e:
+                await finished.put(StreamItem(index = index, error = f'Invalid input line: {e}'))
+                continue
+            item = await _triage_item(index, user_query, label = 'Stream', stream_index = index)
+            await finished.put(StreamItem(**dict(item), id = record_id))
+
+    async def run():
+        try:
+            await asyncio.gather(read(), *(work() for _ in range(STREAM_CONCURRENCY)))
+        finally:
+            await finished.put(None)
+
+    runner = asyncio.create_task(run())
+    try:
+        while (item := await finished.get()) is not None:
+            yield item.model_dump_json() + '\n'
+        await runner
+    finally:
+        #a client that disconnects mid-stream stops the remaining extractions
+        runner.cancel()
+        await close()
+
+
+@router.post("/triage/stream")
+async def recommend_stream(request: Request):
+    '''
+    Triages an NDJSON upload - the request body itself, or a file in a multipart form. Each line is
+    {"user_query": ..., "id": ...} or a JSON string. Results stream back as NDJSON in completion order, with index
+    set to the 0-based input line and the id echoed back. At most STREAM_CONCURRENCY reports are processed at once
+    '''
+    upload, close = await _spool_upload(request)
+    return StreamingResponse(_stream_results(upload, close), media_type = 'application/x-ndjson')
+
+
+class JobAccepted(BaseModel):
+    job_id: str
+    status: str
+
+
+class JobStatus(BaseModel):
+    job_id: str
+    status: str
+    result: TriageResponse | None = None
+    error: str | None = None
+    #true when the job gave up because the LLM stayed unavailable - resubmit the report later
+    retryable: bool = False
+    attempts: int
+    created: float
+    updated: float
+
+
+async def process_job(user_query: str) -> dict:
+    '''
+    Job queue handler - a RetryableError is left to the queue, which schedules another attempt
+    '''
+    json_summary = await _extract(user_query)
+    recommendation, final = _triage(json_summary)
+    _audit_log(user_query, json_summary, recommendation, job = True)
+    return TriageResponse(user_input = json_summary, recommendation = final).model_dump(mode = 'json')
+
+
+@router.post("/triage/jobs", response_model = JobAccepted, status_code = 202)
+async def submit_job(request: UserInput, response: Response):
+    '''
+    Queues a report and returns straight away - poll GET /triage/jobs/{job_id} for the result.
+    Returns 429 when JOB_QUEUE_MAX_PENDING jobs are already waiting, and 503 when the queue is not configured
+    '''
+    try:
+        job_id = await job_queue.submit(request.user_query)
+    except QueueDisabledError as e:
+        raise HTTPException(status_code = 503, detail = f'Job queue is off: {e} - use POST /triage')
+    except QueueFullError as e:
+        raise HTTPException(status_code = 429, detail = f'Job queue is full: {e}',
+                            headers = {'Retry-After': str(math.ceil(max(job_queue.poll_interval, 1)))})
+    response.headers['Location'] = f'/triage/jobs/{job_id}'
+    return JobAccepted(job_id = job_id, status = 'queued')
+
+
+@router.get("/triage/jobs/{job_id}", response_model = JobStatus)
+async def get_job(job_id: str):
+    job = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code = 404, detail = 'Unknown or expired job')
+    return JobStatus(**job)
+
+
+#stats kept by the cache, audit log, router and redaction batcher, read when /metrics is scraped
+metrics.registry.gauge('extraction_cache_events_total', 'Extraction cache lookups and removals by outcome',
+                       lambda: {k: v for k, v in functions.extraction_cache.stats().items() if k != 'hit_rate'},
+                       label_name = 'event', metric_type = 'counter')
+metrics.registry.gauge('audit_log_records_total', 'Audit log records by outcome',
+                       lambda: {k: log_stats.as_dict()[k] for k in ('enqueued', 'dropped', 'written', 'delayed')},
+                       label_name = 'outcome', metric_type = 'counter')
+metrics.registry.gauge('audit_log_max_delay_seconds', 'Longest wait between a request and its audit record reaching disk',
+                       lambda: log_stats.max_delay)
+metrics.registry.gauge('llm_outstanding_requests', 'LLM requests in flight per deployment',
+                       lambda: {d.name: d.outstanding for d in extraction_router.deployments}, label_name = 'deployment')
+metrics.registry.gauge('llm_requests_total', 'LLM requests sent per deployment',
+                       lambda: {d.name: d.requests for d in extraction_router.deployments}, label_name = 'deployment',
+                       metric_type = 'counter')
+metrics.registry.gauge('llm_errors_total', 'Failed or invalid LLM responses per deployment',
+                       lambda: {d.name: d.errors for d in extraction_router.deployments}, label_name = 'deployment',
+                       metric_type = 'counter')
+metrics.registry.gauge('llm_hedged_requests_total', 'Requests also sent to a second deployment',
+                       lambda: extraction_router.hedges, metric_type = 'counter')
+metrics.registry.gauge('llm_circuit_open', 'Whether the circuit breaker of each deployment is open',
+                       lambda: {d.name: int(d.client.breaker.is_open) for d in extraction_router.deployments
+                                if hasattr(d.client, 'breaker')}, label_name = 'deployment')
+metrics.registry.gauge('llm_rate_limit_scale', 'Fraction of the configured quota each deployment is currently paced to',
+                       lambda: {d.name: d.client.limiter.scale for d in extraction_router.deployments
+                                if hasattr(d.client, 'limiter')}, label_name = 'deployment')
+metrics.registry.gauge('triage_jobs', 'Jobs in the job queue by status',
+                       lambda: job_queue.counts(), label_name = 'status')
+metrics.registry.gauge('triage_jobs_total', 'Jobs finished, retried or rejected by this process',
+                       lambda: job_queue.stats(), label_name = 'outcome', metric_type = 'counter')
+metrics.registry.gauge('near_duplicate_lookups_total', 'Near-duplicate index lookups by outcome',
+                       lambda: {k: functions.near_duplicates.stats()[k] for k in ('lookups', 'reused', 'fields_differ', 'embedding_failures')},
+                       label_name = 'outcome', metric_type = 'counter')
+metrics.registry.gauge('near_duplicate_reuse_ratio', 'Share of near-duplicate lookups that reused an earlier extraction',
+                       lambda: functions.near_duplicates.stats()['reuse_rate'])
+metrics.registry.gauge('structured_output_repair_ratio', 'Share of LLM extractions that missed the schema and were repaired locally',
+                       lambda: metrics.structured_output.value(outcome = 'repaired') / max(1, sum(value for _, _, value in metrics.structured_output.samples())))
+metrics.registry.gauge('patient_history_procedures_total', 'Procedures sent to /triage/patient, by whether they had to be triaged',
+                       lambda: patient_history.stats(), label_name = 'outcome', metric_type = 'counter')
+metrics.registry.gauge('pii_redaction_batches_total', 'NER batches run by the redaction service',
+                       lambda: redaction_service.stats()['batches'], metric_type = 'counter')
 
-    )
 
-    return {'user_input': json_summary, 'recommendation': final}
\ No newline at end of file
+@router.get("/metrics", response_class = PlainTextResponse)
+async def get_metrics():
+    '''
+    Prometheus text exposition of stage latencies, token usage, rule hits and the cache/log/router stats
+    '''
+    return PlainTextResponse(metrics.registry.render(), media_type = 'text/plain; version=0.0.4')
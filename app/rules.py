@@ -0,0 +1,270 @@
+'''
+The triage rules. functions.triage and functions.age_out delegate here.
+
+Each procedure of a summary is reduced to a TriageFeatures record in one pass over its polyps, the rules are
+evaluated in priority order from RULE_TABLE and the most conservative procedure outcome is kept. triage_many
+works on stored summaries (model dumps) without validating them into models first
+'''
+import datetime
+import functools
+
+rules_dict = {
+    'rule_1': 'Cecum not reached',
+    'rule_2': 'Inadequate prep',
+    'rule_3': 'Serrated polyposis syndrome',
+    'rule_4': 'Greater than 10 adenomatous polyps',
+    'rule_5': 'SSL >= 10mm',
+    'rule_6': 'SSL with dysplasia',
+    'rule_7': 'Adenoma >= 10mm',
+    'rule_8': 'Tubulovillous or villous adenoma',
+    'rule_9': 'Adenoma with HGD',
+    'rule_10': '5 or more SSL all less than 10mm, no other polyps, no high risk features',
+    'rule_11': '5-9 adenomas with no high risk features and no SSL',
+    'rule_12': '5-9 combined adenomas and SSL',
+    'rule_13': 'Hyperplastic polyp >= 10mm',
+    'rule_14': '3-4 adenomas, no SSL, no high risk features',
+    'rule_15': '1-4 SSL < 10mm no dysplasia no other polyps',
+    'rule_16': 'Adenoma and SSL present, less than 5 total polyps, no high risk features',
+    'rule_17': '1-2 adenomas less than 10mm no hgd',
+    'rule_18': 'No polyps',
+    'rule_19': 'No criteria met, needs human review',
+    'rule_20': 'Patient aged out',
+    'rule_21': 'Incomplete/piecemeal resection or incomplete retrieval',
+    'rule_22': 'IBD',
+    'rule_23': 'Discharged due to no polyps and family history category 1 or 2',
+    'rule_24': 'Extraction failed, needs human review'
+}
+
+#high risk polyps can rescope up to age 78, so they are exempt from the usual age out check
+HIGH_RISK_RULES = frozenset(['rule_5', 'rule_6', 'rule_7', 'rule_8', 'rule_9'])
+AGE_OUT_LIMIT = 75
+FAMILY_HISTORY_DISCHARGE = frozenset(['family_history_category_1', 'family_history_category_2'])
+
+
+class TriageFeatures:
+    __slots__ = (
+        'patient_age', 'indication', 'total_polyps', 'cecum',
+        'bbps_total', 'bbps_right', 'bbps_transverse', 'bbps_left',
+        'has_polyps', 'n_adenoma', 'max_adenoma', 'hgd_adenoma',
+        'n_ssl', 'max_ssl', 'dysplastic_ssl', 'n_hyperplastic', 'max_hyperplastic',
+        'tva', 'incomplete',
+    )
+
+
+def procedure_features(patient_age: int, indication: str, colonoscopy) -> TriageFeatures:
+    '''
+    Aggregates one procedure into the values the rules look at, in one pass over its polyps. colonoscopy is
+    a Colonoscopy model or its model_dump
+    '''
+    f = TriageFeatures()
+    n_adenoma = max_adenoma = n_ssl = max_ssl = n_hyperplastic = max_hyperplastic = 0
+    hgd_adenoma = dysplastic_ssl = tva = incomplete = False
+
+    #pydantic models keep their fields in __dict__, so a model is read like its dump without calling model_dump
+    is_model = not isinstance(colonoscopy, dict)
+    if is_model:
+        colonoscopy = colonoscopy.__dict__
+    polyps = colonoscopy['polyps']
+    bbps = colonoscopy['bostonBowelPrepScore']
+    if polyps:
+        for polyp in polyps:
+            if is_model:
+                polyp = polyp.__dict__
+            polyp_type = polyp['type']
+            if polyp_type == 'adenoma':
+                n_adenoma += 1
+                size = polyp['size']
+                if size > max_adenoma:
+                    max_adenoma = size
+                if polyp['dysplasia'] == 'high_grade':
+                    hgd_adenoma = True
+            elif polyp_type == 'sessile_serrated_polyp':
+                n_ssl += 1
+                size = polyp['size']
+                if size > max_ssl:
+                    max_ssl = size
+                if polyp['dysplasia'] in ('low_grade', 'high_grade'):
+                    dysplastic_ssl = True
+            elif polyp_type == 'hyperplastic_polyp':
+                n_hyperplastic += 1
+                size = polyp['size']
+                if size > max_hyperplastic:
+                    max_hyperplastic = size
+            elif polyp_type == 'tubulovillous_or_villous_adenoma':
+                tva = True
+            if polyp['resection'] != 'complete' or polyp['retrieval'] != 'complete':
+                incomplete = True
+
+    f.patient_age = patient_age
+    f.indication = indication
+    f.total_polyps = colonoscopy['number_of_polyps']
+    f.cecum = colonoscopy['cecum_reached']
+    if bbps is None:
+        f.bbps_total = f.bbps_right = f.bbps_transverse = f.bbps_left = None
+    else:
+        if is_model:
+            bbps = bbps.__dict__
+        f.bbps_total = bbps['total']
+        f.bbps_right = bbps['right']
+        f.bbps_transverse = bbps['transverse']
+        f.bbps_left = bbps['left']
+    f.has_polyps = bool(polyps)
+    f.n_adenoma = n_adenoma
+    f.max_adenoma = max_adenoma
+    f.hgd_adenoma = hgd_adenoma
+    f.n_ssl = n_ssl
+    f.max_ssl = max_ssl
+    f.dysplastic_ssl = dysplastic_ssl
+    f.n_hyperplastic = n_hyperplastic
+    f.max_hyperplastic = max_hyperplastic
+    f.tva = tva
+    f.incomplete = incomplete
+    return f
+
+
+def extract_features(data: dict, procedure: int = 0) -> TriageFeatures:
+    '''
+    The feature record of one procedure of a summary (a ColonoscopySummary dump)
+    '''
+    return procedure_features(data['patient_age'], data.get('indication', ''), data['colonoscopy'][procedure])
+
+
+def _inadequate_prep(f: TriageFeatures) -> bool:
+    return f.bbps_total < 6 or f.bbps_right < 2 or f.bbps_transverse < 2 or f.bbps_left < 2
+
+
+#(rule id, follow up in years, condition on the feature record f) in priority order - the first matching rule wins
+#a follow up of 0 means the case needs human review. app/bulk.py holds the same conditions as array masks
+RULE_TABLE = [
+    #cecum_reached is a bool - None (not stated) is not a failed caecal intubation
+    ('rule_1', 0, lambda f: f.cecum is False),
+    ('rule_2', 0, _inadequate_prep),
+    ('rule_3', 0, lambda f: f.indication == 'sps'),
+    ('rule_4', 0, lambda f: f.n_adenoma >= 10),
+    ('rule_21', 0, lambda f: f.incomplete),
+    ('rule_22', 0, lambda f: f.indication == 'ibd'),
+    #high risk polyps - exempt from the usual age out check
+    ('rule_5', 3, lambda f: f.max_ssl >= 10),
+    ('rule_6', 3, lambda f: f.dysplastic_ssl),
+    ('rule_7', 3, lambda f: f.max_adenoma >= 10),
+    ('rule_8', 3, lambda f: f.tva),
+    ('rule_9', 3, lambda f: f.hgd_adenoma),
+    ('rule_10', 3, lambda f: f.n_adenoma == 0 and f.n_ssl >= 5 and f.max_ssl < 10),
+    ('rule_11', 3, lambda f: f.n_ssl == 0 and 5 <= f.n_adenoma <= 9 and f.max_adenoma < 10 and not f.hgd_adenoma),
+    ('rule_12', 3, lambda f: f.n_ssl > 0 and f.n_adenoma > 0 and 5 <= f.total_polyps <= 9),
+    ('rule_13', 3, lambda f: f.max_hyperplastic >= 10),
+    ('rule_14', 5, lambda f: f.n_ssl == 0 and 3 <= f.n_adenoma <= 4 and f.max_adenoma < 10 and not f.hgd_adenoma),
+    ('rule_15', 5, lambda f: 1 <= f.n_ssl <= 4 and f.max_ssl < 10 and f.n_adenoma == 0),
+    ('rule_16', 5, lambda f: f.n_ssl > 0 and f.total_polyps <= 4 and f.max_ssl < 10 and f.max_adenoma < 10),
+    ('rule_17', 10, lambda f: f.n_ssl == 0 and 0 < f.n_adenoma < 3 and f.max_adenoma < 10 and not f.hgd_adenoma),
+    ('rule_18', 10, lambda f: f.n_ssl == 0 and f.n_adenoma == 0),
+    ('rule_23', 20, lambda f: not f.has_polyps and f.indication in FAMILY_HISTORY_DISCHARGE),
+]
+FALLBACK_RULE = ('rule_19', 0)
+AGE_OUT_RULE = ('rule_20', 20)
+#summaries the LLM could not produce (functions.empty_summary) go to human review before any rule is checked
+EXTRACTION_FAILED_RULE = ('rule_24', 0)
+
+
+def _outcome(rule: str, follow_up: int) -> dict:
+    return {'follow_up': follow_up, 'rule': rule, 'reason': rules_dict[rule]}
+
+
+_RULES = tuple((condition, _outcome(rule, follow_up)) for rule, follow_up, condition in RULE_TABLE)
+_FALLBACK = _outcome(*FALLBACK_RULE)
+_AGED_OUT = _outcome(*AGE_OUT_RULE)
+_EXTRACTION_FAILED = _outcome(*EXTRACTION_FAILED_RULE)
+
+
+def evaluate(f: TriageFeatures) -> dict:
+    '''
+    The outcome of the first rule in RULE_TABLE whose condition holds for f
+    '''
+    for condition, outcome in _RULES:
+        if condition(f):
+            return outcome.copy()
+    return _FALLBACK.copy()
+
+
+def extraction_failed_outcome() -> dict:
+    return _EXTRACTION_FAILED.copy()
+
+
+def extraction_failed(data: dict) -> bool:
+    return not data.get('extraction_successful', True) or not data['colonoscopy']
+
+
+def apply_age_out(patient_age: int, outcome: dict) -> dict:
+    follow_up = outcome['follow_up']
+    if outcome['rule'] in HIGH_RISK_RULES and patient_age <= AGE_OUT_LIMIT:
+        return outcome
+    if follow_up is not None and follow_up != 0 and follow_up + patient_age > AGE_OUT_LIMIT:
+        return _AGED_OUT.copy()
+    return outcome
+
+
+def most_conservative(outcomes) -> dict:
+    '''
+    Combines the outcomes of the procedures in a patient's history. Human review (a follow up of 0) sorts
+    first, then the shortest follow up; on a tie the earlier outcome is kept
+    '''
+    return min(outcomes, key = lambda outcome: outcome['follow_up'])
+
+
+#reports are from New Zealand, so numeric dates are day first. The prompt asks for YYYY-MM-DD
+DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%y', '%d %B %Y', '%d %b %Y', '%B %d, %Y', '%b %d, %Y')
+
+
+@functools.lru_cache(maxsize = 4096)
+def _parse_date(value: str) -> str | None:
+    try:
+        return datetime.date.fromisoformat(value).isoformat()
+    except ValueError:
+        pass
+    value = ' '.join(value.split()).rstrip('.')
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            pass
+    return None
+
+
+def normalize_date(value) -> str | None:
+    '''
+    A procedure date as YYYY-MM-DD, or None when there is none or it can't be read
+    '''
+    if not value or not isinstance(value, str):
+        return None
+    return _parse_date(value)
+
+
+def combine_history(procedures) -> tuple:
+    '''
+    (outcome, date it counts from) for a patient's history, given as (date, outcome) pairs. A later colonoscopy
+    supersedes the findings of an earlier one, so the most recent dated procedure sets the follow up and
+    older ones are left out - an old review or 3 year outcome no longer decides today's recommendation.
+    Procedures on that date, and undated ones that can't be placed in time, are combined with most_conservative.
+    Every path that combines procedures (a report with several, a patient's stored history, bulk) uses this
+    '''
+    procedures = [(normalize_date(date), outcome) for date, outcome in procedures]
+    #YYYY-MM-DD sorts in date order
+    latest = max((date for date, _ in procedures if date is not None), default = None)
+    outcome = most_conservative([outcome for date, outcome in procedures if date is None or date == latest])
+    return outcome, latest
+
+
+def triage(data: dict) -> dict:
+    if extraction_failed(data):
+        return _EXTRACTION_FAILED.copy()
+    outcomes = [(colonoscopy.get('date'), evaluate(extract_features(data, i))) for i, colonoscopy in enumerate(data['colonoscopy'])]
+    return combine_history(outcomes)[0]
+
+
+def triage_with_age_out(data: dict) -> dict:
+    #age out only looks at the patient, so it is applied once to the combined outcome
+    return apply_age_out(data['patient_age'], triage(data))
+
+
+def triage_many(summaries) -> list:
+    return [triage_with_age_out(data) for data in summaries]
@@ -0,0 +1,68 @@
+'''
+Random but schema-valid ColonoscopySummary data for tests, benchmarks and the mock LLM server.
+The distributions are chosen to exercise every branch of the triage rules, not to look like real traffic
+'''
+import random
+from typing import get_args
+
+from app.models.colonoscopy import BostonBowelPrepScore, Colonoscopy, ColonoscopySummary, Polyp
+
+
+def _literal_values(model, field: str) -> list:
+    annotation = model.model_fields[field].annotation
+    values = []
+    for arg in get_args(annotation):
+        values.extend(v for v in get_args(arg) if v is not None)
+    return values or list(get_args(annotation))
+
+
+LOCATIONS = _literal_values(Polyp, 'location')
+POLYP_TYPES = _literal_values(Polyp, 'type')
+DYSPLASIA = _literal_values(Polyp, 'dysplasia')
+RESECTION = _literal_values(Polyp, 'resection')
+RETRIEVAL = _literal_values(Polyp, 'retrieval')
+INDICATIONS = _literal_values(ColonoscopySummary, 'indication')
+
+
+def random_polyp(rng: random.Random) -> Polyp:
+    return Polyp(
+        location = rng.choice(LOCATIONS),
+        size = rng.randint(10, 30) if rng.random() < 0.1 else rng.randint(1, 9),
+        type = rng.choices(POLYP_TYPES, weights = [12, 1, 6, 4, 2])[0],
+        dysplasia = rng.choices(DYSPLASIA, weights = [10, 20, 1])[0],
+        resection = 'complete' if rng.random() < 0.98 else rng.choice(RESECTION),
+        retrieval = 'complete' if rng.random() < 0.98 else rng.choice(RETRIEVAL),
+    )
+
+
+def random_bbps(rng: random.Random) -> BostonBowelPrepScore:
+    right, transverse, left = (rng.choices([0, 1, 2, 3], weights = [1, 1, 6, 60])[0] for _ in range(3))
+    return BostonBowelPrepScore(total = right + transverse + left, right = right, transverse = transverse, left = left)
+
+
+def random_colonoscopy(rng: random.Random) -> Colonoscopy:
+    n_polyps = rng.choices([0, rng.randint(1, 4), rng.randint(5, 9), rng.randint(10, 14)], weights = [3, 5, 2, 1])[0]
+    polyps = [random_polyp(rng) for _ in range(n_polyps)]
+    return Colonoscopy(
+        date = f'{rng.randint(2015, 2026)}-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}',
+        number_of_polyps = n_polyps,
+        cecum_reached = rng.random() < 0.95,
+        bostonBowelPrepScore = random_bbps(rng),
+        polyps = polyps,
+    )
+
+
+def random_summary(rng: random.Random, n_colonoscopies: int = 1) -> ColonoscopySummary:
+    return ColonoscopySummary(
+        patient_name = f'patient {rng.randint(0, 10**6)}',
+        patient_NHI = f"{''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ') for _ in range(3))}{rng.randint(0, 9999):04}",
+        patient_age = rng.randint(30, 85),
+        indication = rng.choices([rng.choice(INDICATIONS), 'screening'], weights = [1, 2])[0],
+        colonoscopy = [random_colonoscopy(rng) for _ in range(n_colonoscopies)],
+    )
+
+
+def random_summaries(n: int, seed: int = 0, max_colonoscopies: int = 1) -> list:
+    rng = random.Random(seed)
+    #only draw a history length when asked for one, so single procedure data stays the same for a given seed
+    return [random_summary(rng, rng.randint(1, max_colonoscopies) if max_colonoscopies > 1 else 1) for _ in range(n)]
@@ -0,0 +1,71 @@
+#throughput of pseudonymizing identifiers - the original per-call hmac.new against app.deidentify.Pseudonymizer
+#run from the repo root: python -m benchmarks.bench_pseudonymize
+
+import os
+import hmac
+import json
+import time
+import base64
+import random
+import hashlib
+import tempfile
+
+from app.deidentify import Pseudonymizer, deidentify_file
+
+N_IDENTIFIERS = 1_000_000
+N_PATIENTS = 50_000
+N_RECORDS = 100_000
+
+
+def reference(identifier: str, key: bytes, length: int = 20) -> str:
+    #functions.pseudonymize before it used a Pseudonymizer
+    h = hmac.new(key, identifier.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b32encode(h).decode('ascii')[:length]
+
+
+def per_second(fn, n: int) -> float:
+    start = time.perf_counter()
+    fn()
+    return n / (time.perf_counter() - start)
+
+
+def random_nhi(rng: random.Random) -> str:
+    return f"{''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ') for _ in range(3))}{rng.randint(0, 9999):04}"
+
+
+def main():
+    rng = random.Random(0)
+    key = os.urandom(32)
+    #audit exports see the same patients many times over
+    patients = [random_nhi(rng) for _ in range(N_PATIENTS)]
+    identifiers = [rng.choice(patients) for _ in range(N_IDENTIFIERS)]
+
+    plain = Pseudonymizer(key)
+    cached = Pseudonymizer(key, cache_size = N_PATIENTS)
+    assert [reference(i, key) for i in identifiers[:1000]] == list(plain.pseudonymize_many(identifiers[:1000]))
+
+    baseline = per_second(lambda: [reference(i, key) for i in identifiers], N_IDENTIFIERS)
+    print(f'hmac.new per call:        {baseline:>12,.0f} identifiers/s')
+    for name, fn in [
+        ('keyed context copy', lambda: list(plain.pseudonymize_many(identifiers))),
+        ('copy + LRU cache', lambda: list(cached.pseudonymize_many(identifiers))),
+        ('pseudonymize_column', lambda: plain.pseudonymize_column(identifiers)),
+    ]:
+        rate = per_second(fn, N_IDENTIFIERS)
+        print(f'{name + ":":<25} {rate:>12,.0f} identifiers/s ({rate / baseline:.2f}x)')
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'audit.log')
+        with open(path, 'w', encoding = 'utf-8') as f:
+            for _ in range(N_RECORDS):
+                nhi = rng.choice(patients)
+                record = {'timestamp': 'now', 'level': 'INFO', 'message': 'User input received and recommendation generated',
+                          'extra': {'user_input': f'Patient NHI {nhi}. Caecum reached, no polyps.',
+                                    'json_summary': {'patient_NHI': nhi, 'patient_name': 'Jane Doe'}}}
+                f.write(json.dumps(record) + '\n')
+        rate = per_second(lambda: deidentify_file(path, pseudonymizer = Pseudonymizer(key, cache_size = N_PATIENTS)), N_RECORDS)
+        print(f'audit log in place:       {rate:>12,.0f} records/s')
+
+
+if __name__ == '__main__':
+    main()
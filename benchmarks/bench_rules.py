@@ -0,0 +1,41 @@
+#throughput of the rules engine and the vectorized bulk path against functions.triage + age_out
+#run from the repo root: python -m benchmarks.bench_rules
+
+import time
+
+from app import bulk, functions, rules
+from app.synthetic import random_summaries
+
+N_SUMMARIES = 100_000
+
+
+def per_second(fn, summaries) -> float:
+    start = time.perf_counter()
+    fn(summaries)
+    return len(summaries) / (time.perf_counter() - start)
+
+
+def reference(summaries):
+    return [functions.age_out(data, functions.triage(data)) for data in summaries]
+
+
+def main():
+    models = random_summaries(N_SUMMARIES, seed = 0)
+    summaries = [s.model_dump() for s in models]
+    #a consistency check of the model and dump paths, which share RULE_TABLE - tests/test_rules.py GOLDEN pins the outcomes
+    assert reference(models[:10_000]) == rules.triage_many(summaries[:10_000])
+
+    baseline = per_second(reference, models)
+    engine = per_second(rules.triage_many, summaries)
+    print(f'triage + age_out:     {baseline:>12,.0f} summaries/s')
+    print(f'rules.triage_many:    {engine:>12,.0f} summaries/s ({engine / baseline:.2f}x)')
+
+    columns = bulk.SummaryColumns(summaries)
+    vectorized = per_second(bulk.triage_with_age_out, columns)
+    end_to_end = per_second(bulk.triage_with_age_out, summaries)
+    print(f'bulk (columns built): {vectorized:>12,.0f} summaries/s ({vectorized / baseline:.2f}x)')
+    print(f'bulk (incl. loading): {end_to_end:>12,.0f} summaries/s ({end_to_end / baseline:.2f}x)')
+
+
+if __name__ == '__main__':
+    main()
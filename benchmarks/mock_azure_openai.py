@@ -0,0 +1,246 @@
+#local stand-in for the Azure OpenAI Responses API, for load testing the service offline
+#run from the repo root:
+#   python -m benchmarks.mock_azure_openai --port 9000 --latency 0.8 --jitter 0.3 --rate-limit-rps 20 --malformed 0.02 --drift 0.05
+#then point the service at it:
+#   HNZ_ENDPOINT=http://127.0.0.1:9000 HNZ_API_KEY=mock uvicorn app.main:app
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from dataclasses import dataclass
+from pathlib import Path
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+from app.cache import normalize_report_text
+from app.models.colonoscopy import ColonoscopySummary
+from app.synthetic import random_summary
+
+
+@dataclass
+class MockSettings:
+    latency: float = 0.0
+    jitter: float = 0.0
+    #fraction of requests answered with a 429 regardless of load
+    rate_limit_fraction: float = 0.0
+    #requests per second allowed before 429s start, 0 means unlimited
+    rate_limit_rps: float = 0.0
+    retry_after: float = 1.0
+    #fraction of responses whose output text is not a valid ColonoscopySummary
+    malformed_fraction: float = 0.0
+    #fraction of the rest whose output misses the schema in ways app.repair fixes
+    drift_fraction: float = 0.0
+    fixtures: Path | None = None
+    seed: int | None = None
+
+
+class FixtureStore:
+    '''
+    Recorded extractions to replay. A JSONL file where each line is a ColonoscopySummary, a
+    {"report": ..., "summary": ...} pair or an audit log record from routes.recommend (app.log works as is).
+    A request whose report matches a recorded one gets that summary back, anything else gets the next one in turn
+    '''
+    def __init__(self, path: Path):
+        self.by_report = {}
+        summaries = []
+        with open(path, 'r', encoding = 'utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                report = None
+                if 'extra' in record and 'json_summary' in record['extra']:
+                    report = record['extra'].get('user_input')
+                    record = record['extra']['json_summary']
+                elif 'summary' in record:
+                    report = record.get('report')
+                    record = record['summary']
+                summary = ColonoscopySummary.model_validate(record).model_dump_json()
+                summaries.append(summary)
+                if report:
+                    self.by_report[normalize_report_text(report)] = summary
+        if not summaries:
+            raise ValueError(f'No fixtures found in {path}')
+        self._cycle = itertools.cycle(summaries)
+
+    def lookup(self, user_content: str) -> str:
+        #format_query_json sends 'Please format this medical text ... - {report}'
+        for candidate in (user_content, user_content.split(' - ', 1)[-1]):
+            summary = self.by_report.get(normalize_report_text(candidate))
+            if summary is not None:
+                return summary
+        return next(self._cycle)
+
+
+class TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        '''
+        0 when a request may go ahead, otherwise the seconds until one would
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+MALFORMED_OUTPUTS = (
+    #truncated json
+    lambda text: text[:len(text) // 2],
+    #valid json, wrong schema
+    lambda text: json.dumps({'patient_name': None, 'colonoscopy': 'unknown'}),
+    #prose instead of json
+    lambda text: 'I am unable to summarise this report.',
+)
+
+
+def drift(text: str) -> str:
+    #off-schema values the service repairs locally - yes/no booleans and abbreviated polyp types
+    return (text.replace('"cecum_reached":true', '"cecum_reached":"yes"').replace('"cecum_reached":false', '"cecum_reached":"no"')
+            .replace('"sessile_serrated_polyp"', '"SSL"').replace('"hyperplastic_polyp"', '"hyperplastic"'))
+
+
+def _user_content(body: dict) -> str:
+    messages = body.get('input')
+    if isinstance(messages, str):
+        return messages
+    for message in reversed(messages or []):
+        if message.get('role') == 'user':
+            content = message.get('content')
+            if isinstance(content, list):
+                return ' '.join(part.get('text', '') for part in content if isinstance(part, dict))
+            return content or ''
+    return ''
+
+
+def _error(status: int, code: str, message: str, headers: dict | None = None) -> JSONResponse:
+    return JSONResponse({'error': {'code': code, 'message': message}}, status_code = status, headers = headers)
+
+
+def create_app(settings: MockSettings) -> FastAPI:
+    rng = random.Random(settings.seed)
+    fixtures = FixtureStore(settings.fixtures) if settings.fixtures else None
+    bucket = TokenBucket(settings.rate_limit_rps) if settings.rate_limit_rps else None
+    stats = {'requests': 0, 'ok': 0, 'rate_limited': 0, 'malformed': 0, 'drifted': 0, 'in_flight': 0, 'max_in_flight': 0}
+    ids = itertools.count(1)
+
+    app = FastAPI(title = 'Mock Azure OpenAI Responses API')
+
+    async def responses(request: Request, deployment: str | None = None):
+        stats['requests'] += 1
+        body = await request.json()
+        model = deployment or body.get('model')
+        if not model or 'input' not in body:
+            return _error(400, 'invalid_request_error', 'model and input are required')
+
+        wait = bucket.take() if bucket is not None else 0.0
+        if wait or rng.random() < settings.rate_limit_fraction:
+            stats['rate_limited'] += 1
+            retry_after = max(wait, settings.retry_after)
+            return _error(429, '429', 'Rate limit exceeded (mock)', headers = {'retry-after': f'{retry_after:.3f}'})
+
+        stats['in_flight'] += 1
+        stats['max_in_flight'] = max(stats['max_in_flight'], stats['in_flight'])
+        try:
+            delay = max(0.0, rng.gauss(settings.latency, settings.jitter)) if settings.jitter else settings.latency
+            if delay:
+                await asyncio.sleep(delay)
+        finally:
+            stats['in_flight'] -= 1
+
+        user_content = _user_content(body)
+        if fixtures is not None:
+            text = fixtures.lookup(user_content)
+        else:
+            text = random_summary(rng).model_dump_json()
+        if rng.random() < settings.malformed_fraction:
+            stats['malformed'] += 1
+            text = rng.choice(MALFORMED_OUTPUTS)(text)
+        elif settings.drift_fraction and rng.random() < settings.drift_fraction:
+            stats['drifted'] += 1
+            text = drift(text)
+        stats['ok'] += 1
+
+        n = next(ids)
+        input_tokens = sum(len(str(m.get('content', ''))) for m in body['input'] if isinstance(m, dict)) // 4
+        output_tokens = len(text) // 4
+        return {
+            'id': f'resp_mock_{n}',
+            'object': 'response',
+            'created_at': int(time.time()),
+            'model': model,
+            'status': 'completed',
+            'output': [{
+                'type': 'message',
+                'id': f'msg_mock_{n}',
+                'role': 'assistant',
+                'status': 'completed',
+                'content': [{'type': 'output_text', 'text': text, 'annotations': []}],
+            }],
+            'parallel_tool_calls': True,
+            'tool_choice': 'auto',
+            'tools': [],
+            'usage': {
+                'input_tokens': input_tokens,
+                'output_tokens': output_tokens,
+                'total_tokens': input_tokens + output_tokens,
+                'input_tokens_details': {'cached_tokens': 0},
+                'output_tokens_details': {'reasoning_tokens': 0},
+            },
+        }
+
+    #AzureOpenAI clients post to /openai/responses, plain OpenAI clients (base_url=.../v1) to /v1/responses
+    app.add_api_route('/openai/responses', responses, methods = ['POST'])
+    app.add_api_route('/openai/deployments/{deployment}/responses', responses, methods = ['POST'])
+    app.add_api_route('/v1/responses', responses, methods = ['POST'])
+
+    @app.get('/mock/stats')
+    async def get_stats():
+        return stats
+
+    return app
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Serve a local mock of the Azure OpenAI Responses API')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 9000)
+    parser.add_argument('--latency', type = float, default = 0.5, help = 'mean seconds before each response')
+    parser.add_argument('--jitter', type = float, default = 0.0, help = 'standard deviation of the latency')
+    parser.add_argument('--rate-limit', type = float, default = 0.0, help = 'fraction of requests answered with a 429')
+    parser.add_argument('--rate-limit-rps', type = float, default = 0.0, help = 'requests per second before 429s (0 = unlimited)')
+    parser.add_argument('--retry-after', type = float, default = 1.0, help = 'Retry-After seconds sent with 429s')
+    parser.add_argument('--malformed', type = float, default = 0.0, help = 'fraction of responses with invalid output')
+    parser.add_argument('--drift', type = float, default = 0.0, help = 'fraction of responses with off-schema values that can be repaired locally')
+    parser.add_argument('--fixtures', type = Path, help = 'JSONL of recorded summaries to replay instead of synthetic ones')
+    parser.add_argument('--seed', type = int)
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    settings = MockSettings(
+        latency = args.latency,
+        jitter = args.jitter,
+        rate_limit_fraction = args.rate_limit,
+        rate_limit_rps = args.rate_limit_rps,
+        retry_after = args.retry_after,
+        malformed_fraction = args.malformed,
+        drift_fraction = args.drift,
+        fixtures = args.fixtures,
+        seed = args.seed,
+    )
+    uvicorn.run(create_app(settings), host = args.host, port = args.port, log_level = 'warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+#reproducible benchmark suite for the triage pipeline, results are written as JSON per commit
+#run from the repo root:
+#   python -m benchmarks.run                       -> benchmarks/results/<git sha>.json
+#   python -m benchmarks.run --llm-delay 0.2 --requests 1000 --concurrency 32
+#   python -m benchmarks.run compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import statistics
+import subprocess
+from contextlib import redirect_stderr
+from datetime import datetime, timezone
+from pathlib import Path
+
+#a benchmark must never hit the extraction cache or write into the real audit log
+os.environ['EXTRACTION_CACHE_ENABLED'] = 'false'
+os.environ.setdefault('LOG_FILE', os.devnull)
+os.environ.setdefault('JOB_QUEUE_PATH', ':memory:')
+
+import httpx
+from openai import AsyncAzureOpenAI
+
+from app import functions, rules
+from app.clients import ResilientClient
+from app.models.colonoscopy import ColonoscopySummary
+from app.synthetic import random_summaries
+from benchmarks.stub_llm import StubLLMClient
+
+RESULTS_PATH = Path(__file__).parent / 'results'
+
+#metrics where a lower value is better, everything else is a throughput
+LOWER_IS_BETTER = ('seconds', 'latency')
+
+
+def git_sha() -> str:
+    try:
+        sha = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output = True, text = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f'{sha}-dirty' if dirty else sha
+
+
+def best_rate(fn, n_items: int, repeat: int) -> float:
+    '''
+    Items per second of the fastest of repeat runs - the minimum is the least noisy estimate on a shared machine
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return n_items / min(timings)
+
+
+def bench_rules(summaries: list, repeat: int) -> dict:
+    n = len(summaries)
+    #the request path hands functions.triage a ColonoscopySummary, the rules engine works on stored dicts
+    models = [ColonoscopySummary.model_validate(s) for s in summaries]
+    return {
+        'triage_per_second': best_rate(lambda: [functions.triage(m) for m in models], n, repeat),
+        'triage_age_out_per_second': best_rate(
+            lambda: [functions.age_out(m, functions.triage(m)) for m in models], n, repeat),
+        'rules_triage_many_per_second': best_rate(lambda: rules.triage_many(summaries), n, repeat),
+    }
+
+
+def bench_models(summaries: list, repeat: int) -> dict:
+    n = len(summaries)
+    models = [ColonoscopySummary.model_validate(s) for s in summaries]
+    payloads = [json.dumps(s) for s in summaries]
+    return {
+        'model_validate_per_second': best_rate(lambda: [ColonoscopySummary.model_validate(s) for s in summaries], n, repeat),
+        'model_validate_json_per_second': best_rate(
+            lambda: [ColonoscopySummary.model_validate_json(p) for p in payloads], n, repeat),
+        'model_dump_per_second': best_rate(lambda: [m.model_dump() for m in models], n, repeat),
+    }
+
+
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+async def bench_endpoint(n_requests: int, concurrency: int, llm_delay: float, llm_url: str | None = None) -> dict:
+    '''
+    Drives POST /triage in-process through the ASGI app, with the LLM deployments swapped for a stub that
+    answers after llm_delay seconds, or for an AzureOpenAI client pointed at llm_url (see mock_azure_openai).
+    Everything else - routing, caching checks, triage, audit logging - is real
+    '''
+    from app.main import app
+    from app.llm_router import Deployment, extraction_router
+
+    if llm_url:
+        llm = ResilientClient.from_env(AsyncAzureOpenAI(api_version = os.getenv('HNZ_API_VERSION', '2025-03-01-preview'),
+                                                        api_key = 'mock', azure_endpoint = llm_url, max_retries = 0), 'mock')
+    else:
+        llm = StubLLMClient(delay = llm_delay)
+    saved = extraction_router.deployments
+    extraction_router.deployments = [Deployment('stub', llm, 'stub-model')]
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app = app)
+    try:
+        #the console log handler binds to stderr when the lifespan starts, keep the audit records off the terminal
+        with open(os.devnull, 'w') as devnull, redirect_stderr(devnull):
+            async with app.router.lifespan_context(app):
+                async with httpx.AsyncClient(transport = transport, base_url = 'http://bench') as client:
+
+                    async def one(i: int):
+                        async with semaphore:
+                            start = time.perf_counter()
+                            response = await client.post('/triage', json = {'user_query': f'benchmark report {i}'})
+                            latencies.append(time.perf_counter() - start)
+                        response.raise_for_status()
+
+                    await one(-1)
+                    latencies.clear()
+                    start = time.perf_counter()
+                    await asyncio.gather(*(one(i) for i in range(n_requests)))
+                    wall = time.perf_counter() - start
+    finally:
+        extraction_router.deployments = saved
+
+    results = {
+        'requests_per_second': n_requests / wall,
+        'latency_p50_seconds': percentile(latencies, 50),
+        'latency_p95_seconds': percentile(latencies, 95),
+        'latency_p99_seconds': percentile(latencies, 99),
+        'latency_mean_seconds': statistics.fmean(latencies),
+    }
+    if not llm_url:
+        results['overhead_p50_seconds'] = percentile(latencies, 50) - llm_delay
+    return results
+
+
+#a fresh interpreter imports the app and runs the startup half of the lifespan, then prints app.main.startup_seconds
+STARTUP_SCRIPT = '''
+import asyncio, json
+from app.main import app, startup_seconds
+
+async def main():
+    async with app.router.lifespan_context(app):
+        pass
+
+asyncio.run(main())
+print(json.dumps(startup_seconds))
+'''
+
+
+def bench_startup(runs: int) -> dict:
+    '''
+    Cold start in a new process: interpreter start-up plus import, and the import and lifespan phases on their own.
+    Medians of runs - the first run also pays for a cold filesystem cache, which is what a fresh container sees
+    '''
+    phases = {'import': [], 'lifespan': [], 'process': []}
+    for _ in range(runs):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output = True, text = True, check = True)
+        phases['process'].append(time.perf_counter() - start)
+        timings = json.loads(completed.stdout.strip().splitlines()[-1])
+        phases['import'].append(timings['import'])
+        phases['lifespan'].append(timings['lifespan'])
+    return {f'{phase}_seconds': statistics.median(values) for phase, values in phases.items()}
+
+
+def run(args) -> dict:
+    summaries = [s.model_dump() for s in random_summaries(args.summaries, seed = args.seed)]
+    results = {
+        'rules': bench_rules(summaries, args.repeat),
+        'models': bench_models(summaries, args.repeat),
+        'endpoint': asyncio.run(bench_endpoint(args.requests, args.concurrency, args.llm_delay, args.llm_url)),
+        'startup': bench_startup(args.startup_runs),
+    }
+    return {
+        'commit': git_sha(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec = 'seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'summaries': args.summaries,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'llm_delay': args.llm_delay,
+            'llm_url': args.llm_url,
+            'startup_runs': args.startup_runs,
+        },
+        'results': results,
+    }
+
+
+def compare(old: dict, new: dict, threshold: float) -> list:
+    '''
+    Returns (metric, old, new, change) for every metric present in both runs, change > 0 meaning better
+    '''
+    rows = []
+    for group, metrics in new['results'].items():
+        for name, value in metrics.items():
+            before = old['results'].get(group, {}).get(name)
+            if not before:
+                continue
+            change = value / before - 1
+            if any(tag in name for tag in LOWER_IS_BETTER):
+                change = -change
+            rows.append((f'{group}.{name}', before, value, change, change < -threshold))
+    return rows
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the triage pipeline and write the results as JSON')
+    sub = parser.add_subparsers(dest = 'command')
+
+    parser.add_argument('--summaries', type = int, default = 20_000, help = 'synthetic summaries for the rules and model benchmarks')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--repeat', type = int, default = 5, help = 'runs per micro benchmark, the fastest is kept')
+    parser.add_argument('--requests', type = int, default = 500, help = 'POST /triage requests in the endpoint benchmark')
+    parser.add_argument('--concurrency', type = int, default = 16)
+    parser.add_argument('--llm-delay', type = float, default = 0.05, help = 'seconds the stub LLM waits before answering')
+    parser.add_argument('--llm-url', help = 'send extractions to this mock Azure OpenAI server instead of the in-process stub')
+    parser.add_argument('--startup-runs', type = int, default = 5, help = 'fresh processes started for the cold start benchmark')
+    parser.add_argument('--output', type = Path, help = 'results file (default benchmarks/results/<git sha>.json)')
+
+    compare_parser = sub.add_parser('compare', help = 'compare two results files')
+    compare_parser.add_argument('old', type = Path)
+    compare_parser.add_argument('new', type = Path)
+    compare_parser.add_argument('--threshold', type = float, default = 0.1, help = 'relative slowdown reported as a regression')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'compare':
+        old, new = json.loads(args.old.read_text()), json.loads(args.new.read_text())
+        print(f'{old["commit"]} -> {new["commit"]}')
+        regressions = 0
+        for name, before, after, change, regressed in compare(old, new, args.threshold):
+            regressions += regressed
+            print(f'{name:<45} {before:>14.4g} {after:>14.4g} {change:>+8.1%}{"  REGRESSION" if regressed else ""}')
+        return 1 if regressions else 0
+
+    report = run(args)
+    output = args.output or RESULTS_PATH / f'{report["commit"]}.json'
+    output.parent.mkdir(parents = True, exist_ok = True)
+    output.write_text(json.dumps(report, indent = 2))
+    for group, metrics in report['results'].items():
+        for name, value in metrics.items():
+            print(f'{group}.{name:<40} {value:>14.4g}')
+    print(f'Results written to {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
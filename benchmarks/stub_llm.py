@@ -0,0 +1,32 @@
+#in-process stand-in for an Azure OpenAI deployment, used to benchmark /triage without calling a model
+
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+from app.synthetic import random_summaries
+
+
+class StubResponses:
+    def __init__(self, summaries: list, delay: float):
+        self._summaries = itertools.cycle(summaries)
+        self.delay = delay
+        self.calls = 0
+
+    async def create(self, model: str, input: list, text = None, **kwargs):
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        prompt_tokens = sum(len(message['content']) for message in input) // 4
+        return SimpleNamespace(
+            output_text = next(self._summaries).model_dump_json(),
+            usage = SimpleNamespace(input_tokens = prompt_tokens, output_tokens = 300),
+        )
+
+
+class StubLLMClient:
+    '''
+    Answers responses.create after a fixed delay with the JSON of synthetic ColonoscopySummary objects
+    '''
+    def __init__(self, delay: float = 0.0, n_summaries: int = 1000, seed: int = 0):
+        self.responses = StubResponses(random_summaries(n_summaries, seed = seed), delay)
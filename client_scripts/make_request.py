@@ -1,8 +1,11 @@
 #script to send data to the api endpoint
 
 import os
-import json
-import requests
+import math
+import time
+import random
+import argparse
+import httpx
 from dotenv import load_dotenv
 import asyncio
 from pathlib import Path
@@ -14,32 +17,56 @@ load_dotenv()
 BASE = Path(__file__).parent.parent
 DATA_PATH = BASE / 'data' / 'sample_reports'
 
-n_files = len(os.listdir(DATA_PATH))
-
 
 local_url = 'http://127.0.0.1:8000/triage'
 base_url = os.getenv('AZURE_APP_ENDPOINT')
 azure_url = f'{base_url}/triage'
 
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def retry_delay(response: httpx.Response | None, attempt: int, backoff: float) -> float:
+    '''
+    Honors Retry-After when the server sends one, otherwise exponential backoff with full jitter
+    '''
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+    return random.uniform(0, backoff * 2 ** attempt)
+
 
-async def send_request(report_text: str, api_url: str):
+async def send_request(client: httpx.AsyncClient, report_text: str, api_url: str, retries: int = 3, backoff: float = 0.5):
     '''
-    Sends a free text report to the API endpoint and returns a recommendation based on the report and database contents
+    Sends a free text report to the API endpoint and returns the response body and the latency of the successful attempt.
+    429s, 5xx responses and connection errors are retried with backoff
     '''
 
     data = {'user_query': report_text}
     headers = {
-        'x-api-key': os.getenv('MY_API_KEY')
+        'x-api-key': os.getenv('MY_API_KEY', '')
     }
 
-    response = requests.post(api_url, json = data, headers = headers)
+    for attempt in range(retries + 1):
+        response = None
+        start = time.perf_counter()
+        try:
+            response = await client.post(api_url, json = data, headers = headers)
+        except httpx.TransportError as e:
+            if attempt == retries:
+                raise Exception(f'API request failed after {attempt + 1} attempts: {e!r}')
+        else:
+            elapsed = time.perf_counter() - start
+            if response.status_code == 200:
+                return response.json(), elapsed
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                raise Exception(f'API request failed with status code {response.status_code}: {response.text}')
+        await asyncio.sleep(retry_delay(response, attempt, backoff))
+
 
-    if response.status_code == 200:
-        return response.json()
-    else:
-        raise Exception(f'API request failed with status code {response.status_code}: {response.text}')
-       
-    
 def accuracy(human, model):
     year_correct = 0
     rule_correct = 0
@@ -51,6 +78,9 @@ def accuracy(human, model):
 
     for item in human:
         cid = item['case']
+        #reports whose request failed are listed separately by main, not scored
+        if cid not in model:
+            continue
         rec = model[cid]
         if item['follow_up'] == rec['follow_up']:
             year_correct += 1
@@ -60,29 +90,67 @@ def accuracy(human, model):
             rule_correct += 1
         else:
             rule_incorrect.append({'case': cid, 'human': item['rule'], 'model': rec['rule']})
-        
+
         if rec['follow_up'] == 0:
             need_human.append({'case': cid, 'model': rec['rule']})
         total += 1
-    year_accuracy = year_correct/total
-    rule_accuracy = rule_correct/total
+    year_accuracy = year_correct/total if total else 0.0
+    rule_accuracy = rule_correct/total if total else 0.0
 
     return year_accuracy, rule_accuracy, year_incorrect, rule_incorrect, need_human
 
 
-async def main():
-    #iterate through the sample reports, pull the recommendation, add it to the model_outputs dictionary 
+def percentile(values: list, p: float) -> float:
+    '''
+    Nearest-rank percentile, p between 0 and 100
+    '''
+    ordered = sorted(values)
+    rank = max(0, math.ceil(p / 100 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+async def evaluate(api_url: str, concurrency: int, retries: int, timeout: float):
+    #iterate through the sample reports concurrently, pull the recommendation, add it to the model_outputs dictionary
+    n_files = len(os.listdir(DATA_PATH))
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections = concurrency, max_keepalive_connections = concurrency)
+    latencies = []
     model_outputs = {}
-    for i in range(n_files):
-        report_path = DATA_PATH / f'sample_patient_report_{i}.txt'
-        with open(report_path, 'r', encoding = 'utf-8') as f:
-            report = f.read()
+    failures = {}
+
+    async with httpx.AsyncClient(limits = limits, timeout = timeout) as client:
 
-        output = await send_request(report, local_url)
-        recommendation = output['recommendation']
+        async def run_case(i: int):
+            report_path = DATA_PATH / f'sample_patient_report_{i}.txt'
+            report = await asyncio.to_thread(report_path.read_text, encoding = 'utf-8')
+            async with semaphore:
+                output, elapsed = await send_request(client, report, api_url, retries = retries)
+            latencies.append(elapsed)
+            model_outputs[f'{i:03}'] = output['recommendation']
+            print(f'{len(model_outputs)} report(s) processed')
+
+        start = time.perf_counter()
+        #one report that exhausts its retries must not abort the run and lose the latencies collected so far
+        results = await asyncio.gather(*(run_case(i) for i in range(n_files)), return_exceptions = True)
+        wall = time.perf_counter() - start
+
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            failures[f'{i:03}'] = str(result)
+    return model_outputs, latencies, wall, failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description = 'Evaluate the triage API against the human labels')
+    parser.add_argument('--url', default = local_url, help = f'triage endpoint (default {local_url})')
+    parser.add_argument('--azure', action = 'store_true', help = 'use the AZURE_APP_ENDPOINT deployment instead of --url')
+    parser.add_argument('--concurrency', type = int, default = 8, help = 'requests in flight at once')
+    parser.add_argument('--retries', type = int, default = 3, help = 'retries on 429, 5xx and connection errors')
+    parser.add_argument('--timeout', type = float, default = 120.0, help = 'per-request timeout in seconds')
+    args = parser.parse_args()
 
-        model_outputs[f'{i:03}'] = recommendation
-        print(f'{i+1} report(s) processed')
+    api_url = azure_url if args.azure else args.url
+    model_outputs, latencies, wall, failures = await evaluate(api_url, args.concurrency, args.retries, args.timeout)
 
     year, rule, y_incorrect, r_incorrect, need_human = accuracy(HUMAN_LABELS, model_outputs)
 
@@ -90,8 +158,13 @@ async def main():
     print(f'Incorrect year cases: \n {y_incorrect}\n')
     print(f'Incorrect rule cases: \n {r_incorrect}\n')
     print(f'These were identified as needing human review:\n {need_human}')
+    if failures:
+        print(f'{len(failures)} request(s) failed and were not scored:\n {dict(sorted(failures.items()))}\n')
+    if latencies:
+        print(f'Latency p50: {percentile(latencies, 50):.2f}s | p95: {percentile(latencies, 95):.2f}s | '
+              f'throughput: {len(latencies) / wall:.2f} reports/s over {wall:.1f}s at concurrency {args.concurrency}')
 
-    print(model_outputs)
+    print(dict(sorted(model_outputs.items())))
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,56 @@
+#checks the regex fast path against the sample reports and the human labels
+#run from the repo root: python -m client_scripts.validate_fast_extract
+
+import sys
+import argparse
+from pathlib import Path
+
+from client_scripts.human_key import HUMAN_LABELS
+from app import functions
+
+BASE = Path(__file__).parent.parent
+DATA_PATH = BASE / 'data' / 'sample_reports'
+
+
+def validate(data_path: Path):
+    labels = {item['case']: item for item in HUMAN_LABELS}
+    reports = sorted(data_path.glob('sample_patient_report_*.txt'))
+    fast = []
+    disagreements = []
+
+    for path in reports:
+        case = f"{int(path.stem.rsplit('_', 1)[1]):03}"
+        text = functions.prepare_report(path.read_text(encoding = 'utf-8'))
+        summary = functions.fast_extractor.extract(text)
+        if summary is None:
+            continue
+        outcome = functions.age_out(summary, functions.triage(summary))
+        fast.append(case)
+        human = labels.get(case)
+        if human is not None and (human['follow_up'], human['rule']) != (outcome['follow_up'], outcome['rule']):
+            disagreements.append({'case': case, 'human': human['rule'], 'fast_path': outcome['rule']})
+
+    return reports, fast, disagreements
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Validate the regex fast path against the human labels')
+    parser.add_argument('--data', type = Path, default = DATA_PATH, help = f'directory of sample reports (default {DATA_PATH})')
+    args = parser.parse_args(argv)
+
+    if not args.data.is_dir():
+        print(f'No sample reports found at {args.data}')
+        return 1
+
+    functions.fast_extractor.enabled = True
+    reports, fast, disagreements = validate(args.data)
+    print(f'Fast path taken for {len(fast)} of {len(reports)} reports ({len(fast) / max(len(reports), 1):.0%}): {fast}')
+    if disagreements:
+        print(f'Disagreements with the human labels:\n {disagreements}')
+        return 1
+    print('All fast path outcomes match the human labels')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+#production server profile - gunicorn managing uvicorn workers:
+#   gunicorn -c gunicorn.conf.py app.main:app
+#for local development with auto-reload use uvicorn app.main:app --reload (compose.local.yaml does)
+import os
+import multiprocessing
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+#each worker holds its own LLM clients, caches and job queue workers; the job queue is shared through SQLite
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+#the app divides LLM_RPM_LIMIT/LLM_TPM_LIMIT between the workers (clients.worker_count), so it needs the real count
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = 'uvicorn_worker.UvicornWorker'
+
+#import the app, build the clients and parse the prompts once in the master, the forked workers share it copy-on-write
+preload_app = True
+
+#extraction can wait on the LLM for a long time, don't kill a worker that is only waiting
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+#set these to recycle workers after a number of requests, the jitter staggers the restarts (0 = never)
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '0'))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def when_ready(server):
+    #runs in the master before the workers are forked - load the tokenizer here so every worker shares it
+    from app.preprocess import get_encoding
+    get_encoding()
+
+
+def pre_fork(server, worker):
+    #give each worker the lowest free slot, a replacement takes over the slot (and log file) of the worker it replaces
+    used = {getattr(w, 'slot', None) for w in server.WORKERS.values()}
+    worker.slot = min(slot for slot in range(len(used) + 1) if slot not in used)
+
+
+def post_fork(server, worker):
+    #each worker writes its own audit log, see logging_config.log_file
+    os.environ['WORKER_SLOT'] = str(worker.slot)
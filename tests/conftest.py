@@ -1,7 +1,12 @@
+import os
 import pytest
 
 from fastapi.testclient import TestClient
 
+#jobs left over from an earlier run would otherwise be picked up by the test client's workers
+os.environ.setdefault('JOB_QUEUE_PATH', ':memory:')
+os.environ.setdefault('PATIENT_HISTORY_PATH', ':memory:')
+
 from app.main import app
 
 from app import functions
@@ -9,7 +9,7 @@ def test_extract_structured_data_and_age_out(client, test_case1):
     fake = {'user_query': 'test text'}
 
     with patch("app.functions.format_query_json", new_callable=AsyncMock) as mock_return:
-        mock_return.return_value = test_case1.model_dump()
+        mock_return.return_value = test_case1
         response = client.post("/triage", json = fake)
     assert mock_return.called
     assert response.status_code == 200
@@ -23,8 +23,7 @@ def test_extract_structured_data_and_age_out(client, test_case1):
 
 def test_no_age_out(client, test_case1):
     fake = {'user_query': 'test text'}
-    test_case = test_case1.model_dump()
-    test_case['patient_age'] = 50
+    test_case = test_case1.model_copy(update = {'patient_age': 50})
     with patch("app.functions.format_query_json", new_callable=AsyncMock) as mock_return:
         mock_return.return_value = test_case
         response = client.post("/triage", json = fake)
@@ -35,14 +34,102 @@ def test_no_age_out(client, test_case1):
 
 def test_high_grade_adenoma(client, test_case1):
     fake = {'user_query': 'test text'}
-    test_case = test_case1.model_dump()
+    test_case = test_case1.model_copy(deep = True)
 
-    test_case['colonoscopy'][0]['polyps'][0]['dysplasia'] = 'high_grade'
-    test_case['patient_age'] = 50
+    test_case.colonoscopy[0].polyps[0].dysplasia = 'high_grade'
+    test_case.patient_age = 50
 
     with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
         mock_return.return_value = test_case
         response = client.post("/triage", json = fake)
     data = response.json()
     
-    assert data['recommendation']['follow_up'] == 3
\ No newline at end of file
+    assert data['recommendation']['follow_up'] == 3
+
+def test_batch_reports_per_item_errors(client, test_case1):
+    fake = {'user_queries': ['report one', 'report two', 'report three']}
+    test_case = test_case1.model_copy(update = {'patient_age': 50})
+
+    with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
+        mock_return.side_effect = [test_case, RuntimeError('upstream timeout'), test_case1]
+        response = client.post("/triage/batch", json = fake)
+    assert mock_return.call_count == 3
+    assert response.status_code == 200
+
+    results = response.json()['results']
+    assert [r['index'] for r in results] == [0, 1, 2]
+    assert results[0]['recommendation']['follow_up'] == 10
+    assert results[1]['error'] is not None
+    assert results[2]['recommendation']['follow_up'] == 20
+
+
+def test_failed_extraction_goes_to_human_review(client):
+    with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
+        mock_return.return_value = functions.empty_summary()
+        response = client.post("/triage", json = {'user_query': 'test text'})
+    assert response.status_code == 200
+    data = response.json()
+    assert data['user_input']['extraction_successful'] is False
+    assert data['recommendation'] == {'follow_up': 0, 'rule': 'rule_24', 'reason': 'Extraction failed, needs human review'}
+
+
+def test_ner_model_not_loaded_unless_redaction_used(client):
+    import sys
+    assert functions.PII_REDACTION_ENABLED is False
+    assert functions._ner is None
+    assert 'transformers' not in sys.modules
+
+
+def test_stream_returns_ndjson_in_completion_order(client, test_case1):
+    import asyncio
+    import json
+
+    async def extract(user_query):
+        #the first report is the slowest, so it should come back last
+        await asyncio.sleep(0.2 if user_query == 'slow' else 0)
+        return test_case1.model_copy(update = {'patient_age': 50})
+
+    body = '\n'.join([
+        json.dumps({'user_query': 'slow', 'id': 'a'}),
+        json.dumps('fast'),
+        '',
+        'not json',
+        json.dumps({'user_query': 'fast again', 'id': 7}),
+    ])
+    with patch("app.functions.format_query_json", new = extract):
+        response = client.post("/triage/stream", content = body, headers = {'content-type': 'application/x-ndjson'})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('application/x-ndjson')
+
+    items = [json.loads(line) for line in response.text.splitlines()]
+    by_index = {item['index']: item for item in items}
+    assert sorted(by_index) == [0, 1, 3, 4]
+    assert items[-1]['index'] == 0 and items[-1]['id'] == 'a'
+    assert by_index[1]['recommendation']['follow_up'] == 10
+    assert by_index[3]['error'].startswith('Invalid input line')
+    assert by_index[4]['id'] == '7'
+
+
+def test_stream_accepts_multipart_upload(client, test_case1):
+    import json
+
+    lines = '\n'.join(json.dumps({'user_query': f'report {i}'}) for i in range(20))
+    with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
+        mock_return.return_value = test_case1
+        response = client.post("/triage/stream", files = {'file': ('reports.ndjson', lines, 'application/x-ndjson')})
+    assert response.status_code == 200
+    items = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(item['index'] for item in items) == list(range(20))
+    assert mock_return.call_count == 20
+
+
+def test_retryable_extraction_failure_is_503(client):
+    from app.clients import RetryableError
+
+    with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
+        mock_return.side_effect = RetryableError('hnz: RateLimitError after 5 attempt(s)', retry_after = 2.2)
+        response = client.post("/triage", json = {'user_query': 'test text'})
+        batch = client.post("/triage/batch", json = {'user_queries': ['one']})
+    assert response.status_code == 503
+    assert response.headers['retry-after'] == '3'
+    assert batch.json()['results'][0]['retryable'] is True
@@ -0,0 +1,81 @@
+import json
+
+from app import bulk, functions, rules
+from app.synthetic import random_summaries
+
+
+def test_bulk_matches_scalar_triage_with_age_out():
+    summaries = [s.model_dump() for s in random_summaries(5000, seed = 2)]
+    result = bulk.triage_with_age_out(summaries)
+    assert result.valid.all()
+    for i, data in enumerate(summaries):
+        assert result.outcome(i) == functions.age_out(data, functions.triage(data))
+
+
+def test_every_rule_has_a_vectorized_form():
+    assert list(bulk.VECTOR_RULES) == [rule for rule, _, _ in rules.RULE_TABLE]
+
+
+def test_bulk_flags_cases_the_rules_cannot_evaluate(test_case1):
+    complete = test_case1.model_dump()
+    failed = functions.empty_summary().model_dump()
+    no_size = test_case1.model_dump()
+    no_size['colonoscopy'][0]['polyps'][0]['size'] = None
+
+    result = bulk.triage_with_age_out([complete, failed, no_size])
+    assert result.outcome(0) == functions.age_out(complete, functions.triage(complete))
+    assert result.outcome(1) == functions.age_out(failed, functions.triage(failed))
+    assert result.outcome(1)['rule'] == 'rule_24'
+    assert result.outcome(2) is None
+    assert result.counts()['invalid'] == 1
+
+
+def scalar_outcome(data):
+    try:
+        return functions.age_out(data, functions.triage(data))
+    except (TypeError, AttributeError):
+        #bulk reports the cases the scalar rules raise on as invalid
+        return None
+
+
+def test_bulk_matches_scalar_on_failed_and_incomplete_histories():
+    summaries = [s.model_dump() for s in random_summaries(3000, seed = 4, max_colonoscopies = 3)]
+    for i, data in enumerate(summaries):
+        colonoscopy = data['colonoscopy'][-1]
+        if i % 7 == 0:
+            summaries[i] = functions.empty_summary().model_dump()
+        elif i % 11 == 0:
+            data['extraction_successful'] = False
+        elif i % 13 == 0 and colonoscopy['polyps']:
+            colonoscopy['polyps'][0]['size'] = None
+        elif i % 17 == 0:
+            colonoscopy['bostonBowelPrepScore'] = None
+        elif i % 19 == 0:
+            colonoscopy['bostonBowelPrepScore']['left'] = None
+
+    result = bulk.triage_with_age_out(summaries)
+    expected = [scalar_outcome(data) for data in summaries]
+    assert result.outcomes() == expected
+    assert result.counts()['rule_24'] == sum(i % 7 == 0 or i % 11 == 0 for i in range(len(summaries)))
+    assert result.counts()['invalid'] > 0
+
+
+def test_bulk_cli_reads_audit_log_records(tmp_path, test_case1):
+    data = test_case1.model_dump()
+    data['patient_age'] = 50
+    lines = [
+        json.dumps(data),
+        'not json',
+        json.dumps({'timestamp': 'now', 'level': 'INFO', 'extra': {'json_summary': data}}),
+    ]
+    source = tmp_path / 'summaries.jsonl'
+    source.write_text('\n'.join(lines), encoding = 'utf-8')
+    output = tmp_path / 'outcomes.jsonl'
+
+    bulk.main([str(source), '-o', str(output)])
+
+    rows = [json.loads(line) for line in output.read_text(encoding = 'utf-8').splitlines()]
+    assert rows[0] == {'line': 1, 'follow_up': 10, 'rule': 'rule_17', 'reason': '1-2 adenomas less than 10mm no hgd'}
+    #unreadable lines keep their place in the output
+    assert rows[1]['line'] == 2 and 'error' in rows[1]
+    assert rows[2]['line'] == 3 and rows[2]['rule'] == 'rule_17'
@@ -0,0 +1,80 @@
+import pytest
+
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from app import functions
+from app.cache import ExtractionCache, prompt_fingerprint
+
+
+@pytest.fixture(scope = 'function')
+def cache(tmp_path):
+    c = ExtractionCache(str(tmp_path / 'cache.sqlite3'), ttl_seconds = 60, max_entries = 2)
+    yield c
+    c.close()
+
+
+def test_cache_hit_and_miss_ignores_whitespace(cache):
+    prompt_id = prompt_fingerprint('2.2', 'system prompt')
+    key = cache.make_key('Polyp  3mm\n adenoma', prompt_id, 'deployment')
+    assert cache.get(key) is None
+
+    cache.set(key, {'patient_age': 50}, prompt_id)
+    same_report = cache.make_key('Polyp 3mm adenoma ', prompt_id, 'deployment')
+    assert cache.get(same_report) == {'patient_age': 50}
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+
+
+def test_cache_key_depends_on_prompt_and_deployment(cache):
+    prompt_id = prompt_fingerprint('2.2', 'system prompt')
+    key = cache.make_key('report', prompt_id, 'deployment')
+    assert key != cache.make_key('report', prompt_fingerprint('2.3', 'system prompt'), 'deployment')
+    assert key != cache.make_key('report', prompt_fingerprint('2.2', 'edited prompt'), 'deployment')
+    assert key != cache.make_key('report', prompt_id, 'other-deployment')
+
+
+def test_cache_ttl_and_size_eviction(cache):
+    prompt_id = prompt_fingerprint('2.2', 'system prompt')
+    for i in range(3):
+        cache.set(f'key{i}', {'i': i}, prompt_id)
+    #max_entries = 2 so the least recently used entry is gone
+    assert cache.get('key0') is None
+    assert cache.get('key2') == {'i': 2}
+    assert cache.stats()['evictions'] == 1
+
+    cache.ttl_seconds = -1
+    assert cache.get('key2') is None
+    assert cache.stats()['expired'] == 1
+
+
+def test_prompt_change_invalidates_entries(cache):
+    old_prompt = prompt_fingerprint('2.2', 'system prompt')
+    new_prompt = prompt_fingerprint('2.2', 'edited prompt')
+    cache.set('old', {'a': 1}, old_prompt)
+    cache.set('new', {'b': 2}, new_prompt)
+    assert cache.get('old') is None
+    assert cache.get('new') == {'b': 2}
+
+
+@pytest.mark.asyncio
+async def test_format_query_json_uses_cache(cache, test_case1):
+    response = SimpleNamespace(output_text = test_case1.model_dump_json())
+    with patch.object(functions, 'extraction_cache', cache), \
+         patch.object(functions.hnz_client.responses, 'create', new_callable = AsyncMock) as mock_create:
+        mock_create.return_value = response
+        first = await functions.format_query_json('same report')
+        second = await functions.format_query_json('same  report')
+    assert mock_create.call_count == 1
+    assert first == second == test_case1
+
+
+def test_cache_is_off_unless_enabled_with_a_path(monkeypatch, tmp_path):
+    monkeypatch.delenv('EXTRACTION_CACHE_ENABLED', raising = False)
+    monkeypatch.delenv('EXTRACTION_CACHE_PATH', raising = False)
+    assert not ExtractionCache.from_env().enabled
+    monkeypatch.setenv('EXTRACTION_CACHE_ENABLED', 'true')
+    assert not ExtractionCache.from_env().enabled
+    monkeypatch.setenv('EXTRACTION_CACHE_PATH', str(tmp_path / 'cache.sqlite3'))
+    cache = ExtractionCache.from_env()
+    assert cache.enabled and cache.path == str(tmp_path / 'cache.sqlite3')
@@ -0,0 +1,157 @@
+import httpx
+import asyncio
+import openai
+import pytest
+
+from types import SimpleNamespace
+
+from app.clients import CircuitBreaker, RateLimiter, ResilientClient, RetryableError, TokenBucket
+
+
+def rate_limited(retry_after = '0.01'):
+    response = httpx.Response(429, headers = {'retry-after': retry_after}, request = httpx.Request('POST', 'http://mock'))
+    return openai.RateLimitError('rate limited', response = response, body = None)
+
+
+def server_error():
+    response = httpx.Response(500, request = httpx.Request('POST', 'http://mock'))
+    return openai.InternalServerError('server error', response = response, body = None)
+
+
+class ScriptedResponses:
+    '''
+    Raises the scripted errors in turn, then answers
+    '''
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def parse(self, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return SimpleNamespace(output_parsed = 'ok', usage = None)
+
+
+def make_client(errors, **kwargs):
+    return ResilientClient(SimpleNamespace(responses = ScriptedResponses(errors)), 'test', **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_retries_429_and_backs_the_limiter_off():
+    client = make_client([rate_limited(), rate_limited()])
+    response = await client.responses.parse(model = 'm', input = [])
+    assert response.output_parsed == 'ok'
+    assert client.client.responses.calls == 3
+    assert client.limiter.scale < 1.0
+
+
+@pytest.mark.asyncio
+async def test_exhausted_retries_raise_retryable_error():
+    client = make_client([rate_limited('2')] * 3, max_retries = 0)
+    with pytest.raises(RetryableError) as e:
+        await client.responses.parse(model = 'm', input = [])
+    assert e.value.retry_after == 2.0
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast_then_probes(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold = 2, reset_timeout = 60)
+    client = make_client([server_error(), server_error()], breaker = breaker, backoff = 0.001)
+    with pytest.raises(RetryableError):
+        await client.responses.parse(model = 'm', input = [])
+    assert breaker.is_open and client.client.responses.calls == 2
+
+    #rejected without calling the deployment
+    with pytest.raises(RetryableError, match = 'Circuit breaker'):
+        await client.responses.parse(model = 'm', input = [])
+    assert client.client.responses.calls == 2
+
+    #after the reset timeout one probe goes through and closes the breaker
+    breaker.opened_at -= 61
+    assert (await client.responses.parse(model = 'm', input = [])).output_parsed == 'ok'
+    assert not breaker.is_open
+
+
+class HangingResponses:
+    async def parse(self, **kwargs):
+        await asyncio.sleep(60)
+
+
+@pytest.mark.asyncio
+async def test_cancelled_probe_releases_the_breaker():
+    breaker = CircuitBreaker(failure_threshold = 1, reset_timeout = 60)
+    breaker.record_failure()
+    breaker.opened_at -= 61
+    client = ResilientClient(SimpleNamespace(responses = HangingResponses()), 'test', breaker = breaker)
+    #the probe is cancelled, as a losing hedge or a disconnected client would be
+    probe = asyncio.create_task(client.responses.parse(model = 'm', input = []))
+    await asyncio.sleep(0.01)
+    assert breaker.probing
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+    assert not breaker.probing
+
+    client.client = SimpleNamespace(responses = ScriptedResponses([]))
+    assert (await client.responses.parse(model = 'm', input = [])).output_parsed == 'ok'
+    assert not breaker.is_open
+
+
+@pytest.mark.asyncio
+async def test_probe_that_is_rate_limited_or_queued_too_long_is_released():
+    breaker = CircuitBreaker(failure_threshold = 1, reset_timeout = 60)
+    breaker.record_failure()
+    breaker.opened_at -= 61
+    client = make_client([rate_limited()], breaker = breaker, max_retries = 0)
+    with pytest.raises(RetryableError):
+        await client.responses.parse(model = 'm', input = [])
+    assert not breaker.probing
+
+    client.limiter = RateLimiter(rpm = 1, max_wait = 0.1)
+    await client.limiter.acquire(0)
+    with pytest.raises(RetryableError, match = 'Rate limiter'):
+        await client.responses.parse(model = 'm', input = [])
+    assert not breaker.probing
+
+
+@pytest.mark.asyncio
+async def test_cancelled_wait_returns_the_reservation():
+    limiter = RateLimiter(rpm = 60)
+    for _ in range(60):
+        await limiter.acquire(0)
+    waiting = asyncio.create_task(limiter.acquire(0))
+    await asyncio.sleep(0.01)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+    assert limiter.requests.level > -1
+
+
+def test_quota_is_shared_between_server_workers(monkeypatch):
+    monkeypatch.setenv('LLM_RPM_LIMIT', '600')
+    monkeypatch.setenv('LLM_TPM_LIMIT', '90000')
+    monkeypatch.setenv('WEB_CONCURRENCY', '3')
+    client = ResilientClient.from_env(None, 'test')
+    assert client.limiter.requests.capacity == 200
+    assert client.limiter.tokens.capacity == 30000
+    #quotas given per deployment are split the same way
+    assert ResilientClient.from_env(None, 'test', rpm = 300).limiter.requests.capacity == 100
+
+
+def test_token_bucket_queues_callers_in_order():
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0, abs = 0.05)
+    assert bucket.reserve(1) == pytest.approx(2.0, abs = 0.05)
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_rejects_when_the_queue_is_too_deep():
+    limiter = RateLimiter(rpm = 60, max_wait = 0.5)
+    for _ in range(60):
+        await limiter.acquire(0)
+    with pytest.raises(RetryableError):
+        await limiter.acquire(0)
+    #the rejected request did not keep its reservation
+    assert limiter.requests.level > -1
@@ -0,0 +1,67 @@
+import hmac
+import json
+import base64
+import hashlib
+
+from app import deidentify, functions
+from app.deidentify import Pseudonymizer
+
+
+def test_matches_full_digest_pseudonyms():
+    identifiers = ['ABC1234', 'Jane Doe', 'ZZZ9999', 'Māori name']
+    for length in (8, 20, 52, 60):
+        pseudonymizer = Pseudonymizer(functions.KEY, length = length)
+        for identifier in identifiers:
+            #the original implementation - base32 of the whole digest, then truncated
+            digest = hmac.new(functions.KEY, identifier.encode('utf-8'), hashlib.sha256).digest()
+            expected = base64.b32encode(digest).decode('ascii')[:length]
+            assert pseudonymizer.pseudonymize(identifier) == expected
+            assert functions.pseudonymize(identifier, length = length) == expected
+
+
+def test_many_and_column_pass_empty_values_through():
+    pseudonymizer = Pseudonymizer(b'key', cache_size = 2)
+    values = ['ABC1234', None, 'ABC1234', '', 'XYZ9876']
+    many = list(pseudonymizer.pseudonymize_many(iter(values)))
+    assert many == pseudonymizer.pseudonymize_column(values)
+    assert many[0] == many[2] and many[1] is None and many[3] == ''
+    assert pseudonymizer.cache_info().hits >= 1
+
+
+def test_audit_log_is_deidentified_in_place(tmp_path, monkeypatch):
+    monkeypatch.setenv('HMAC_KEY', base64.b64encode(b'test key').decode('ascii'))
+    record = {
+        'timestamp': 'now',
+        'level': 'INFO',
+        'extra': {
+            'user_input': 'Patient: Jane Doe, NHI ABC1234. JANE DOE had no polyps.',
+            'json_summary': {'patient_name': 'Jane Doe', 'patient_NHI': 'ABC1234', 'patient_age': 60},
+            'recommendation': {'follow_up': 10},
+        },
+    }
+    path = tmp_path / 'audit.log'
+    path.write_text(json.dumps(record) + '\nnot json\n', encoding = 'utf-8')
+
+    assert deidentify.main([str(path)]) == 0
+    lines = path.read_text(encoding = 'utf-8').splitlines()
+    assert lines[1] == 'not json'
+    extra = json.loads(lines[0])['extra']
+    pseudonymizer = Pseudonymizer(b'test key')
+    nhi, name = pseudonymizer.pseudonymize('ABC1234'), pseudonymizer.pseudonymize('Jane Doe')
+    assert extra['json_summary'] == {'patient_name': name, 'patient_NHI': nhi, 'patient_age': 60}
+    assert extra['user_input'] == f'Patient: {name}, NHI {nhi}. {name} had no polyps.'
+    assert [p.name for p in tmp_path.iterdir()] == ['audit.log']
+
+    deidentify.deidentify_file(str(path), str(tmp_path / 'dropped.jsonl'), pseudonymizer, drop_text = True)
+    assert 'user_input' not in json.loads((tmp_path / 'dropped.jsonl').read_text(encoding = 'utf-8').splitlines()[0])['extra']
+
+
+def test_name_is_not_replaced_inside_other_words():
+    pseudonymizer = Pseudonymizer(b'test key')
+    record = {'extra': {
+        'user_input': 'Patient: Al. Al also had a colonoscopy-related bleed, seen by Dr Alder (al).',
+        'json_summary': {'patient_name': 'Al'},
+    }}
+    deidentify.deidentify_record(record, pseudonymizer)
+    name = pseudonymizer.pseudonymize('Al')
+    assert record['extra']['user_input'] == f'Patient: {name}. {name} also had a colonoscopy-related bleed, seen by Dr Alder ({name}).'
@@ -0,0 +1,76 @@
+import pytest
+
+from unittest.mock import AsyncMock, patch
+
+from app import functions
+from app.fast_extract import CECUM_REACHED, FastExtractor
+
+SIMPLE = '''Colonoscopy report
+NHI: ABC1234   Age: 62   Date: 2025-05-05
+Indication: positive FIT
+The caecum was reached and identified by the appendiceal orifice.
+BBPS 8 (2/3/3)
+No polyps seen.
+'''
+
+
+@pytest.fixture
+def extractor():
+    return FastExtractor(functions.nhi_pattern)
+
+
+def test_simple_report_is_extracted(extractor):
+    summary = extractor.extract(SIMPLE)
+    assert summary is not None
+    assert summary.patient_age == 62
+    assert summary.patient_NHI == 'ABC1234'
+    assert summary.indication == 'positive_faecal_immunochemical_test'
+    colonoscopy = summary.colonoscopy[0]
+    assert colonoscopy.date == '2025-05-05'
+    assert (colonoscopy.number_of_polyps, colonoscopy.cecum_reached, colonoscopy.polyps) == (0, True, [])
+    assert colonoscopy.bostonBowelPrepScore.model_dump() == {'total': 8, 'right': 2, 'transverse': 3, 'left': 3}
+    assert functions.triage(summary)['rule'] == 'rule_18'
+
+
+@pytest.mark.parametrize('text', [
+    SIMPLE.replace('No polyps seen.', 'One 4 mm polyp in the sigmoid, removed by cold snare.'),
+    SIMPLE.replace('No polyps seen.', 'No polyps seen. Sigmoid polyp noted on withdrawal.'),
+    SIMPLE.replace('The caecum was reached', 'The caecum was not reached'),
+    SIMPLE.replace('BBPS 8 (2/3/3)', 'BBPS 7 (2/3/3)'),
+    SIMPLE.replace('BBPS 8 (2/3/3)', 'BBPS 8'),
+    SIMPLE.replace('Indication:', '68 year old male. Indication:'),
+    SIMPLE.replace('Age: 62', ''),
+    SIMPLE.replace('positive FIT', 'family history of bowel cancer'),
+    SIMPLE.replace('positive FIT', 'ulcerative colitis surveillance'),
+    SIMPLE.replace('The caecum was reached and identified by the appendiceal orifice.', 'The caecum was not visualised.'),
+    SIMPLE.replace('The caecum was reached and identified by the appendiceal orifice.', 'Caecum could not be identified.'),
+    SIMPLE.replace('The caecum was reached and identified by the appendiceal orifice.', "Caecum wasn't identified."),
+    SIMPLE.replace('The caecum was reached and identified by the appendiceal orifice.', 'Terminal ileum not intubated, caecum not identified'),
+    SIMPLE.replace('The caecum was reached and identified by the appendiceal orifice.', 'Failed to reach the caecum.'),
+])
+def test_anything_uncertain_falls_back_to_the_llm(extractor, text):
+    assert extractor.extract(text) is None
+
+
+@pytest.mark.parametrize('text', ['The caecum was not visualised.', 'Caecum could not be identified.', 'Caecum unable to be intubated'])
+def test_negated_cecum_is_not_reached(text):
+    assert CECUM_REACHED.search(text) is None
+
+
+def test_fast_extract_is_off_by_default():
+    assert not FastExtractor.from_env(functions.nhi_pattern).enabled
+
+
+def test_bbps_total_of_nine_implies_the_segments(extractor):
+    summary = extractor.extract(SIMPLE.replace('BBPS 8 (2/3/3)', 'Boston Bowel Prep Score: 9'))
+    assert summary.colonoscopy[0].bostonBowelPrepScore.model_dump() == {'total': 9, 'right': 3, 'transverse': 3, 'left': 3}
+
+
+@pytest.mark.asyncio
+async def test_fast_path_skips_the_llm(monkeypatch):
+    monkeypatch.setattr(functions.fast_extractor, 'enabled', True)
+    with patch.object(functions.hnz_client.responses, 'create', new_callable = AsyncMock) as mock_create:
+        summary = await functions.format_query_json(SIMPLE)
+    assert not mock_create.called
+    assert summary.patient_age == 62
+    assert functions.fast_extractor.stats()['hits'] >= 1
@@ -0,0 +1,160 @@
+import time
+import sqlite3
+import asyncio
+import pytest
+
+from unittest.mock import AsyncMock, patch
+
+from app.clients import RetryableError
+from app.jobs import JobQueue, JobStore, QueueDisabledError, QueueFullError
+
+
+@pytest.fixture(scope = 'function')
+def store(tmp_path):
+    s = JobStore(str(tmp_path / 'jobs.sqlite3'), lease_seconds = 60)
+    yield s
+    s.close()
+
+
+def test_jobs_survive_a_restart(tmp_path, store):
+    job_id = store.enqueue('report', max_pending = 10)
+    store.close()
+
+    reopened = JobStore(store.path)
+    claimed_id, user_query, attempts = reopened.claim()
+    assert (claimed_id, user_query, attempts) == (job_id, 'report', 1)
+    assert reopened.claim() is None
+
+    reopened.complete(job_id, {'follow_up': 10})
+    job = reopened.get(job_id)
+    reopened.close()
+    assert job['status'] == 'done'
+    assert job['result'] == {'follow_up': 10}
+
+
+def test_expired_lease_is_claimed_again(store):
+    job_id = store.enqueue('report', max_pending = 10)
+    store.claim()
+    #the worker holding the job died - once the lease runs out the job goes to the next worker
+    store.lease_seconds = -1
+    store._connect().execute('UPDATE triage_jobs SET available_at = ?', (time.time() - 1,))
+    assert store.claim()[0] == job_id
+    assert store.get(job_id)['attempts'] == 2
+
+
+def test_full_queue_rejects_submissions(store):
+    store.enqueue('one', max_pending = 2)
+    store.enqueue('two', max_pending = 2)
+    with pytest.raises(QueueFullError):
+        store.enqueue('three', max_pending = 2)
+    assert store.counts()['queued'] == 2
+
+
+@pytest.mark.asyncio
+async def test_retryable_jobs_are_retried_then_fail(store):
+    handler = AsyncMock(side_effect = [RetryableError('rate limited', retry_after = 0.01), {'ok': True}])
+    queue = JobQueue(store, workers = 2, max_attempts = 2, poll_interval = 0.01)
+    await queue.start(handler)
+    job_id = await queue.submit('report')
+    for _ in range(200):
+        job = await queue.get(job_id)
+        if job['status'] == 'done':
+            break
+        await asyncio.sleep(0.01)
+    assert job['result'] == {'ok': True}
+    assert job['attempts'] == 2
+    assert queue.stats()['retried'] == 1
+
+    handler.side_effect = RetryableError('still rate limited', retry_after = 0.01)
+    job_id = await queue.submit('report')
+    for _ in range(200):
+        job = await queue.get(job_id)
+        if job['status'] == 'failed':
+            break
+        await asyncio.sleep(0.01)
+    await queue.close()
+    assert job['retryable'] is True
+    assert job['attempts'] == 2
+
+
+@pytest.mark.asyncio
+async def test_worker_survives_store_errors(store):
+    queue = JobQueue(store, workers = 1, poll_interval = 0.01)
+    claim = store.claim
+    errors = [sqlite3.OperationalError('database is locked')]
+
+    def flaky_claim():
+        if errors:
+            raise errors.pop()
+        return claim()
+
+    with patch.object(store, 'claim', side_effect = flaky_claim):
+        await queue.start(AsyncMock(return_value = {'ok': True}))
+        job_id = await queue.submit('report')
+        for _ in range(200):
+            job = await queue.get(job_id)
+            if job['status'] == 'done':
+                break
+            await asyncio.sleep(0.01)
+        assert queue.running
+        await queue.close()
+    assert job['status'] == 'done'
+    assert queue.stats()['errors'] == 1
+
+
+@pytest.mark.asyncio
+async def test_cancelled_job_is_handed_back(store):
+    started = asyncio.Event()
+
+    async def handler(user_query):
+        started.set()
+        await asyncio.sleep(60)
+
+    queue = JobQueue(store, workers = 1, poll_interval = 0.01)
+    await queue.start(handler)
+    job_id = await queue.submit('report')
+    await asyncio.wait_for(started.wait(), 1)
+    await queue.close()
+    reopened = JobStore(store.path)
+    assert reopened.get(job_id)['status'] == 'queued'
+    reopened.close()
+
+
+@pytest.mark.asyncio
+async def test_queue_without_a_path_is_off(monkeypatch):
+    monkeypatch.delenv('JOB_QUEUE_PATH', raising = False)
+    queue = JobQueue.from_env()
+    await queue.start(AsyncMock())
+    assert not queue.enabled and not queue.running
+    with pytest.raises(QueueDisabledError):
+        await queue.submit('report')
+    assert await queue.get('job') is None
+    assert queue.counts()['queued'] == 0
+    assert queue.store._conn is None
+
+
+def test_job_endpoints(client, test_case1):
+    from app.routes import job_queue
+
+    with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
+        mock_return.return_value = test_case1.model_copy(update = {'patient_age': 50})
+        response = client.post("/triage/jobs", json = {'user_query': 'test text'})
+        assert response.status_code == 202
+        job_id = response.json()['job_id']
+        assert response.headers['location'] == f'/triage/jobs/{job_id}'
+        for _ in range(200):
+            job = client.get(f"/triage/jobs/{job_id}").json()
+            if job['status'] == 'done':
+                break
+            time.sleep(0.01)
+    assert job['result']['recommendation']['follow_up'] == 10
+    assert client.get("/triage/jobs/unknown").status_code == 404
+
+    with patch.object(job_queue, 'max_pending', 0):
+        response = client.post("/triage/jobs", json = {'user_query': 'test text'})
+    assert response.status_code == 429
+    assert 'retry-after' in response.headers
+
+    with patch.object(job_queue, 'enabled', False):
+        response = client.post("/triage/jobs", json = {'user_query': 'test text'})
+    assert response.status_code == 503
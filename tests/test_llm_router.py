@@ -0,0 +1,98 @@
+import asyncio
+import pytest
+
+from types import SimpleNamespace
+
+from app.llm_router import Deployment, InvalidResponse, LLMRouter
+
+
+class FakeResponses:
+    def __init__(self, deployment):
+        self.deployment = deployment
+
+    async def parse(self, **kwargs):
+        d = self.deployment
+        d.calls += 1
+        await asyncio.sleep(d.delay)
+        if d.fail:
+            raise RuntimeError(f'{d.name} unavailable')
+        return SimpleNamespace(output_parsed = None if d.invalid else {'served_by': d.name, 'model': kwargs['model']})
+
+
+class FakeDeployment:
+    '''
+    Local stand-in for an Azure OpenAI deployment with configurable latency and failures
+    '''
+    def __init__(self, name, delay = 0.0, fail = False, invalid = False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.invalid = invalid
+        self.calls = 0
+        self.responses = FakeResponses(self)
+
+
+async def parse(client, model):
+    return await client.responses.parse(model = model, input = [])
+
+
+def is_valid(response):
+    return response.output_parsed is not None
+
+
+def make_router(*fakes, **kwargs):
+    return LLMRouter([Deployment(f.name, f, f'{f.name}-model') for f in fakes], **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_least_outstanding_spreads_concurrent_requests():
+    a, b = FakeDeployment('a', delay = 0.05), FakeDeployment('b', delay = 0.05)
+    router = make_router(a, b)
+    results = await asyncio.gather(*(router.request(parse, is_valid) for _ in range(10)))
+    assert a.calls == 5 and b.calls == 5
+    assert {r.output_parsed['model'] for r in results} == {'a-model', 'b-model'}
+
+
+@pytest.mark.asyncio
+async def test_failed_request_moves_to_another_deployment_and_marks_it_unhealthy(monkeypatch):
+    #ties go to the first deployment listed, so bad is tried until it is marked unhealthy
+    monkeypatch.setattr('app.llm_router.random.choice', lambda candidates: candidates[0])
+    bad, good = FakeDeployment('bad', fail = True), FakeDeployment('good')
+    router = make_router(bad, good, failure_threshold = 2, cooldown = 60)
+    for _ in range(6):
+        response = await router.request(parse, is_valid)
+        assert response.output_parsed['served_by'] == 'good'
+    assert bad.calls == 2
+    assert router.stats()['deployments']['bad']['healthy'] is False
+
+
+@pytest.mark.asyncio
+async def test_invalid_responses_are_not_accepted():
+    router = make_router(FakeDeployment('invalid', invalid = True))
+    with pytest.raises(InvalidResponse):
+        await router.request(parse, is_valid)
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_returns_the_faster_deployment():
+    slow, fast = FakeDeployment('slow', delay = 1.0), FakeDeployment('fast', delay = 0.01)
+    router = make_router(slow, fast, hedge = True, hedge_min_delay = 0.02)
+    router.pick = lambda exclude = (): next(d for d in router.deployments if d not in exclude)
+
+    start = asyncio.get_running_loop().time()
+    response = await router.request(parse, is_valid)
+    assert response.output_parsed['served_by'] == 'fast'
+    assert asyncio.get_running_loop().time() - start < 0.5
+    assert router.hedges == 1 and router.hedge_wins == 1
+    #the losing request is cancelled, not left running
+    await asyncio.sleep(0.01)
+    assert router.deployments[0].outstanding == 0
+
+
+@pytest.mark.asyncio
+async def test_no_hedge_when_primary_answers_in_time():
+    a, b = FakeDeployment('a', delay = 0.0), FakeDeployment('b', delay = 0.0)
+    router = make_router(a, b, hedge = True, hedge_min_delay = 0.5)
+    await router.request(parse, is_valid)
+    assert a.calls + b.calls == 1
+    assert router.hedges == 0
@@ -0,0 +1,72 @@
+import json
+import logging
+import queue
+
+from app.logging_config import (
+    BatchedRotatingFileHandler, BatchingQueueListener, DroppingQueueHandler, JSONFormatter, LogStats
+)
+
+
+def make_logger(name, log_queue, stats):
+    logger = logging.getLogger(name)
+    logger.handlers.clear()
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(DroppingQueueHandler(log_queue, stats))
+    return logger
+
+
+def test_records_are_written_in_batches_off_the_caller_thread(tmp_path):
+    stats = LogStats()
+    log_queue = queue.Queue(maxsize = 100)
+    handler = BatchedRotatingFileHandler(tmp_path / 'audit.log', maxBytes = 5_000_000, backupCount = 1)
+    handler.setFormatter(JSONFormatter())
+    listener = BatchingQueueListener(log_queue, [handler], stats, batch_size = 50, flush_interval = 0.05)
+    logger = make_logger('test_batched_logger', log_queue, stats)
+
+    for i in range(20):
+        logger.info('record %s', i, extra = {'extra_data': {'i': i}})
+    listener.start()
+    listener.stop()
+    handler.close()
+
+    lines = (tmp_path / 'audit.log').read_text(encoding = 'utf-8').splitlines()
+    records = [json.loads(line) for line in lines]
+    assert [r['extra']['i'] for r in records] == list(range(20))
+    assert records[3]['message'] == 'record 3'
+    assert stats.written == 20
+    assert stats.batches == 1
+
+
+def test_full_queue_drops_instead_of_blocking():
+    stats = LogStats()
+    logger = make_logger('test_dropping_logger', queue.Queue(maxsize = 2), stats)
+    for i in range(5):
+        logger.info('record %s', i)
+    assert stats.enqueued == 2
+    assert stats.dropped == 3
+
+
+def test_setup_logging_is_idempotent(client):
+    from app.logging_config import setup_logging
+    #the app lifespan has already configured logging through the client fixture
+    logger = setup_logging()
+    assert setup_logging() is logger
+    assert len([h for h in logger.handlers if isinstance(h, DroppingQueueHandler)]) == 1
+
+
+def test_formatter_is_compact_and_serializes_models(test_case1):
+    record = logging.LogRecord('api_logger', logging.INFO, __file__, 1, 'hello', None, None)
+    record.extra_data = {'json_summary': test_case1}
+    line = JSONFormatter().format(record)
+    assert ', ' not in line.split('"extra"')[0]
+    assert json.loads(line)['extra']['json_summary'] == test_case1.model_dump(mode = 'json')
+
+
+def test_each_worker_logs_to_its_own_file(monkeypatch):
+    from app import logging_config
+    monkeypatch.delenv('WORKER_SLOT', raising = False)
+    assert logging_config.log_file() == logging_config.LOG_FILE
+    monkeypatch.setattr(logging_config, 'LOG_FILE', 'logs/app.log')
+    monkeypatch.setenv('WORKER_SLOT', '2')
+    assert logging_config.log_file() == 'logs/app-2.log'
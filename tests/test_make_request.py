@@ -0,0 +1,61 @@
+import httpx
+import pytest
+
+from client_scripts import make_request
+
+
+@pytest.mark.asyncio
+async def test_send_request_retries_throttled_responses():
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(429, headers = {'retry-after': '0'})
+        if len(calls) == 2:
+            return httpx.Response(503)
+        return httpx.Response(200, json = {'recommendation': {'follow_up': 10, 'rule': 'rule_18'}})
+
+    async with httpx.AsyncClient(transport = httpx.MockTransport(handler)) as client:
+        output, elapsed = await make_request.send_request(client, 'report', 'http://test/triage', retries = 3, backoff = 0)
+    assert len(calls) == 3
+    assert output['recommendation']['rule'] == 'rule_18'
+    assert elapsed >= 0
+
+
+@pytest.mark.asyncio
+async def test_send_request_does_not_retry_client_errors():
+    async with httpx.AsyncClient(transport = httpx.MockTransport(lambda request: httpx.Response(422))) as client:
+        with pytest.raises(Exception, match = '422'):
+            await make_request.send_request(client, 'report', 'http://test/triage', retries = 3, backoff = 0)
+
+
+@pytest.mark.asyncio
+async def test_failed_request_does_not_abort_the_run(monkeypatch, tmp_path):
+    for i in range(3):
+        (tmp_path / f'sample_patient_report_{i}.txt').write_text(f'report {i}', encoding = 'utf-8')
+    monkeypatch.setattr(make_request, 'DATA_PATH', tmp_path)
+
+    async def send_request(client, report, api_url, retries):
+        if report == 'report 1':
+            raise Exception('API request failed with status code 503')
+        return {'recommendation': {'follow_up': 10, 'rule': 'rule_18'}}, 0.5
+
+    monkeypatch.setattr(make_request, 'send_request', send_request)
+    outputs, latencies, wall, failures = await make_request.evaluate('http://test/triage', 2, 0, 1.0)
+    assert sorted(outputs) == ['000', '002']
+    assert latencies == [0.5, 0.5]
+    assert list(failures) == ['001'] and '503' in failures['001']
+
+
+def test_accuracy_skips_failed_cases():
+    human = [{'case': '000', 'follow_up': 10, 'rule': 'rule_18'}, {'case': '001', 'follow_up': 3, 'rule': 'rule_7'}]
+    year, rule, _, _, _ = make_request.accuracy(human, {'000': {'follow_up': 10, 'rule': 'rule_18'}})
+    assert year == 1.0 and rule == 1.0
+
+
+def test_percentile():
+    latencies = [float(i) for i in range(1, 101)]
+    assert make_request.percentile(latencies, 50) == 50.0
+    assert make_request.percentile(latencies, 95) == 95.0
+    assert make_request.percentile([2.0], 95) == 2.0
@@ -0,0 +1,38 @@
+from unittest.mock import AsyncMock, patch
+
+from app import metrics
+from app.metrics import Registry
+
+
+def test_histogram_exposition_is_cumulative():
+    registry = Registry()
+    hist = registry.histogram('stage_seconds', 'test', buckets = (0.1, 1.0))
+    hist.observe(0.05, stage = 'a')
+    hist.observe(0.5, stage = 'a')
+    hist.observe(5.0, stage = 'a')
+    text = registry.render()
+    assert 'stage_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="a",le="1.0"} 2' in text
+    assert 'stage_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 'stage_seconds_count{stage="a"} 3' in text
+    assert '# TYPE stage_seconds histogram' in text
+
+
+def test_metrics_endpoint_reports_stages_and_rule_hits(client, test_case1):
+    hits = metrics.rule_hits.value(rule = 'rule_20')
+    with patch("app.functions.format_query_json", new_callable=AsyncMock) as mock_return:
+        mock_return.return_value = test_case1
+        assert client.post("/triage", json = {'user_query': 'test text'}).status_code == 200
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    text = response.text
+    for stage in ('extraction', 'triage', 'age_out', 'audit_log'):
+        assert f'triage_stage_seconds_count{{stage="{stage}"}}' in text
+    assert metrics.rule_hits.value(rule = 'rule_20') == hits + 1
+    assert 'extraction_cache_events_total{event="hits"}' in text
+    assert 'llm_outstanding_requests{deployment="hnz"} 0' in text
+    assert 'app_startup_seconds{phase="import"}' in text
+    assert 'app_startup_seconds{phase="lifespan"}' in text
+    assert 'structured_output_repair_ratio ' in text
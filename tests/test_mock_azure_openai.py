@@ -0,0 +1,70 @@
+import json
+import httpx
+import pytest
+
+from openai import AsyncAzureOpenAI, RateLimitError
+
+from app import functions, metrics
+from app.llm_router import Deployment
+from app.synthetic import random_summaries
+from benchmarks.mock_azure_openai import MockSettings, create_app
+
+
+def mock_client(settings: MockSettings) -> AsyncAzureOpenAI:
+    transport = httpx.ASGITransport(app = create_app(settings))
+    return AsyncAzureOpenAI(api_version = '2025-03-01-preview', api_key = 'mock', azure_endpoint = 'http://mock',
+                            max_retries = 0, http_client = httpx.AsyncClient(transport = transport))
+
+
+@pytest.fixture
+def use_mock(monkeypatch):
+    monkeypatch.setattr(functions.extraction_cache, 'enabled', False)
+
+    def use(settings: MockSettings):
+        deployments = [Deployment('mock', mock_client(settings), 'mock-model')]
+        monkeypatch.setattr(functions.extraction_router, 'deployments', deployments)
+    return use
+
+
+@pytest.mark.asyncio
+async def test_format_query_json_parses_mock_responses(use_mock):
+    use_mock(MockSettings(seed = 1))
+    tokens = metrics.llm_tokens.value(direction = 'output')
+    summary = await functions.format_query_json('report text')
+    assert summary != functions.empty_summary()
+    assert summary.extraction_successful and summary.colonoscopy
+    assert metrics.llm_tokens.value(direction = 'output') > tokens
+
+
+@pytest.mark.asyncio
+async def test_malformed_output_falls_back_to_empty_summary(use_mock):
+    use_mock(MockSettings(malformed_fraction = 1.0, seed = 1))
+    assert await functions.format_query_json('report text') == functions.empty_summary()
+
+
+@pytest.mark.asyncio
+async def test_drifted_output_is_repaired_locally(use_mock):
+    use_mock(MockSettings(drift_fraction = 1.0, seed = 1))
+    repaired = metrics.structured_output.value(outcome = 'repaired')
+    summary = await functions.format_query_json('report text')
+    assert summary != functions.empty_summary()
+    assert metrics.structured_output.value(outcome = 'repaired') == repaired + 1
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_sends_retry_after():
+    client = mock_client(MockSettings(rate_limit_fraction = 1.0, retry_after = 2.5))
+    with pytest.raises(RateLimitError) as e:
+        await client.responses.create(model = 'mock-model', input = [{'role': 'user', 'content': 'x'}])
+    assert e.value.response.headers['retry-after'] == '2.500'
+
+
+@pytest.mark.asyncio
+async def test_fixtures_replay_the_recorded_summary(use_mock, tmp_path):
+    recorded = random_summaries(2, seed = 3)
+    fixtures = tmp_path / 'app.log'
+    fixtures.write_text('\n'.join(
+        json.dumps({'extra': {'user_input': f'report  {i}', 'json_summary': s.model_dump()}}) for i, s in enumerate(recorded)
+    ))
+    use_mock(MockSettings(fixtures = fixtures))
+    assert await functions.format_query_json('report 1') == recorded[1]
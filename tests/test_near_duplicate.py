@@ -0,0 +1,105 @@
+import re
+import zlib
+import asyncio
+import pytest
+
+import numpy as np
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from app import functions
+from app.near_duplicate import NearDuplicateIndex, key_fields
+
+NHI = re.compile(r'\b[A-Z]{3}[0-9]{4}\b')
+
+REPORT = 'NHI ABC1234. Caecum reached. Two polyps: 4 mm adenoma in the ascending colon and 6 mm adenoma in the sigmoid, both removed.'
+EDITED = 'NHI ABC1234. Caecum reached.  Two polyps: 4 mm adenoma in the ascending colon, and 6 mm adenoma in the sigmoid - both removed.'
+RESIZED = 'NHI ABC1234. Caecum reached. Two polyps: 4 mm adenoma in the ascending colon and 16 mm adenoma in the sigmoid, both removed.'
+
+
+def bag_of_words(text: str) -> list:
+    #a stand-in embedding - similar wording gives similar vectors
+    vector = np.zeros(256)
+    for word in re.findall(r'\w+', text.lower()):
+        vector[zlib.crc32(word.encode()) % 256] += 1
+    return vector.tolist()
+
+
+def fake_embedding_client():
+    async def create(model, input):
+        return SimpleNamespace(data = [SimpleNamespace(index = i, embedding = bag_of_words(t)) for i, t in enumerate(input)])
+    return SimpleNamespace(embeddings = SimpleNamespace(create = AsyncMock(side_effect = create)))
+
+
+@pytest.fixture(scope = 'function')
+def index():
+    return NearDuplicateIndex(fake_embedding_client(), 'embedding-model', NHI, threshold = 0.9, max_entries = 4, enabled = True)
+
+
+@pytest.mark.asyncio
+async def test_edited_report_reuses_result(index):
+    vector = await index.embed(REPORT)
+    assert index.find(vector, REPORT, 'prompt') is None
+    index.add(vector, REPORT, 'prompt', {'patient_NHI': 'ABC1234'})
+
+    match = index.find(await index.embed(EDITED), EDITED, 'prompt')
+    assert match is not None and match.result == {'patient_NHI': 'ABC1234'}
+    assert match.similarity > 0.9
+    #same text, different prompt - the old extraction doesn't apply
+    assert index.find(await index.embed(EDITED), EDITED, 'new prompt') is None
+
+
+@pytest.mark.asyncio
+async def test_changed_key_fields_are_not_reused(index):
+    vector = await index.embed(REPORT)
+    index.add(vector, REPORT, 'prompt', {'patient_NHI': 'ABC1234'})
+    resized = await index.embed(RESIZED)
+    assert float(resized @ vector) > 0.9
+    assert index.find(resized, RESIZED, 'prompt') is None
+    assert index.stats()['fields_differ'] == 1
+    assert key_fields(REPORT, NHI) != key_fields(REPORT.replace('ABC1234', 'XYZ9876'), NHI)
+
+
+@pytest.mark.parametrize('before, after', [
+    ('tubular adenoma with low-grade dysplasia', 'tubulovillous adenoma with high-grade dysplasia'),
+    ('adenoma, removed en bloc', 'adenoma, removed piecemeal'),
+    ('sessile polyp in the sigmoid', 'pedunculated polyp in the sigmoid'),
+    ('4 mm polyp in the caecum and 6 mm polyp in the rectum', '6 mm polyp in the caecum and 4 mm polyp in the rectum'),
+])
+def test_clinical_edits_change_the_key_fields(before, after):
+    report = f'NHI ABC1234. Caecum reached. One {before}.'
+    assert key_fields(report, NHI) != key_fields(f'NHI ABC1234. Caecum reached. One {after}.', NHI)
+
+
+@pytest.mark.asyncio
+async def test_grade_change_is_not_reused(index):
+    report = 'NHI ABC1234. Caecum reached. One 8 mm tubular adenoma in the sigmoid with low-grade dysplasia, removed.'
+    edited = 'NHI ABC1234. Caecum reached. One 8 mm tubulovillous adenoma in the sigmoid with high-grade dysplasia, removed.'
+    #the stand-in embedding scores this pair at 0.89, a real one puts it well above the threshold
+    index.threshold = 0.85
+    vector = await index.embed(report)
+    index.add(vector, report, 'prompt', {'patient_NHI': 'ABC1234'})
+    assert index.find(await index.embed(edited), edited, 'prompt') is None
+    assert index.stats()['fields_differ'] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reports_share_an_embedding_call(index):
+    vectors = await asyncio.gather(*(index.embed(f'report {i}') for i in range(5)))
+    assert len(vectors) == 5
+    assert index.client.embeddings.create.call_count == 1
+    assert index.client.embeddings.create.call_args.kwargs['input'] == [f'report {i}' for i in range(5)]
+
+
+@pytest.mark.asyncio
+async def test_format_query_json_skips_the_llm_for_a_resubmission(index, test_case1):
+    with patch.object(functions, 'near_duplicates', index), \
+         patch.object(functions.extraction_cache, 'enabled', False), \
+         patch.object(functions.hnz_client.responses, 'create', new_callable = AsyncMock) as mock_create:
+        mock_create.return_value = SimpleNamespace(output_text = test_case1.model_dump_json())
+        await functions.format_query_json(REPORT)
+        second = await functions.format_query_json(EDITED)
+    await index.close()
+    assert mock_create.call_count == 1
+    assert second == test_case1
+    assert index.stats()['reused'] == 1
@@ -0,0 +1,114 @@
+import pytest
+
+from unittest.mock import AsyncMock, Mock, patch
+
+from app import functions
+from app.patient_history import PatientHistoryStore
+from app.rules import combine_history
+
+
+@pytest.fixture(scope = 'function')
+def store(tmp_path):
+    s = PatientHistoryStore(str(tmp_path / 'history.sqlite3'))
+    yield s
+    s.close()
+
+
+def report(test_case1, date, **polyp):
+    #one procedure per report, as a referring centre would send them
+    data = test_case1.model_copy(deep = True, update = {'patient_age': 50})
+    data.colonoscopy[0].date = date
+    for field, value in polyp.items():
+        setattr(data.colonoscopy[0].polyps[0], field, value)
+    return data
+
+
+def test_only_new_procedures_are_triaged(store, test_case1):
+    triage_procedure = Mock(side_effect = functions.triage_colonoscopy)
+
+    outcome, procedures, _ = store.update('patient', report(test_case1, '2020-01-01'), triage_procedure)
+    assert (outcome['rule'], procedures) == ('rule_17', 1)
+
+    outcome, procedures, _ = store.update('patient', report(test_case1, '2023-01-01', dysplasia = 'high_grade'), triage_procedure)
+    assert (outcome['rule'], procedures) == ('rule_9', 2)
+    assert triage_procedure.call_count == 2
+
+    #the full history resent - nothing has changed, so nothing is triaged again
+    history = report(test_case1, '2020-01-01')
+    history.colonoscopy.append(report(test_case1, '2023-01-01', dysplasia = 'high_grade').colonoscopy[0])
+    outcome, procedures, _ = store.update('patient', history, triage_procedure)
+    assert (outcome['rule'], procedures) == ('rule_9', 2)
+    assert triage_procedure.call_count == 2
+    assert store.stats() == {'triaged': 2, 'already_known': 2}
+
+
+def test_corrected_procedure_rebuilds_the_outcome(store, test_case1):
+    store.update('patient', report(test_case1, '2020-01-01'), functions.triage_colonoscopy)
+    store.update('patient', report(test_case1, '2023-01-01', dysplasia = 'high_grade'), functions.triage_colonoscopy)
+    outcome, procedures, _ = store.update('patient', report(test_case1, '2023-01-01'), functions.triage_colonoscopy)
+    assert (outcome['rule'], procedures) == ('rule_17', 2)
+    assert store.get('other patient') is None
+
+
+def test_most_recent_procedure_sets_the_follow_up(store, test_case1):
+    #an old review outcome and an old 3 year outcome are superseded by a later clean colonoscopy
+    old = report(test_case1, '2015-06-01')
+    old.colonoscopy[0].bostonBowelPrepScore.right = 1
+    assert functions.triage_colonoscopy(old, old.colonoscopy[0])['follow_up'] == 0
+    store.update('patient', old, functions.triage_colonoscopy)
+    store.update('patient', report(test_case1, '2018-06-01', dysplasia = 'high_grade'), functions.triage_colonoscopy)
+    outcome, procedures, follow_up_from = store.update('patient', report(test_case1, '2024-06-01'), functions.triage_colonoscopy)
+    assert (outcome['rule'], procedures, follow_up_from) == ('rule_17', 3, '2024-06-01')
+
+    #a report of an older procedure arriving late does not override the most recent one
+    outcome, _, follow_up_from = store.update('patient', report(test_case1, '2020-01-01', size = 12), functions.triage_colonoscopy)
+    assert (outcome['rule'], follow_up_from) == ('rule_17', '2024-06-01')
+    assert store.get('patient') == (outcome, 4, '2024-06-01')
+
+
+def test_combine_history_keeps_undated_procedures():
+    review = {'follow_up': 0, 'rule': 'rule_19', 'reason': ''}
+    ten = {'follow_up': 10, 'rule': 'rule_18', 'reason': ''}
+    three = {'follow_up': 3, 'rule': 'rule_7', 'reason': ''}
+    assert combine_history([('2019-01-01', review), ('2024-01-01', ten)]) == (ten, '2024-01-01')
+    #an undated procedure can't be placed in time, so it still counts
+    assert combine_history([('2024-01-01', ten), (None, three)]) == (three, '2024-01-01')
+    assert combine_history([(None, ten), ('not a date', three)]) == (three, None)
+
+
+def test_patient_endpoint_combines_history(client, test_case1):
+    first = report(test_case1, '2021-02-03')
+    first.patient_NHI = 'HIS1234'
+    second = report(test_case1, '2024-02-03', size = 12)
+    second.patient_NHI = 'HIS1234'
+
+    with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
+        mock_return.side_effect = [first, second, second.model_copy(update = {'patient_NHI': None})]
+        one = client.post("/triage/patient", json = {'user_query': 'first report'}).json()
+        two = client.post("/triage/patient", json = {'user_query': 'second report'}).json()
+        no_nhi = client.post("/triage/patient", json = {'user_query': 'third report'})
+    assert (one['recommendation']['follow_up'], one['procedures']) == (10, 1)
+    assert (two['recommendation']['rule'], two['procedures'], two['follow_up_from']) == ('rule_7', 2, '2024-02-03')
+    assert no_nhi.status_code == 422
+
+
+def test_same_date_written_two_ways_is_one_procedure(store, test_case1):
+    store.update('patient', report(test_case1, '2024-01-03'), functions.triage_colonoscopy)
+    outcome, procedures, follow_up_from = store.update('patient', report(test_case1, '03/01/2024', size = 12), functions.triage_colonoscopy)
+    assert (outcome['rule'], procedures, follow_up_from) == ('rule_7', 1, '2024-01-03')
+
+
+def test_report_and_patient_history_agree(client, test_case1):
+    #an old piecemeal resection followed by a clean colonoscopy, both in one report
+    data = test_case1.model_copy(deep = True, update = {'patient_age': 50, 'patient_NHI': 'AGR1234'})
+    old = data.colonoscopy[0].model_copy(deep = True, update = {'date': '2018-05-01'})
+    old.polyps[0].resection = 'piecemeal'
+    clean = data.colonoscopy[0].model_copy(deep = True, update = {'date': '01/01/2024', 'polyps': [], 'number_of_polyps': 0})
+    data.colonoscopy = [old, clean]
+
+    with patch("app.functions.format_query_json", new_callable = AsyncMock) as mock_return:
+        mock_return.return_value = data
+        single = client.post("/triage", json = {'user_query': 'history report'}).json()
+        patient = client.post("/triage/patient", json = {'user_query': 'history report'}).json()
+    assert single['recommendation']['rule'] == patient['recommendation']['rule'] == 'rule_18'
+    assert patient['follow_up_from'] == '2024-01-01'
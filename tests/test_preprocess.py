@@ -0,0 +1,87 @@
+import pytest
+
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from app import functions, preprocess
+from app.cache import ExtractionCache
+from app.preprocess import Preprocessor, normalize_whitespace
+
+REPORT = '''Page 1 of 2
+COLONOSCOPY  REPORT
+Patient: John Smith   NHI: ABC1234
+
+Findings:\tcaecum reached, BBPS 3/3/3
+   Polyp 1: 4 mm adenoma, ascending colon, removed complete.
+----------
+Page 2 of 2
+This report is confidential and intended solely for the named recipient.
+Electronically signed by Dr A. Jones 05/05/2025 10:31
+*** END OF REPORT ***
+'''
+
+RESUBMITTED = '''COLONOSCOPY REPORT
+Patient: John Smith NHI: ABC1234
+Findings: caecum reached, BBPS 3/3/3
+
+
+Polyp 1: 4 mm adenoma, ascending colon, removed complete.
+This report is confidential and intended solely for the named recipient.
+Electronically signed by Dr A. Jones 06/05/2025 09:02
+'''
+
+
+def test_boilerplate_is_removed_and_findings_kept():
+    prepared = Preprocessor.from_file().prepare(REPORT)
+    assert prepared.text == (
+        'COLONOSCOPY REPORT\n'
+        'Patient: John Smith NHI: ABC1234\n\n'
+        'Findings: caecum reached, BBPS 3/3/3\n'
+        'Polyp 1: 4 mm adenoma, ascending colon, removed complete.'
+    )
+    assert set(prepared.removed) == {'page_marker', 'separator', 'confidentiality_notice', 'signature', 'end_of_report'}
+    assert prepared.tokens_saved > 0
+
+
+def test_disclaimer_on_a_findings_line_keeps_the_findings():
+    preprocessor = Preprocessor.from_file()
+    text = preprocessor.prepare('Findings: 12mm SSL in the caecum, removed piecemeal. This e-mail and its attachments are confidential.').text
+    assert text == 'Findings: 12mm SSL in the caecum, removed piecemeal.'
+    text = preprocessor.prepare('Caecum reached, BBPS 3/3/3, no polyps seen. This report is confidential and intended solely for the named recipient.').text
+    assert text == 'Caecum reached, BBPS 3/3/3, no polyps seen.'
+
+
+def test_cleaning_that_guts_the_report_falls_back():
+    #a report that is mostly disclaimer is sent whole rather than as an empty string shared with other reports
+    prepared = Preprocessor.from_file().prepare('This report is confidential and intended solely for the named recipient.')
+    assert prepared.fallback
+    assert prepared.text == 'This report is confidential and intended solely for the named recipient.'
+    assert prepared.removed == {}
+
+
+def test_normalize_whitespace_keeps_line_structure():
+    assert normalize_whitespace(' a \t b\r\n\r\n\r\n c  ') == 'a b\n\nc'
+    assert normalize_whitespace('4\u00a0mm') == '4 mm'
+
+
+def test_disabled_preprocessor_passes_text_through():
+    assert Preprocessor.from_file(enabled = False).prepare(REPORT).text == REPORT
+
+
+def test_token_estimate_without_tiktoken(monkeypatch):
+    monkeypatch.setattr(preprocess, '_encoding', False)
+    assert preprocess.count_tokens('x' * 40) == 10
+
+
+@pytest.mark.asyncio
+async def test_resubmission_with_different_boilerplate_hits_the_cache(tmp_path, test_case1):
+    cache = ExtractionCache(str(tmp_path / 'cache.sqlite3'), ttl_seconds = 60, max_entries = 10)
+    with patch.object(functions, 'extraction_cache', cache), \
+         patch.object(functions.hnz_client.responses, 'create', new_callable = AsyncMock) as mock_create:
+        mock_create.return_value = SimpleNamespace(output_text = test_case1.model_dump_json())
+        await functions.format_query_json(REPORT)
+        await functions.format_query_json(RESUBMITTED)
+    cache.close()
+    assert mock_create.call_count == 1
+    sent = mock_create.call_args.kwargs['input'][1]['content']
+    assert 'confidential' not in sent and 'Electronically signed' not in sent
@@ -0,0 +1,89 @@
+import os
+import asyncio
+import pytest
+
+from unittest.mock import patch
+
+from app import functions
+from app.prompt_registry import PromptRegistry
+
+
+PROMPT_YAML = '''name: {name}
+version: {version}
+prompt:
+  role: system
+  content: |
+    {content}
+  rules:
+    - Do not make any clinical diagnoses or suggestions
+'''
+
+
+def write_prompt(path, version, content):
+    path.write_text(PROMPT_YAML.format(name = 'test_prompt', version = version, content = content), encoding = 'utf-8')
+
+
+def test_registry_serves_compiled_prompt_by_name_and_file(tmp_path):
+    write_prompt(tmp_path / 'test_prompt.yaml', '1.0', 'Summarize the report')
+    registry = PromptRegistry(tmp_path, reload_interval = 0)
+    registry.load_all()
+
+    prompt = registry.get('test_prompt')
+    assert prompt is registry.get('test_prompt.yaml')
+    assert prompt.version == '1.0'
+    assert prompt.system_prompt.startswith('Summarize the report')
+    assert '- Do not make any clinical diagnoses or suggestions' in prompt.system_prompt
+
+    with pytest.raises(FileNotFoundError):
+        registry.get('missing.yaml')
+
+
+def test_registry_reloads_only_when_mtime_changes(tmp_path):
+    path = tmp_path / 'test_prompt.yaml'
+    write_prompt(path, '1.0', 'Summarize the report')
+    registry = PromptRegistry(tmp_path, reload_interval = 0)
+    registry.load_all()
+    first = registry.get('test_prompt')
+    assert registry.get('test_prompt') is first
+
+    write_prompt(path, '1.1', 'Summarize the whole report')
+    os.utime(path, (first.mtime + 10, first.mtime + 10))
+    #get() serves what is loaded, the edit is only picked up by a reload
+    assert registry.get('test_prompt') is first
+    registry.reload()
+    reloaded = registry.get('test_prompt')
+    assert reloaded.version == '1.1'
+    assert reloaded.system_prompt.startswith('Summarize the whole report')
+
+    #a broken save keeps the last good prompt
+    path.write_text('prompt: [unclosed', encoding = 'utf-8')
+    os.utime(path, (first.mtime + 20, first.mtime + 20))
+    registry.reload()
+    assert registry.get('test_prompt') is reloaded
+
+
+@pytest.mark.asyncio
+async def test_background_reload_keeps_get_off_the_disk(tmp_path):
+    path = tmp_path / 'test_prompt.yaml'
+    write_prompt(path, '1.0', 'Summarize the report')
+    registry = PromptRegistry(tmp_path, reload_interval = 0.01)
+    registry.load_all()
+    first = registry.get('test_prompt')
+    write_prompt(path, '1.1', 'Summarize the whole report')
+    os.utime(path, (first.mtime + 10, first.mtime + 10))
+
+    with patch.object(PromptRegistry, '_scan', side_effect = AssertionError('get() read the disk')):
+        assert registry.get('test_prompt') is first
+
+    registry.start()
+    for _ in range(200):
+        if registry.get('test_prompt').version == '1.1':
+            break
+        await asyncio.sleep(0.01)
+    await registry.close()
+    assert registry.get('test_prompt').version == '1.1'
+
+
+def test_load_prompt_uses_registry():
+    system_prompt = functions.load_prompt(functions.JSON_SUMMARY_PROMPT)
+    assert system_prompt == functions.prompt_registry.get('json_summarize_input_text').system_prompt
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+
+from app import functions
+from app.redaction import RedactionService
+
+
+class FakeNer:
+    '''
+    Stands in for the Hugging Face pipeline - tags every occurrence of "Bob" as a NAME
+    '''
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        results = []
+        for text in texts:
+            entities = []
+            start = text.find('Bob')
+            while start != -1:
+                entities.append({'start': start, 'end': start + 3, 'entity_group': 'NAME'})
+                start = text.find('Bob', start + 3)
+            results.append(entities)
+        return results
+
+
+def test_apply_redactions_uses_original_offsets():
+    text = 'Bob ABC1234 had a 3mm adenoma, Bob was discharged'
+    entities = [
+        {'start': 0, 'end': 3, 'entity_group': 'NAME'},
+        {'start': 31, 'end': 34, 'entity_group': 'NAME'},
+    ]
+    assert functions.apply_redactions(text, entities) == 'NAME [NHI] had a 3mm adenoma, NAME was discharged'
+
+
+def test_apply_redactions_skips_overlapping_spans():
+    text = 'NHI ABC1234'
+    entities = [{'start': 4, 'end': 11, 'entity_group': 'ID'}]
+    assert functions.apply_redactions(text, entities) == 'NHI ID'
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reports_share_one_pipeline_call():
+    ner = FakeNer()
+    service = RedactionService(ner_factory = lambda: ner, max_batch_size = 8, max_wait = 0.05)
+    texts = [f'Report {i} for Bob' for i in range(5)]
+    try:
+        redacted = await asyncio.gather(*(service.redact(text) for text in texts))
+    finally:
+        await service.close()
+
+    assert redacted == [f'Report {i} for NAME' for i in range(5)]
+    assert len(ner.calls) == 1
+    assert service.stats() == {'batches': 1, 'reports': 5}
+
+
+@pytest.mark.asyncio
+async def test_batches_flush_at_max_size():
+    ner = FakeNer()
+    service = RedactionService(ner_factory = lambda: ner, max_batch_size = 2, max_wait = 0.05)
+    try:
+        await asyncio.gather(*(service.redact(f'Bob {i}') for i in range(5)))
+    finally:
+        await service.close()
+    assert [len(call) for call in ner.calls] == [2, 2, 1]
@@ -0,0 +1,163 @@
+import json
+import pytest
+
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, patch
+
+from app import functions, metrics
+from app.llm_router import Deployment
+from app.models.colonoscopy import ColonoscopySummary
+from app.repair import parse_output, text_format
+
+
+def drifted(summary) -> str:
+    data = summary.model_dump()
+    colonoscopy = data['colonoscopy'][0]
+    colonoscopy['cecum_reached'] = 'no'
+    colonoscopy['bostonBowelPrepScore'] = {'right': 4, 'transverse': '2', 'left': 3, 'total': 8}
+    colonoscopy['polyps'] = [
+        {'location': 'Caecum', 'size': '5 mm', 'type': 'SSL', 'dysplasia': 'no dysplasia', 'resection': 'en bloc', 'retrieval': 'retrieved'},
+        {'location': 'left colon', 'size': 3, 'type': 'Tubular adenoma', 'dysplasia': 'LGD', 'resection': 'completely resected', 'retrieval': 'fragmented'},
+    ]
+    colonoscopy['number_of_polyps'] = 'two'
+    data['indication'] = 'Positive FIT'
+    return json.dumps(data)
+
+
+def test_text_format_is_strict():
+    def objects(schema):
+        if isinstance(schema, dict):
+            if schema.get('type') == 'object':
+                yield schema
+            for value in schema.values():
+                yield from objects(value)
+        elif isinstance(schema, list):
+            for value in schema:
+                yield from objects(value)
+
+    fmt = text_format(ColonoscopySummary)
+    assert (fmt['type'], fmt['name'], fmt['strict']) == ('json_schema', 'ColonoscopySummary', True)
+    found = list(objects(fmt['schema']))
+    assert len(found) == 4
+    for schema in found:
+        assert schema['additionalProperties'] is False
+        assert schema['required'] == list(schema['properties'])
+    assert '"default": null' not in json.dumps(fmt)
+
+
+def test_valid_output_is_not_repaired(test_case1):
+    result = parse_output(test_case1.model_dump_json())
+    assert result.summary == test_case1
+    assert result.repairs == [] and not result.repaired
+
+
+def test_drifted_output_is_repaired(test_case1):
+    result = parse_output(drifted(test_case1))
+    assert result.repaired
+    colonoscopy = result.summary.colonoscopy[0]
+    assert colonoscopy.cecum_reached is False
+    assert (colonoscopy.bostonBowelPrepScore.right, colonoscopy.bostonBowelPrepScore.transverse) == (3, 2)
+    assert colonoscopy.bostonBowelPrepScore.total == 8
+    assert colonoscopy.number_of_polyps == 2
+    first, second = colonoscopy.polyps
+    assert (first.location, first.size, first.type, first.dysplasia) == ('cecum', 5, 'sessile_serrated_polyp', 'none')
+    assert (first.resection, first.retrieval) == ('complete', 'complete')
+    assert (second.location, second.type, second.dysplasia, second.resection) == (None, 'adenoma', 'low_grade', 'complete')
+    assert second.retrieval == 'unknown'
+    assert result.summary.indication == 'positive_faecal_immunochemical_test'
+    assert 'cecum_reached_bool' in result.repairs and 'bbps_right_clamped' in result.repairs
+
+
+@pytest.mark.parametrize('text', [
+    'I am unable to summarise this report.',
+    '{"patient_name": null, "colonoscopy": [{"polyps": [{"type": "carcinoid", "size": 4}]}',
+    '{"patient_name": null, "colonoscopy": [{"polyps": [{"type": "carcinoid", "size": 4}]}]}',
+    '{"colonoscopy": [{"polyps": [{"type": "adenoma", "size": "large"}]}]}',
+    '{"colonoscopy": [{"cecum_reached": "partially"}]}',
+    '{"colonoscopy": "unknown"}',
+])
+def test_unrepairable_output_fails(text):
+    #a value the triage rules depend on is never guessed
+    result = parse_output(text)
+    assert result.summary is None
+    assert result.error
+
+
+@pytest.mark.parametrize('field, value', [
+    ('resection', 'removed piecemeal'),
+    ('resection', 'removed in fragments'),
+    ('resection', 'cold snare'),
+    ('dysplasia', 'not assessed'),
+    ('dysplasia', 'not reported'),
+    ('dysplasia', 'nondiagnostic'),
+    ('type', 'tattooed site'),
+])
+def test_values_the_rules_depend_on_are_not_guessed(test_case1, field, value):
+    data = test_case1.model_dump()
+    data['colonoscopy'][0]['polyps'][0][field] = value
+    result = parse_output(json.dumps(data))
+    assert result.summary is None
+    assert field in result.error
+
+
+@pytest.mark.parametrize('size', ['9.5 mm', '10.5', 9.5])
+def test_fractional_sizes_are_not_rounded(test_case1, size):
+    data = test_case1.model_dump()
+    data['colonoscopy'][0]['polyps'][0]['size'] = size
+    result = parse_output(json.dumps(data))
+    assert result.summary is None
+    assert 'polyp_size' in result.error
+
+
+def test_whole_number_sizes_keep_their_value(test_case1):
+    data = test_case1.model_dump()
+    data['colonoscopy'][0]['polyps'][0]['size'] = '10.0 mm'
+    assert parse_output(json.dumps(data)).summary.colonoscopy[0].polyps[0].size == 10
+
+
+@pytest.mark.parametrize('indication', ['IBD surveillance', 'Ulcerative colitis', "Crohn's disease"])
+def test_ibd_indications_stay_ibd(test_case1, indication):
+    data = test_case1.model_dump()
+    data['indication'] = indication
+    result = parse_output(json.dumps(data))
+    assert result.summary.indication == 'ibd'
+
+
+@pytest.mark.parametrize('indication', ['history of bleeding from IBD', 'surveillance', 'colonoscopy requested by GP'])
+def test_unlisted_indication_is_not_guessed(test_case1, indication):
+    data = test_case1.model_dump()
+    data['indication'] = indication
+    result = parse_output(json.dumps(data))
+    assert result.summary is None
+    assert 'indication' in result.error
+
+
+@pytest.mark.asyncio
+async def test_format_query_json_repairs_without_a_second_call(test_case1):
+    repaired_before = metrics.structured_output.value(outcome = 'repaired')
+    response = SimpleNamespace(output_text = drifted(test_case1), usage = SimpleNamespace(input_tokens = 900, output_tokens = 300))
+    with patch.object(functions.extraction_cache, 'enabled', False), \
+         patch.object(functions.hnz_client.responses, 'create', new_callable = AsyncMock) as mock_create:
+        mock_create.return_value = response
+        output = await functions.format_query_json('a report the model answers with drifted output')
+    assert mock_create.call_count == 1
+    assert output.colonoscopy[0].polyps[0].type == 'sessile_serrated_polyp'
+    assert metrics.structured_output.value(outcome = 'repaired') == repaired_before + 1
+    assert metrics.structured_output_repairs.value(repair = 'polyp_type_synonym') >= 2
+
+
+@pytest.mark.asyncio
+async def test_format_query_json_asks_again_when_repair_fails(monkeypatch, test_case1):
+    def deployment(name, output_text):
+        create = AsyncMock(return_value = SimpleNamespace(output_text = output_text, usage = None))
+        return Deployment(name, SimpleNamespace(responses = SimpleNamespace(create = create)), f'{name}-model')
+
+    prose = deployment('prose', 'I am unable to summarise this report.')
+    good = deployment('good', test_case1.model_dump_json())
+    monkeypatch.setattr(functions.extraction_cache, 'enabled', False)
+    monkeypatch.setattr(functions.extraction_router, 'deployments', [prose, good])
+    monkeypatch.setattr(functions.extraction_router, 'pick', lambda exclude: next((d for d in (prose, good) if d not in exclude), None))
+    output = await functions.format_query_json('a report one deployment answers with prose')
+    assert prose.client.responses.create.call_count == 1
+    assert good.client.responses.create.call_count == 1
+    assert output == test_case1
@@ -0,0 +1,150 @@
+import pytest
+
+from app.models.colonoscopy import BostonBowelPrepScore, Colonoscopy, ColonoscopySummary, Polyp
+
+from app import functions, rules
+from app.synthetic import random_summaries
+
+
+def test_model_and_dump_paths_agree():
+    #both paths evaluate RULE_TABLE, this checks the feature extraction of models against that of dumps -
+    #the outcomes themselves are pinned by GOLDEN below
+    summaries = [s.model_dump() for s in random_summaries(5000, seed = 1)]
+    seen_rules = set()
+    for data in summaries:
+        expected = functions.age_out(data, functions.triage(data))
+        assert rules.triage_with_age_out(data) == expected
+        assert rules.triage(data) == functions.triage(data)
+        seen_rules.add(expected['rule'])
+    #the synthetic data should reach nearly every rule, otherwise this test proves little
+    assert len(seen_rules) >= 18
+
+
+def test_rules_engine_matches_fixture(test_case1):
+    data = test_case1.model_dump()
+    assert rules.triage_with_age_out(data) == {'follow_up': 20, 'rule': 'rule_20', 'reason': 'Patient aged out'}
+    data['patient_age'] = 50
+    assert rules.triage_with_age_out(data) == {'follow_up': 10, 'rule': 'rule_17', 'reason': '1-2 adenomas less than 10mm no hgd'}
+
+
+def test_rule_table_reasons_come_from_rules_dict():
+    assert functions.rules_dict is rules.rules_dict
+    for rule, _, _ in rules.RULE_TABLE:
+        assert rule in rules.rules_dict
+
+
+def test_triage_accepts_models_and_dicts(test_case1):
+    data = test_case1.model_dump()
+    assert functions.triage(test_case1) == functions.triage(data)
+    assert functions.age_out(test_case1, functions.triage(test_case1)) == rules.triage_with_age_out(data)
+
+
+def test_failed_extraction_needs_review():
+    expected = {'follow_up': 0, 'rule': 'rule_24', 'reason': 'Extraction failed, needs human review'}
+    empty = functions.empty_summary()
+    assert functions.triage(empty) == expected
+    assert functions.age_out(empty, functions.triage(empty)) == expected
+    assert rules.triage_with_age_out(empty.model_dump()) == expected
+
+
+def test_every_procedure_in_the_history_is_triaged():
+    from app import bulk
+
+    summaries = [s.model_dump() for s in random_summaries(3000, seed = 3, max_colonoscopies = 4)]
+    result = bulk.triage_with_age_out(summaries)
+    for i, data in enumerate(summaries):
+        expected = functions.age_out(data, functions.triage(data))
+        assert rules.triage_with_age_out(data) == expected
+        assert result.outcome(i) == expected
+        #the combined outcome is the patient history outcome of the single procedure outcomes
+        single = [(c['date'], functions.triage({**data, 'colonoscopy': [c]})) for c in data['colonoscopy']]
+        assert functions.triage(data) == rules.combine_history(single)[0]
+
+
+def test_dates_are_normalized():
+    for value in ('2024-01-03', '03/01/2024', '3/1/2024', '03.01.2024', '3 January 2024', 'Jan 3, 2024', ' 2024/01/03 '):
+        assert rules.normalize_date(value) == '2024-01-03'
+    for value in (None, '', 'yesterday', '2024-13-01'):
+        assert rules.normalize_date(value) is None
+
+
+def test_human_review_outranks_shorter_follow_up():
+    outcomes = [
+        {'follow_up': 3, 'rule': 'rule_7', 'reason': rules.rules_dict['rule_7']},
+        {'follow_up': 0, 'rule': 'rule_2', 'reason': rules.rules_dict['rule_2']},
+        {'follow_up': 10, 'rule': 'rule_18', 'reason': rules.rules_dict['rule_18']},
+    ]
+    assert rules.most_conservative(outcomes)['rule'] == 'rule_2'
+    assert rules.most_conservative([outcomes[2], outcomes[0]])['rule'] == 'rule_7'
+
+
+def test_caecum_not_reached_needs_review(test_case1):
+    from app import bulk
+
+    data = test_case1.model_copy(deep = True, update = {'patient_age': 50})
+    data.colonoscopy[0].cecum_reached = False
+    expected = {'follow_up': 0, 'rule': 'rule_1', 'reason': 'Cecum not reached'}
+    assert functions.age_out(data, functions.triage(data)) == expected
+    assert rules.triage_with_age_out(data.model_dump()) == expected
+    assert bulk.triage_with_age_out([data.model_dump()]).outcome(0) == expected
+    #not stated is not the same as not reached
+    data.colonoscopy[0].cecum_reached = None
+    assert functions.triage(data)['rule'] == 'rule_17'
+
+
+def polyp(polyp_type = 'adenoma', size = 3, dysplasia = 'low_grade', resection = 'complete'):
+    return Polyp(type = polyp_type, size = size, dysplasia = dysplasia, resection = resection, retrieval = 'complete')
+
+
+def summary(polyps = (), number_of_polyps = None, indication = 'screening', patient_age = 50, cecum_reached = True, right = 3):
+    bbps = BostonBowelPrepScore(total = 6 + right, right = right, transverse = 3, left = 3)
+    colonoscopy = Colonoscopy(date = '2025-01-01', cecum_reached = cecum_reached, bostonBowelPrepScore = bbps, polyps = list(polyps),
+                              number_of_polyps = len(polyps) if number_of_polyps is None else number_of_polyps)
+    return ColonoscopySummary(patient_age = patient_age, indication = indication, colonoscopy = [colonoscopy])
+
+
+SSL = 'sessile_serrated_polyp'
+
+#hand-checked (rule, follow up, summary) for each rule, written out independently of RULE_TABLE so an edit to the table is caught.
+#rule_23 is not listed - rule_18 matches every case without polyps first
+GOLDEN = [
+    ('rule_1', 0, summary(cecum_reached = False)),
+    ('rule_2', 0, summary([polyp()], right = 1)),
+    ('rule_3', 0, summary([polyp()], indication = 'sps')),
+    ('rule_4', 0, summary([polyp()] * 10)),
+    ('rule_21', 0, summary([polyp(resection = 'piecemeal')])),
+    ('rule_22', 0, summary([polyp()], indication = 'ibd')),
+    ('rule_5', 3, summary([polyp(SSL, 10, 'none')])),
+    ('rule_6', 3, summary([polyp(SSL, 5, 'low_grade')])),
+    ('rule_7', 3, summary([polyp(size = 12)])),
+    ('rule_8', 3, summary([polyp('tubulovillous_or_villous_adenoma', 5)])),
+    ('rule_9', 3, summary([polyp(dysplasia = 'high_grade')])),
+    ('rule_10', 3, summary([polyp(SSL, 5, 'none')] * 5)),
+    ('rule_11', 3, summary([polyp()] * 6)),
+    ('rule_12', 3, summary([polyp()] * 3 + [polyp(SSL, 5, 'none')] * 2)),
+    ('rule_13', 3, summary([polyp('hyperplastic_polyp', 12, 'none')])),
+    ('rule_14', 5, summary([polyp()] * 3)),
+    ('rule_15', 5, summary([polyp(SSL, 5, 'none')] * 2)),
+    ('rule_16', 5, summary([polyp(), polyp(SSL, 5, 'none')])),
+    ('rule_17', 10, summary([polyp()])),
+    ('rule_18', 10, summary()),
+    ('rule_19', 0, summary([polyp(), polyp(SSL, 5, 'none')], number_of_polyps = 10)),
+    ('rule_20', 20, summary([polyp()], patient_age = 70)),
+    ('rule_5', 3, summary([polyp(SSL, 10, 'none')], patient_age = 75)),
+    ('rule_20', 20, summary([polyp(SSL, 10, 'none')], patient_age = 76)),
+    ('rule_24', 0, ColonoscopySummary(extraction_successful = False)),
+]
+
+
+def test_every_rule_has_a_golden_case():
+    assert {rule for rule, _, _ in GOLDEN} == set(rules.rules_dict) - {'rule_23'}
+
+
+@pytest.mark.parametrize('rule, follow_up, data', GOLDEN, ids = [f'{rule}-{i}' for i, (rule, _, _) in enumerate(GOLDEN)])
+def test_golden_outcomes(rule, follow_up, data):
+    from app import bulk
+
+    expected = {'follow_up': follow_up, 'rule': rule, 'reason': rules.rules_dict[rule]}
+    assert functions.age_out(data, functions.triage(data)) == expected
+    assert rules.triage_with_age_out(data.model_dump()) == expected
+    assert bulk.triage_with_age_out([data.model_dump()]).outcome(0) == expected